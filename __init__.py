@@ -0,0 +1,53 @@
+import importlib
+
+"""
+The package imports nothing up front: submodules, and the main classes and
+functions listed in _LAZY, are loaded on first attribute access (PEP 562),
+so that
+
+import NN
+model = NN.FullyConnectedNet([100, 100])
+
+only loads numpy and the layers, and the Solver, gradient checking and
+benchmarking code are only imported by the programs that use them. Inference
+workers should import NN.inference, which never loads the training code.
+"""
+
+_SUBMODULES = (
+    'autotune', 'benchmark', 'cnn', 'data_utils', 'detect', 'fast_layers',
+    'fc_net', 'gradient_check', 'inference', 'layer_utils', 'layers',
+    'lowrank', 'lr_schedule', 'metrics', 'optim', 'profiler', 'pruning',
+    'quantize', 'runtime', 'sequential', 'solver',
+)
+
+_LAZY = {
+    'ConvNet': 'cnn',
+    'FullyConnectedNet': 'fc_net',
+    'IncrementalDetector': 'detect',
+    'MagnitudePruner': 'pruning',
+    'PredictionCache': 'detect',
+    'Sequential': 'sequential',
+    'Solver': 'solver',
+    'SparseFCNet': 'pruning',
+    'compress_affine': 'lowrank',
+    'detect_digits': 'detect',
+    'load_checkpoint': 'inference',
+    'quantize_model': 'quantize',
+}
+
+__all__ = sorted(_LAZY)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('%s.%s' % (__name__, name))
+    if name in _LAZY:
+        module = importlib.import_module('%s.%s' % (__name__, _LAZY[name]))
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | set(_LAZY))
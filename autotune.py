@@ -0,0 +1,254 @@
+from __future__ import print_function, division
+import json
+import os
+import time
+
+import numpy as np
+
+"""
+This file implements a batch size autotuner and the per-machine tuning
+profile that the Solver and the inference code read their default batch
+sizes from.
+
+autotune sweeps batch sizes for a model, timing training steps (a forward
+and backward pass) and test-time forward passes. It measures the throughput
+in samples per second and the peak memory allocated by a call, skips batch
+sizes whose peak memory exceeds a cap, and records for each mode the smallest
+batch size within tolerance of the best throughput: beyond that point larger
+batches only cost memory. The results are saved in a JSON profile, stored by
+default in ~/.cache/NN/tuning.json (or the file named by the NN_TUNING_PROFILE
+environment variable), under the name of the machine and a signature of the
+model architecture, so one file can be shared between machines.
+
+Example usage:
+
+autotune(model, data['X_train'], data['y_train'], memory_cap=2**30)
+
+# Later, on the same machine, for a model with the same architecture
+solver = Solver(model, data)            # uses the tuned training batch size
+y_pred = predict(model, data['X_test'])  # uses the tuned inference batch size
+
+An explicit batch_size always takes precedence over the profile. Note that
+the training batch size is tuned for speed only; it also changes the
+optimization, so the learning rate may need to be tuned again.
+"""
+
+# Parsed profiles by path, with the modification time they were read at
+_profiles = {}
+
+
+def default_profile_path():
+    """
+    Path of the tuning profile used when none is given.
+    """
+    path = os.environ.get('NN_TUNING_PROFILE')
+    if path:
+        return path
+    return os.path.join(os.path.expanduser('~'), '.cache', 'NN', 'tuning.json')
+
+
+def machine_key():
+    """
+    Name under which the settings of this machine are stored in a profile.
+    """
+    if hasattr(os, 'uname'):
+        uname = os.uname()
+        return '%s-%s' % (uname.nodename, uname.machine)
+    import platform
+    return '%s-%s' % (platform.node(), platform.machine())
+
+
+def model_signature(model):
+    """
+    String identifying the architecture of a model: its class, its declared
+    dtype attribute, and the names and shapes of its parameters. The dtypes of
+    the parameter arrays are left out, since update rules such as adam upcast
+    them during training. Models without a params dictionary have no
+    signature and return None.
+    """
+    params = getattr(model, 'params', None)
+    if not params:
+        return None
+    shapes = ','.join('%s:%s' % (p, 'x'.join(map(str, params[p].shape)))
+                      for p in sorted(params))
+    dtype = getattr(model, 'dtype', None)
+    dtype = '' if dtype is None else np.dtype(dtype).str
+    return '%s[%s](%s)' % (type(model).__name__, dtype, shapes)
+
+
+def load_profile(path=None):
+    """
+    Load a tuning profile; a missing or unreadable file gives an empty one.
+    Profiles are cached and only read again when the file changes.
+    """
+    path = path or default_profile_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    cached = _profiles.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except ValueError:
+        profile = {}
+    _profiles[path] = (mtime, profile)
+    return profile
+
+
+def save_settings(model, settings, path=None):
+    """
+    Store the settings of a model for this machine in a tuning profile,
+    replacing earlier settings of models with the same signature.
+    """
+    signature = model_signature(model)
+    if signature is None:
+        raise ValueError('The model has no params dictionary to tune for')
+    path = path or default_profile_path()
+    profile = dict(load_profile(path))
+    profile.setdefault(machine_key(), {})[signature] = settings
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Write then rename, so that readers never see a partial file
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def load_settings(model, path=None):
+    """
+    Settings recorded by autotune for models with the architecture of model
+    on this machine, or None.
+    """
+    signature = model_signature(model)
+    if signature is None:
+        return None
+    return load_profile(path).get(machine_key(), {}).get(signature)
+
+
+def tuned_batch_size(model, mode, default, path=None):
+    """
+    Tuned batch size of model for mode ('train' or 'inference') on this
+    machine, or default if the model has not been tuned. A path of False
+    disables the lookup.
+    """
+    if path is False:
+        return default
+    settings = load_settings(model, path)
+    if not settings or mode not in settings:
+        return default
+    return settings[mode]['batch_size']
+
+
+def _sweep(call, batch_sizes, memory_cap, repeats, min_time, verbose, mode):
+    """
+    Measure call(batch_size) for every batch size in increasing order,
+    stopping at the first one over memory_cap.
+    """
+    from NN.profiler import _peak_memory
+
+    results = {}
+    for batch_size in sorted(batch_sizes):
+        _, peak = _peak_memory(call, batch_size)
+        if memory_cap is not None and peak > memory_cap:
+            if verbose:
+                print('%-9s batch size %5d: %.1f MB over the memory cap' % (
+                      mode, batch_size, peak / 2.0**20))
+            break
+        # Repeat the call so that each measurement takes at least min_time
+        start = time.perf_counter()
+        call(batch_size)
+        number = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(number):
+                call(batch_size)
+            best = min(best, (time.perf_counter() - start) / number)
+        results[batch_size] = {'samples_per_sec': batch_size / best,
+                               'time': best, 'peak_bytes': peak}
+        if verbose:
+            print('%-9s batch size %5d: %10.0f samples/s  %8.1f MB' % (
+                  mode, batch_size, batch_size / best, peak / 2.0**20))
+    return results
+
+
+def _choose(results, tolerance):
+    """
+    Smallest batch size within tolerance of the best throughput.
+    """
+    if not results:
+        return None
+    best = max(r['samples_per_sec'] for r in results.values())
+    for batch_size in sorted(results):
+        if results[batch_size]['samples_per_sec'] >= (1 - tolerance) * best:
+            return batch_size
+
+
+def autotune(model, X, y=None,
+             batch_sizes=(8, 16, 32, 64, 128, 256, 512, 1024),
+             memory_cap=None, tolerance=0.05, modes=('train', 'inference'),
+             repeats=3, min_time=0.05, path=None, save=True, verbose=True):
+    """
+    Find the batch sizes with the best throughput of a model on this machine
+    and record them in the tuning profile.
+
+    Inputs:
+    - model: A model following the Solver API. It is not modified; the
+      sweep runs on a copy so that batch normalization statistics are kept.
+    - X: Array of data with at least max(batch_sizes) samples, e.g.
+      data['X_train']; larger batch sizes are skipped.
+    - y: Labels of X, required for the 'train' mode.
+    - batch_sizes: Batch sizes to try.
+    - memory_cap: If not None, largest peak memory in bytes allowed for one
+      call; the sweep stops at the first batch size above it.
+    - tolerance: The smallest batch size whose throughput is within this
+      fraction of the best one is chosen.
+    - modes: 'train' times model.loss(X, y), 'inference' times model.loss(X).
+    - repeats, min_time: Each batch size is timed repeats times, each over
+      enough calls to take at least min_time seconds; the best is kept.
+    - path: Path of the profile; default_profile_path() if None.
+    - save: If True, record the chosen settings in the profile.
+
+    Returns:
+    - A dictionary mapping each mode to a dictionary with the chosen
+      'batch_size', its 'samples_per_sec' and 'peak_bytes', and the whole
+      'sweep' mapping batch sizes (as strings, as in the JSON profile) to
+      their measurements.
+    """
+    import copy
+
+    if 'train' in modes and y is None:
+        raise ValueError('Tuning the train mode requires labels y')
+    model = copy.deepcopy(model)
+    batch_sizes = [b for b in batch_sizes if b <= X.shape[0]]
+    if not batch_sizes:
+        raise ValueError('X has fewer samples than the smallest batch size')
+
+    calls = {
+        'train': lambda b: model.loss(X[:b], y[:b]),
+        'inference': lambda b: model.loss(X[:b]),
+    }
+    settings = {'time': time.time()}
+    for mode in modes:
+        sweep = _sweep(calls[mode], batch_sizes, memory_cap, repeats,
+                       min_time, verbose, mode)
+        batch_size = _choose(sweep, tolerance)
+        if batch_size is None:
+            raise ValueError('Every batch size exceeds the memory cap')
+        settings[mode] = {
+            'batch_size': batch_size,
+            'samples_per_sec': sweep[batch_size]['samples_per_sec'],
+            'peak_bytes': sweep[batch_size]['peak_bytes'],
+            'sweep': {str(b): r for b, r in sweep.items()},
+        }
+        if verbose:
+            print('%-9s best batch size: %d' % (mode, batch_size))
+
+    if save:
+        save_settings(model, settings, path)
+    return settings
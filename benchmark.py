@@ -0,0 +1,861 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from NN import optim
+from NN.cnn import ConvNet
+from NN.data_utils import collapse_identical_channels
+from NN.detect import IncrementalDetector, detect_digits
+from NN.fast_layers import (conv_backward_fast, conv_forward_fast,
+                            max_pool_backward_fast, max_pool_forward_fast)
+from NN.fc_net import FullyConnectedNet
+from NN.layer_utils import (affine_relu_backward, affine_relu_forward,
+                            lowrank_affine_relu_backward,
+                            lowrank_affine_relu_forward,
+                            sparse_affine_relu_backward,
+                            sparse_affine_relu_forward)
+from NN.layers import (affine_backward, affine_forward, batchnorm_backward,
+                       batchnorm_backward_alt, batchnorm_forward,
+                       conv_backward_naive, conv_forward_naive,
+                       distillation_loss, dropout_backward, dropout_forward, layernorm_backward,
+                       layernorm_forward, lowrank_affine_backward,
+                       lowrank_affine_forward, max_pool_backward_naive,
+                       max_pool_forward_naive, relu_backward, relu_forward,
+                       softmax_loss, softmax_loss_topk,
+                       sparse_affine_backward, sparse_affine_forward,
+                       spatial_batchnorm_backward, spatial_batchnorm_forward,
+                       spatial_groupnorm_backward, spatial_groupnorm_forward,
+                       svm_loss)
+from NN.profiler import _nbytes, _peak_memory
+from NN.pruning import MagnitudePruner, SparseFCNet
+from NN.quantize import evaluate_quantization, quantize_model
+from NN.runtime import available_cores, get_blas_threads
+from NN.solver import Solver
+
+"""
+This file contains benchmarks comparing the speed and accuracy of different
+training and inference configurations. Each benchmark returns a dictionary of
+results and prints a short summary when verbose is True.
+
+The benchmarks accept a data dictionary in the format used by Solver. When no
+data is given, synthetic_data() generates a small random classification problem
+with the same shape as the digit images so the benchmarks can run anywhere.
+
+The second half of the file is a regression suite timing every layer function,
+the layer_utils sandwiches, FullyConnectedNet training steps, the update rules
+and Solver iterations. Run it as
+
+python -m NN.benchmark --out results.json [--baseline baseline.json] [--quick]
+
+to save the results together with machine information as JSON, and to compare
+them against a stored baseline; the exit status is 1 if any case got slower
+than the baseline by more than the tolerance. Store a baseline for a machine
+with --save-baseline baseline.json.
+"""
+
+
+def synthetic_data(num_train=2000, num_val=500, input_shape=(28, 28, 3),
+                   num_classes=10, seed=0):
+    """
+    Generate a linearly separable-ish random dataset in the format expected by
+    Solver: uint8-range images of shape (N,) + input_shape and integer labels.
+    """
+    rng = np.random.RandomState(seed)
+    D = int(np.prod(input_shape))
+    centers = rng.uniform(0, 255, size=(num_classes, D))
+    N = num_train + num_val
+    y = rng.randint(num_classes, size=N)
+    X = centers[y] + rng.normal(scale=64, size=(N, D))
+    X = np.clip(X, 0, 255).reshape((N,) + tuple(input_shape))
+    return {
+        'X_train': X[:num_train], 'y_train': y[:num_train],
+        'X_val': X[num_train:], 'y_val': y[num_train:],
+    }
+
+
+def _time_training(model, data, num_epochs, seed, **solver_kwargs):
+    np.random.seed(seed)
+    solver = Solver(model, data, num_epochs=num_epochs, verbose=False,
+                    **solver_kwargs)
+    start = time.time()
+    solver.train()
+    elapsed = time.time() - start
+    return {
+        'step_time': elapsed / max(solver.loss_history.count, 1),
+        'val_acc': solver.best_val_acc,
+        'final_loss': solver.loss_history[-1],
+    }
+
+
+def benchmark_mixed_precision(data=None, hidden_dims=(150, 150), num_epochs=2,
+                              batch_size=100, learning_rate=1e-3, seed=0,
+                              verbose=True):
+    """
+    Compare training a FullyConnectedNet in pure float64 against mixed precision
+    (float32 compute with float64 master weights in the Solver).
+
+    Returns a dictionary mapping 'float64' and 'mixed' to dictionaries with the
+    average time per step, best validation accuracy and final training loss.
+    """
+    if data is None:
+        data = synthetic_data(seed=seed)
+    input_dim = int(np.prod(data['X_train'].shape[1:]))
+    solver_kwargs = {
+        'update_rule': 'adam',
+        'optim_config': {'learning_rate': learning_rate},
+        'batch_size': batch_size,
+    }
+
+    results = {}
+    for name, dtype, master_dtype in [('float64', np.float64, None),
+                                      ('mixed', np.float32, np.float64)]:
+        np.random.seed(seed)
+        model = FullyConnectedNet(list(hidden_dims), input_dim=input_dim,
+                                  normalization='batchnorm', dtype=dtype)
+        results[name] = _time_training(model, data, num_epochs, seed,
+                                       master_dtype=master_dtype,
+                                       **solver_kwargs)
+
+    if verbose:
+        for name, r in results.items():
+            print('%-8s step: %.2f ms  val_acc: %f  loss: %f' % (
+                  name, 1000 * r['step_time'], r['val_acc'], r['final_loss']))
+        print('speedup: %.2fx' % (results['float64']['step_time'] /
+                                  results['mixed']['step_time']))
+    return results
+
+
+def _images_per_second(model, X, batch_size=100, repeats=3):
+    """
+    Best-of-repeats test-time throughput of model.loss on X in images/s.
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        for i in range(0, X.shape[0], batch_size):
+            model.loss(X[i:i + batch_size])
+        best = min(best, time.time() - start)
+    return X.shape[0] / best
+
+
+def benchmark_convnet(data=None, num_epochs=2, batch_size=100,
+                      learning_rate=1e-3, seed=0, verbose=True):
+    """
+    Compare a ConvNet against FullyConnectedNet([150, 150]) trained on the same
+    data with Adam. The images must have shape (N, 28, 28, 3).
+
+    Returns a dictionary mapping 'convnet' and 'fc_net' to dictionaries with
+    the training and inference throughput in images/s, the best validation
+    accuracy and the number of parameters.
+    """
+    if data is None:
+        data = synthetic_data(seed=seed)
+    input_dim = int(np.prod(data['X_train'].shape[1:]))
+    models = [
+        ('convnet', lambda: ConvNet(normalization='batchnorm')),
+        ('fc_net', lambda: FullyConnectedNet([150, 150], input_dim=input_dim,
+                                             normalization='batchnorm')),
+    ]
+
+    results = {}
+    for name, build in models:
+        np.random.seed(seed)
+        model = build()
+        r = _time_training(model, data, num_epochs, seed, update_rule='adam',
+                           optim_config={'learning_rate': learning_rate},
+                           batch_size=batch_size)
+        results[name] = {
+            'train_images_per_sec': batch_size / r['step_time'],
+            'test_images_per_sec': _images_per_second(model, data['X_val']),
+            'val_acc': r['val_acc'],
+            'num_params': sum(v.size for v in model.params.values()),
+        }
+
+    if verbose:
+        for name, r in results.items():
+            print('%-8s train: %8.1f img/s  test: %8.1f img/s  val_acc: %f  '
+                  'params: %d' % (name, r['train_images_per_sec'],
+                                  r['test_images_per_sec'], r['val_acc'],
+                                  r['num_params']))
+    return results
+
+
+def benchmark_quantization(data=None, hidden_dims=(150, 150), num_epochs=2,
+                           num_calib=500, seed=0, verbose=True):
+    """
+    Train a FullyConnectedNet, quantize it to int8 with quantize_model and
+    compare the two on the validation set. The float model is compared as a
+    float32 copy, since adam upcasts the params to float64 during training.
+
+    Returns the dictionary of evaluate_quantization, extended with the
+    inference throughput in images/s of the float32 model, of the int8 model
+    and of the int8 model with cached float32 weights, and the resident bytes
+    of the latter.
+    """
+    import copy
+
+    if data is None:
+        data = synthetic_data(seed=seed)
+    input_dim = int(np.prod(data['X_train'].shape[1:]))
+    np.random.seed(seed)
+    model = FullyConnectedNet(list(hidden_dims), input_dim=input_dim,
+                              normalization='batchnorm')
+    _time_training(model, data, num_epochs, seed, update_rule='adam',
+                   optim_config={'learning_rate': 1e-3})
+    float_model = copy.deepcopy(model)
+    float_model.params = {p: v.astype(np.float32)
+                          for p, v in model.params.items()}
+    X_calib = data['X_val'][:num_calib]
+    qmodel = quantize_model(float_model, X_calib)
+    cached = quantize_model(float_model, X_calib, cache_float_weights=True)
+
+    results = evaluate_quantization(float_model, qmodel, data['X_val'],
+                                    data['y_val'], verbose=verbose)
+    results['int8_cached_bytes'] = cached.nbytes
+    for name, m in (('float', float_model), ('int8', qmodel),
+                    ('int8_cached', cached)):
+        results[name + '_images_per_sec'] = _images_per_second(m, data['X_val'])
+    if verbose:
+        print('throughput: %.1f -> %.1f img/s (%.1f img/s with cached float32 '
+              'weights, %.2f MB)' % (
+              results['float_images_per_sec'], results['int8_images_per_sec'],
+              results['int8_cached_images_per_sec'],
+              results['int8_cached_bytes'] / 2.0**20))
+    return results
+
+
+def benchmark_pruning(hidden_dims=(1024, 1024), input_dim=3*28*28,
+                      sparsities=(0.0, 0.5, 0.8, 0.9, 0.95, 0.99),
+                      batch_size=100, seed=0, verbose=True):
+    """
+    Measure the inference latency of a FullyConnectedNet whose weight matrices
+    are magnitude pruned to each of the given sparsities, with the dense
+    float32 path and with the CSR path of SparseFCNet.
+
+    Returns a dictionary mapping each sparsity to a dictionary with the dense
+    and sparse latency of one batch in seconds and the bytes of the weights of
+    the sparse model.
+    """
+    rng = np.random.RandomState(seed)
+    X = rng.randn(batch_size, input_dim)
+    results = {}
+    for sparsity in sparsities:
+        np.random.seed(seed)
+        model = FullyConnectedNet(list(hidden_dims), input_dim=input_dim)
+        pruner = MagnitudePruner(sparsity)
+        pruner.reset(model.params, 1, 1)
+        pruner.update_masks(model.params, sparsity)
+        pruner.apply(model.params)
+        dense = SparseFCNet(model, density_threshold=0.0)
+        sparse = SparseFCNet(model, density_threshold=float('inf'))
+        results[sparsity] = {
+            'dense_time': min(_time_case(lambda: dense.loss(X))),
+            'sparse_time': min(_time_case(lambda: sparse.loss(X))),
+            'sparse_bytes': sparse.nbytes,
+        }
+        if verbose:
+            r = results[sparsity]
+            print('sparsity %.2f  dense: %.3f ms  sparse: %.3f ms  '
+                  'weights: %.2f MB' % (sparsity, 1000 * r['dense_time'],
+                                         1000 * r['sparse_time'],
+                                         r['sparse_bytes'] / 2.0**20))
+    return results
+
+
+def synthetic_digits(num=100, shift=4, ink=0.35, seed=0):
+    """
+    Generate images that resemble the digit images loaded by cv2.imread: a
+    random pattern of white pixels in a 20x20 box, shifted by up to shift
+    pixels, on a black 28x28 background, repeated over three identical
+    channels. Returns an array of shape (num, 28, 28, 3).
+    """
+    rng = np.random.RandomState(seed)
+    X = np.zeros((num, 28, 28), dtype=np.float32)
+    for i in range(num):
+        dy, dx = rng.randint(-shift, shift + 1, size=2)
+        X[i, 4 + dy:24 + dy, 4 + dx:24 + dx] = 255 * (rng.rand(20, 20) < ink)
+    return np.repeat(X[..., np.newaxis], 3, axis=3)
+
+
+# Modules that an inference-only import must not load
+_TRAINING_MODULES = ('NN.solver', 'NN.optim', 'NN.gradient_check',
+                     'NN.benchmark', 'scipy', 'future', 'past')
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import numpy
+middle = time.perf_counter()
+import %s
+end = time.perf_counter()
+print(json.dumps({'time': end - start, 'overhead': end - middle,
+                  'modules': sorted(sys.modules)}))
+"""
+
+
+def benchmark_import_time(modules=('NN', 'NN.inference', 'NN.fc_net',
+                                   'NN.solver'),
+                          budget=0.05, repeats=5, verbose=True):
+    """
+    Measure the time to import modules of the package in fresh interpreters.
+
+    Each module is imported repeats times in a new python process, right
+    after numpy, and the best time is kept. NN and NN.inference must import
+    within budget seconds on top of numpy and must not load any of
+    _TRAINING_MODULES.
+
+    Returns a dictionary mapping each module to a dictionary with the import
+    time including numpy and the time over numpy in seconds, the number of
+    package modules
+    loaded, the training modules loaded and whether the module is within
+    budget (None for modules that have no budget).
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    def measure(module):
+        best = None
+        for _ in range(repeats):
+            out = subprocess.check_output(
+                [sys.executable, '-c', _IMPORT_SCRIPT % module], env=env)
+            r = json.loads(out.decode().splitlines()[-1])
+            if best is None or r['overhead'] < best['overhead']:
+                best = r
+        return best
+
+    results = {}
+    for module in modules:
+        r = measure(module)
+        loaded = [m for m in _TRAINING_MODULES if m in r['modules']]
+        within = None
+        if module in ('NN', 'NN.inference'):
+            within = r['overhead'] <= budget and not loaded
+        results[module] = {
+            'time': r['time'],
+            'overhead': r['overhead'],
+            'package_modules': sum(m.startswith('NN.') for m in r['modules']),
+            'training_modules': loaded,
+            'within_budget': within,
+        }
+        if verbose:
+            flag = {None: '', True: '  ok', False: '  OVER BUDGET'}[within]
+            print('%-16s %7.2f ms (+%6.2f ms over numpy)  %2d modules%s' % (
+                  module, 1000 * r['time'], 1000 * results[module]['overhead'],
+                  results[module]['package_modules'], flag))
+            if loaded:
+                print('    loads training modules: %s' % ', '.join(loaded))
+    return results
+
+
+def synthetic_scene(num_digits=10, shape=(480, 640), seed=0):
+    """
+    Generate a uint8 image of shape shape + (3,) with num_digits images from
+    synthetic_digits pasted at random positions on a black background, like
+    the image searched in the training notebook.
+    """
+    rng = np.random.RandomState(seed)
+    H, W = shape
+    image = np.zeros((H, W, 3), dtype=np.uint8)
+    digits = synthetic_digits(num_digits, shift=0, seed=seed).astype(np.uint8)
+    for digit in digits:
+        y, x = rng.randint(0, H - 28), rng.randint(0, W - 28)
+        np.maximum(image[y:y + 28, x:x + 28], digit,
+                   out=image[y:y + 28, x:x + 28])
+    return image
+
+
+def benchmark_incremental_detection(num_frames=30, change_sizes=(0, 8, 28, 96),
+                                    seed=0, verbose=True):
+    """
+    Compare detect_digits on every frame against IncrementalDetector on a
+    static scene in which one square region of each frame is redrawn with
+    random pixels.
+
+    Returns a dictionary mapping each side of the changed square (in pixels)
+    to a dictionary with the mean time per frame of both methods in seconds.
+    """
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    model = FullyConnectedNet([150, 150])
+    scene = synthetic_scene(seed=seed)
+    H, W, _ = scene.shape
+
+    results = {}
+    for change in change_sizes:
+        frames = []
+        for _ in range(num_frames):
+            frame = scene.copy()
+            if change:
+                y, x = rng.randint(0, H - change), rng.randint(0, W - change)
+                frame[y:y + change, x:x + change] = rng.randint(
+                    0, 256, size=(change, change, 3))
+            frames.append(frame)
+
+        detector = IncrementalDetector(model)
+        detector.detect(scene)
+        start = time.time()
+        for frame in frames:
+            detector.detect(frame)
+        incremental = (time.time() - start) / num_frames
+        start = time.time()
+        for frame in frames:
+            detect_digits(model, frame)
+        full = (time.time() - start) / num_frames
+        results[change] = {'full_time': full, 'incremental_time': incremental}
+        if verbose:
+            print('changed %3dx%-3d  full: %.2f ms  incremental: %.2f ms' % (
+                  change, change, 1000 * full, 1000 * incremental))
+    return results
+
+
+def benchmark_sparse_input(hidden_dim=150, batch_size=100, seed=0,
+                           verbose=True):
+    """
+    Time the forward and backward pass of the first layer of a
+    FullyConnectedNet on digit-like images: dense on the three identical
+    channels, dense on collapsed channels, and sparse_affine_forward on
+    collapsed channels without dx, for augmented (shifted) digits and for
+    centered digits with an always-black border.
+
+    Returns a dictionary mapping (images, method) to the time of one forward
+    and backward pass in seconds.
+    """
+    rng = np.random.RandomState(seed)
+    results = {}
+    for images, shift in [('shifted', 4), ('centered', 0)]:
+        X3 = synthetic_digits(batch_size, shift=shift, seed=seed)
+        X1, _ = collapse_identical_channels(X3)
+        dout = rng.randn(batch_size, hidden_dim).astype(np.float32)
+        W3 = rng.randn(X3[0].size, hidden_dim).astype(np.float32)
+        W1 = W3[::3].copy()
+        b = np.zeros(hidden_dim, dtype=np.float32)
+
+        def dense(X, W):
+            _, cache = affine_relu_forward(X, W, b)
+            return affine_relu_backward(dout, cache)
+
+        def sparse():
+            _, cache = sparse_affine_relu_forward(X1, W1, b)
+            return sparse_affine_relu_backward(dout, cache, compute_dx=False)
+
+        results[images, 'dense_3_channels'] = min(_time_case(
+            lambda: dense(X3, W3)))
+        results[images, 'dense_1_channel'] = min(_time_case(
+            lambda: dense(X1, W1)))
+        results[images, 'sparse_1_channel'] = min(_time_case(sparse))
+        if verbose:
+            print('%-8s density %.2f  ' % (images, np.mean(X1 != 0)) +
+                  '  '.join('%s: %.3f ms' % (method, 1000 * results[images,
+                                                                   method])
+                            for method in ('dense_3_channels',
+                                           'dense_1_channel',
+                                           'sparse_1_channel')))
+    return results
+
+
+def benchmark_activation_memory(hidden_dims=(1024, 1024, 1024), batch_size=512,
+                                input_dim=3*28*28, dropout=0.5, seed=0,
+                                verbose=True, **model_kwargs):
+    """
+    Measure the peak memory and time of one training step of a
+    FullyConnectedNet, which is dominated by the forward caches kept for the
+    backward pass.
+
+    Returns a dictionary with the peak bytes allocated during model.loss, the
+    bytes held in the forward caches and the time of the step in seconds.
+    """
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    model = FullyConnectedNet(list(hidden_dims), input_dim=input_dim,
+                              dropout=dropout, seed=seed, **model_kwargs)
+    X = rng.randn(batch_size, input_dim)
+    y = rng.randint(10, size=batch_size)
+
+    start = time.time()
+    _, peak = _peak_memory(model.loss, X, y)
+    elapsed = time.time() - start
+
+    results = {
+        'peak_bytes': peak,
+        'cache_bytes': _nbytes(model.cache),
+        'step_time': elapsed,
+    }
+    if verbose:
+        print('peak: %.1f MB  caches: %.1f MB  step: %.2f ms' % (
+              results['peak_bytes'] / 2.0**20, results['cache_bytes'] / 2.0**20,
+              1000 * results['step_time']))
+    return results
+
+
+def benchmark_checkpointing(depth=16, width=256, batch_size=4096,
+                            checkpoint_every=(None, 2, 4), seed=0,
+                            verbose=True):
+    """
+    Show the memory/time trade-off of activation recomputation for a deep,
+    narrow FullyConnectedNet trained on a large batch.
+
+    Returns a dictionary mapping each value of checkpoint_every to the result
+    of benchmark_activation_memory for that setting.
+    """
+    results = {}
+    for k in checkpoint_every:
+        results[k] = benchmark_activation_memory(
+            hidden_dims=[width] * depth, input_dim=width,
+            batch_size=batch_size, dropout=0.5,
+            seed=seed, verbose=False, normalization='batchnorm',
+            checkpoint_every=k)
+        if verbose:
+            r = results[k]
+            print('checkpoint_every=%-4s peak: %.1f MB  step: %.2f ms' % (
+                  k, r['peak_bytes'] / 2.0**20, 1000 * r['step_time']))
+    return results
+
+
+def benchmark_gradient_accumulation(data=None, hidden_dims=(256, 256),
+                                    batch_size=2000,
+                                    micro_batch_sizes=(None, 500, 100),
+                                    seed=0, verbose=True):
+    """
+    Measure the peak memory and time of one Solver step with a large batch,
+    computed in one pass or accumulated over micro-batches.
+
+    Returns a dictionary mapping each micro-batch size to a dictionary with
+    the peak bytes allocated during the step and its time in seconds.
+    """
+    if data is None:
+        data = synthetic_data(num_train=batch_size)
+    results = {}
+    for micro_batch_size in micro_batch_sizes:
+        np.random.seed(seed)
+        model = FullyConnectedNet(list(hidden_dims), normalization='batchnorm')
+        solver = Solver(model, data, update_rule='adam', batch_size=batch_size,
+                        micro_batch_size=micro_batch_size, verbose=False)
+        start = time.time()
+        _, peak = _peak_memory(solver._step)
+        results[micro_batch_size] = {
+            'peak_bytes': peak,
+            'step_time': time.time() - start,
+        }
+        if verbose:
+            r = results[micro_batch_size]
+            print('micro_batch_size=%-5s peak: %.1f MB  step: %.2f ms' % (
+                  micro_batch_size, r['peak_bytes'] / 2.0**20,
+                  1000 * r['step_time']))
+    return results
+
+
+
+def _time_case(fn, repeats=5, min_time=0.02):
+    """
+    Time fn() like timeit: calibrate the number of calls per repeat so that a
+    repeat takes at least min_time seconds, then return the per-call time of
+    every repeat.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 2**20:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    times = [elapsed / number]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def _forward_backward_cases(name, forward, backward, *args):
+    """
+    Build the forward and backward cases of a layer: the backward case reuses a
+    cache from one forward call made at setup time. If the forward pass is a
+    stub that returns None, both cases return None and are skipped.
+    """
+    out, cache = forward(*args)
+    dout = None
+    if out is not None:
+        dout = np.random.randn(*out.shape).astype(out.dtype)
+    return [
+        (name + '_forward', lambda: forward(*args)),
+        (name + '_backward', lambda: backward(dout, cache)),
+    ]
+
+
+def layer_cases(quick=False):
+    """
+    Benchmark cases for every implemented function of layers.py, fast_layers.py
+    and layer_utils.py. Stubs that are not implemented yet are skipped.
+    """
+    rng = np.random.RandomState(0)
+    N, D, M = (64, 784, 150) if quick else (256, 2352, 500)
+    x = rng.randn(N, D)
+    w = rng.randn(D, M) * 1e-2
+    b = np.zeros(M)
+    h = rng.randn(N, M)
+    gamma, beta = np.ones(M), np.zeros(M)
+    scores = rng.randn(N, 10)
+    teacher_scores = rng.randn(N, 10)
+    y = rng.randint(10, size=N)
+
+    images = rng.randn(8 if quick else 32, 3, 28, 28)
+    conv_w = rng.randn(16, 3, 3, 3) * 1e-2
+    conv_b = np.zeros(16)
+    conv_param = {'stride': 1, 'pad': 1}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    small_images = images[:2, :, :14, :14]
+
+    cases = []
+    cases += _forward_backward_cases('affine', affine_forward, affine_backward,
+                                     x, w, b)
+    cases += _forward_backward_cases('relu', relu_forward, relu_backward, h)
+
+    # Rank M // 8 factorization of w
+    u = rng.randn(D, M // 8) * 1e-2
+    v = rng.randn(M // 8, M) * 1e-2
+    cases += _forward_backward_cases('lowrank_affine', lowrank_affine_forward,
+                                     lowrank_affine_backward, x, u, v, b)
+    cases += _forward_backward_cases('lowrank_affine_relu',
+                                     lowrank_affine_relu_forward,
+                                     lowrank_affine_relu_backward, x, u, v, b)
+
+    # Mostly-zero inputs for the 'csr' and 'compact' paths of the sparse
+    # affine layer: 3% nonzero entries, and a border of input features that
+    # are zero in every example, as in digit images
+    x_csr = x * (rng.rand(N, D) < 0.03)
+    x_compact = x.copy()
+    x_compact[:, :D // 2] = 0
+    cases += _forward_backward_cases('sparse_affine_csr', sparse_affine_forward,
+                                     sparse_affine_backward, x_csr, w, b)
+    cases += _forward_backward_cases('sparse_affine_compact',
+                                     sparse_affine_forward,
+                                     sparse_affine_backward, x_compact, w, b)
+    cases += _forward_backward_cases('sparse_affine_relu',
+                                     sparse_affine_relu_forward,
+                                     sparse_affine_relu_backward, x_compact,
+                                     w, b)
+    cases += _forward_backward_cases('batchnorm', batchnorm_forward,
+                                     batchnorm_backward, h, gamma, beta,
+                                     {'mode': 'train'})
+    _, bn_cache = batchnorm_forward(h, gamma, beta, {'mode': 'train'})
+    cases.append(('batchnorm_backward_alt',
+                  lambda: batchnorm_backward_alt(h, bn_cache)))
+    cases += _forward_backward_cases('layernorm', layernorm_forward,
+                                     layernorm_backward, h, gamma, beta, {})
+    cases += _forward_backward_cases('dropout', dropout_forward,
+                                     dropout_backward, h,
+                                     {'mode': 'train', 'p': 0.5})
+    cases += _forward_backward_cases('affine_relu', affine_relu_forward,
+                                     affine_relu_backward, x, w, b)
+    cases += _forward_backward_cases('spatial_batchnorm',
+                                     spatial_batchnorm_forward,
+                                     spatial_batchnorm_backward, images,
+                                     np.ones(3), np.zeros(3), {'mode': 'train'})
+    cases += _forward_backward_cases('spatial_groupnorm',
+                                     spatial_groupnorm_forward,
+                                     spatial_groupnorm_backward, images,
+                                     np.ones(3), np.zeros(3), 3, {})
+    cases += _forward_backward_cases('conv_naive', conv_forward_naive,
+                                     conv_backward_naive, small_images,
+                                     conv_w, conv_b, conv_param)
+    cases += _forward_backward_cases('conv_fast', conv_forward_fast,
+                                     conv_backward_fast, images, conv_w, conv_b,
+                                     conv_param)
+    cases += _forward_backward_cases('max_pool_naive', max_pool_forward_naive,
+                                     max_pool_backward_naive, small_images,
+                                     pool_param)
+    cases += _forward_backward_cases('max_pool_fast', max_pool_forward_fast,
+                                     max_pool_backward_fast, images, pool_param)
+    cases += [
+        ('svm_loss', lambda: svm_loss(scores, y)),
+        ('softmax_loss', lambda: softmax_loss(scores, y)),
+        ('softmax_loss_topk', lambda: softmax_loss_topk(scores, y, k=3)),
+        ('distillation_loss',
+         lambda: distillation_loss(scores, y, teacher_scores)),
+    ]
+    return cases
+
+
+def model_cases(quick=False):
+    """
+    Benchmark cases for full FullyConnectedNet training steps at several widths
+    and batch sizes, and for float and int8 inference.
+    """
+    rng = np.random.RandomState(0)
+    widths = (100, 500) if quick else (100, 500, 1000)
+    batch_sizes = (50,) if quick else (50, 200, 1000)
+    cases = []
+    for width in widths:
+        for batch_size in batch_sizes:
+            np.random.seed(0)
+            model = FullyConnectedNet([width, width],
+                                      normalization='batchnorm', dropout=0.5)
+            X = rng.randn(batch_size, 3 * 28 * 28)
+            y = rng.randint(10, size=batch_size)
+            name = 'fc_net_loss_w%d_n%d' % (width, batch_size)
+            cases.append((name, lambda m=model, X=X, y=y: m.loss(X, y)))
+
+    # Float and int8 inference of the same network
+    np.random.seed(0)
+    model = FullyConnectedNet([150, 150])
+    X = rng.randn(200, 3 * 28 * 28)
+    qmodel = quantize_model(model, X)
+    cached = quantize_model(model, X, cache_float_weights=True)
+    cases.append(('fc_net_predict_float', lambda: model.loss(X)))
+    cases.append(('fc_net_predict_int8', lambda: qmodel.loss(X)))
+    cases.append(('fc_net_predict_int8_cached', lambda: cached.loss(X)))
+    return cases
+
+
+def optim_cases(quick=False):
+    """
+    Benchmark cases for every update rule of optim.py on a weight matrix the
+    size of W1. Update rules that are not implemented yet are skipped.
+    """
+    rng = np.random.RandomState(0)
+    shape = (784, 150) if quick else (2352, 500)
+    cases = []
+    for name in ('sgd', 'sgd_momentum', 'rmsprop', 'adam'):
+        rule = getattr(optim, name)
+        w = rng.randn(*shape)
+        dw = rng.randn(*shape)
+        config = {'learning_rate': 1e-6}
+
+        def step(rule=rule, w=w, dw=dw, config=config):
+            return rule(w, dw, config)
+        cases.append(('optim_' + name, step))
+    return cases
+
+
+def solver_cases(quick=False):
+    """
+    Benchmark case for end-to-end Solver.train iterations, including the
+    accuracy checks at epoch boundaries.
+    """
+    data = synthetic_data(num_train=500 if quick else 2000, num_val=200)
+
+    def train():
+        np.random.seed(0)
+        model = FullyConnectedNet([150, 150], normalization='batchnorm')
+        solver = Solver(model, data, update_rule='adam', num_epochs=1,
+                        batch_size=100, verbose=False)
+        solver.train()
+        return solver
+    return [('solver_train_epoch', train)]
+
+
+def machine_info():
+    """
+    Description of the machine and software versions the suite ran on.
+    """
+    info = {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'available_cores': available_cores(),
+        'blas_threads': get_blas_threads(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'node': platform.node(),
+    }
+    try:
+        config = np.show_config(mode='dicts')
+        info['blas'] = config['Build Dependencies']['blas'].get('name')
+    except Exception:
+        info['blas'] = None
+    return info
+
+
+def run_suite(quick=False, pattern=None, verbose=True):
+    """
+    Run every benchmark case whose name contains pattern.
+
+    Returns a dictionary with the machine information and, for every case, the
+    minimum and median time per call in seconds. Cases whose function returns
+    None (unimplemented stubs) are recorded as skipped.
+    """
+    cases = (layer_cases(quick) + model_cases(quick) + optim_cases(quick) +
+             solver_cases(quick))
+    results = {}
+    for name, fn in cases:
+        if pattern is not None and pattern not in name:
+            continue
+        result = fn()
+        if result is None or (isinstance(result, tuple) and result[0] is None):
+            results[name] = {'skipped': 'not implemented'}
+            if verbose:
+                print('%-32s skipped (not implemented)' % name)
+            continue
+        times = _time_case(fn, repeats=3 if quick else 5)
+        results[name] = {'min': min(times), 'median': float(np.median(times))}
+        if verbose:
+            print('%-32s %12.6f ms' % (name, 1000 * results[name]['min']))
+    return {'machine': machine_info(), 'quick': quick, 'time': time.time(),
+            'results': results}
+
+
+def compare(results, baseline, tolerance=0.25, verbose=True):
+    """
+    Compare the results of run_suite against a baseline from an earlier run.
+
+    Returns a list of (name, baseline_time, time) for every case whose minimum
+    time grew by more than the fraction tolerance.
+    """
+    regressions = []
+    for name, r in results['results'].items():
+        b = baseline['results'].get(name)
+        if b is None or 'min' not in b or 'min' not in r:
+            continue
+        ratio = r['min'] / b['min']
+        if verbose:
+            flag = '  REGRESSION' if ratio > 1 + tolerance else ''
+            print('%-32s %8.2fx%s' % (name, ratio, flag))
+        if ratio > 1 + tolerance:
+            regressions.append((name, b['min'], r['min']))
+    if baseline.get('machine', {}).get('node') != results['machine']['node']:
+        print('warning: baseline was recorded on a different machine')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--save-baseline',
+                        help='write the results as a new baseline here')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--quick', action='store_true',
+                        help='use smaller problem sizes')
+    parser.add_argument('--filter', help='only run cases containing this')
+    args = parser.parse_args(argv)
+
+    results = run_suite(quick=args.quick, pattern=args.filter)
+    for filename in (args.out, args.save_baseline):
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        if regressions:
+            print('%d regression(s)' % len(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
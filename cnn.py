@@ -0,0 +1,58 @@
+import numpy as np
+
+from NN.sequential import (Affine, AffineReLU, ChannelsFirst, Conv, MaxPool,
+                           ReLU, Sequential, SpatialBatchNorm)
+
+
+class ConvNet(Sequential):
+    """
+    A convolutional network with an arbitrary number of conv blocks followed by
+    a fully-connected head:
+
+    {conv - [spatial batchnorm] - relu - 2x2 max pool} x M - affine - relu - affine - softmax
+
+    Every conv layer uses "same" padding, so each block halves the spatial size.
+    The conv and pool layers use the im2col and reshape kernels from
+    fast_layers.py.
+
+    The network operates on minibatches of data that have shape (N, C, H, W),
+    or (N, H, W, C) when channels_last is True, as for images loaded with
+    cv2.imread. Like all Sequential models it conforms to the Solver API.
+    """
+
+    def __init__(self, input_dim=(3, 28, 28), num_filters=(16, 32),
+                 filter_size=3, hidden_dim=100, num_classes=10,
+                 normalization='batchnorm', channels_last=True,
+                 weight_scale=1e-2, reg=0.0, dtype=np.float32):
+        """
+        Initialize a new network.
+
+        Inputs:
+        - input_dim: Tuple (C, H, W) giving size of input data
+        - num_filters: Number of filters of the conv layer in each block
+        - filter_size: Width/height of filters to use in the convolutional layers
+        - hidden_dim: Number of units to use in the fully-connected hidden layer
+        - num_classes: Number of scores to produce from the final affine layer.
+        - normalization: "batchnorm" to use spatial batch normalization after each
+          conv layer, or None.
+        - channels_last: If True, the inputs have shape (N, H, W, C).
+        - weight_scale: Scalar giving standard deviation for random initialization
+          of weights.
+        - reg: Scalar giving L2 regularization strength
+        - dtype: numpy datatype to use for computation.
+        """
+        C, H, W = input_dim
+        layers = []
+        if channels_last:
+            layers.append(ChannelsFirst())
+        for F in num_filters:
+            layers.append(Conv(C, F, filter_size, weight_scale=weight_scale))
+            if normalization == 'batchnorm':
+                layers.append(SpatialBatchNorm(F))
+            layers.append(ReLU())
+            layers.append(MaxPool(2))
+            C, H, W = F, H // 2, W // 2
+        layers.append(AffineReLU(C * H * W, hidden_dim, weight_scale=weight_scale))
+        layers.append(Affine(hidden_dim, num_classes, weight_scale=weight_scale))
+
+        super(ConvNet, self).__init__(layers, reg=reg, dtype=dtype)
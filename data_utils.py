@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+"""
+This file contains helpers for loading the digit images used to train the
+models.
+
+The images are read with cv2.imread, which returns three identical BGR
+channels for grayscale files. load_images collapses such channels to one at
+load time, which divides the input dimension, and the cost of the first affine
+layer, by three. Models trained on collapsed images expect collapsed images at
+inference time too, so the same helper should be used for every split.
+"""
+
+
+def collapse_identical_channels(X):
+    """
+    Keep only the first channel of images whose channels are all identical.
+
+    Inputs:
+    - X: Array of images of shape (N, H, W, C)
+
+    Returns a tuple of:
+    - X: The images, of shape (N, H, W, 1) if the channels were identical in
+      every image, otherwise the input unchanged.
+    - collapsed: Boolean; True if the channels were collapsed.
+    """
+    for c in range(1, X.shape[-1]):
+        if not np.array_equal(X[..., 0], X[..., c]):
+            return X, False
+    return X[..., :1].copy(), True
+
+
+def load_images(directory, num_classes=10, collapse_channels=True):
+    """
+    Load labelled images stored as directory/<label>/<file>, as in the
+    training notebook.
+
+    Inputs:
+    - directory: Directory with one subdirectory per label 0, ...,
+      num_classes - 1.
+    - num_classes: Number of labels.
+    - collapse_channels: If True, apply collapse_identical_channels.
+
+    Returns a tuple of:
+    - X: Array of images of shape (N, H, W, C)
+    - y: Array of labels of shape (N,)
+    """
+    import cv2
+
+    X, y = [], []
+    for label in range(num_classes):
+        label_dir = os.path.join(directory, str(label))
+        for filename in sorted(os.listdir(label_dir)):
+            X.append(cv2.imread(os.path.join(label_dir, filename)))
+            y.append(label)
+    X = np.array(X)
+    y = np.array(y)
+    if collapse_channels:
+        X, _ = collapse_identical_channels(X)
+    return X, y
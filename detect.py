@@ -0,0 +1,498 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+"""
+This file implements the sliding-window digit search of the training notebook
+and a prediction cache for inference.
+
+detect_digits slides a size x size window over an image with a stride, keeps
+the windows that are bright enough and whose borders are blank (the first and
+last boundary rows and columns are equal, so a whole digit lies inside),
+classifies them, and returns one detection per group of windows that contain
+the same digit.
+
+Many candidate windows are pixel-identical: blank background, repeated
+borders, the same digit seen through overlapping windows. A PredictionCache
+stores the scores of windows keyed by a hash of their bytes and a version of
+the model, so repeated windows skip the forward pass:
+
+cache = PredictionCache(max_size=100000)
+detections = detect_digits(model, image, cache=cache)
+print(cache.hits, cache.misses)
+
+For successive frames of a mostly static view, an IncrementalDetector only
+re-classifies the windows that intersect tiles that changed since the previous
+frame:
+
+detector = IncrementalDetector(model, tile=16)
+for frame in frames:
+    detections = detector.detect(frame)
+"""
+
+
+def model_fingerprint(model):
+    """
+    Hash of the parameters and batch normalization statistics of a model,
+    usable as the model version of a PredictionCache.
+    """
+    import hashlib
+
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(model.params):
+        h.update(name.encode())
+        h.update(np.ascontiguousarray(model.params[name]).tobytes())
+    for bn_param in getattr(model, 'bn_params', []):
+        for name in ('running_mean', 'running_var'):
+            if name in bn_param:
+                h.update(np.ascontiguousarray(bn_param[name]).tobytes())
+    return h.hexdigest()
+
+
+def inference_batch_size(model):
+    """
+    Inference batch size tuned for model on this machine (see autotune), or
+    256 if it has not been tuned. This reads the tuning profile, so callers
+    that predict repeatedly resolve it once and pass it on.
+    """
+    from NN.autotune import tuned_batch_size
+    return tuned_batch_size(model, 'inference', 256)
+
+
+def predict_in_batches(model, X, batch_size=None):
+    """
+    Test-time scores of model on X, computed in batches of batch_size; None
+    uses inference_batch_size(model).
+    """
+    if batch_size is None:
+        batch_size = inference_batch_size(model)
+    if X.shape[0] == 0:
+        return model.loss(X)
+    return np.concatenate([model.loss(X[i:i + batch_size])
+                           for i in range(0, X.shape[0], batch_size)])
+
+
+class PredictionCache(object):
+    """
+    LRU cache of model scores keyed by the bytes of each input and a model
+    version.
+
+    The attributes hits, misses and evictions count lookups that found an
+    entry, lookups that needed a forward pass and entries dropped because the
+    cache was full. Inputs repeated within one call count as hits after the
+    first.
+    """
+
+    def __init__(self, max_size=100000, batch_size=None):
+        """
+        Inputs:
+        - max_size: Maximum number of cached score vectors.
+        - batch_size: Batch size of the forward passes; None uses the
+          inference_batch_size of each model, resolved on its first call.
+        """
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self._batch_sizes = {}
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        self._entries.clear()
+
+    @staticmethod
+    def key(x, model_version):
+        """
+        Cache key of one input x, e.g. a uint8 window.
+        """
+        # hashlib loads OpenSSL, which takes longer than the rest of
+        # NN.inference together, so it is only imported once it is needed
+        import hashlib
+
+        digest = hashlib.blake2b(np.ascontiguousarray(x).tobytes(),
+                                 digest_size=16).digest()
+        return (model_version, x.shape, x.dtype.str, digest)
+
+    def get(self, key):
+        scores = self._entries.get(key)
+        if scores is not None:
+            self._entries.move_to_end(key)
+        return scores
+
+    def put(self, key, scores):
+        self._entries[key] = scores
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def predict(self, model, X, model_version=None, batch_size=None):
+        """
+        Test-time scores of model on X, running the model only on the inputs
+        that are not cached.
+
+        Inputs:
+        - model: A model with the test-time model.loss(X) API.
+        - X: Array of inputs of shape (N, d_1, ..., d_k)
+        - model_version: Any hashable identifying the current parameters of
+          the model. If None, model_fingerprint(model) is computed, which
+          hashes all parameters; pass a version to avoid that cost.
+        - batch_size: Batch size of the forward passes; None uses the batch
+          size given to the constructor.
+
+        Returns:
+        - scores: Array of shape (N, C)
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        if batch_size is None:
+            if id(model) not in self._batch_sizes:
+                self._batch_sizes[id(model)] = inference_batch_size(model)
+            batch_size = self._batch_sizes[id(model)]
+        if model_version is None:
+            model_version = model_fingerprint(model)
+        N = X.shape[0]
+        if N == 0:
+            return predict_in_batches(model, X[:0], batch_size)
+        scores = [None] * N
+        missing = OrderedDict()
+        for i in range(N):
+            key = self.key(X[i], model_version)
+            cached = self.get(key)
+            if cached is not None:
+                scores[i] = cached
+                self.hits += 1
+            elif key in missing:
+                missing[key].append(i)
+                self.hits += 1
+            else:
+                missing[key] = [i]
+                self.misses += 1
+
+        if missing:
+            first = [indices[0] for indices in missing.values()]
+            new_scores = predict_in_batches(model, X[first], batch_size)
+            for (key, indices), s in zip(missing.items(), new_scores):
+                self.put(key, s)
+                for i in indices:
+                    scores[i] = s
+        return np.stack(scores)
+
+
+def window_view(image, size=28, stride=2):
+    """
+    Read-only view of all size x size windows of image at the given stride.
+
+    Inputs:
+    - image: Array of shape (H, W, C)
+
+    Returns:
+    - windows: Array of shape (H_out, W_out, size, size, C) where
+      windows[j, i] is image[j * stride:j * stride + size,
+      i * stride:i * stride + size].
+    """
+    H, W, C = image.shape
+    H_out = (H - size) // stride + 1
+    W_out = (W - size) // stride + 1
+    sH, sW, sC = image.strides
+    return as_strided(image, shape=(H_out, W_out, size, size, C),
+                      strides=(sH * stride, sW * stride, sH, sW, sC),
+                      writeable=False)
+
+
+def window_sums(image, size=28, stride=2):
+    """
+    Pixel sums of all windows of window_view(image, size, stride), of shape
+    (H_out, W_out), computed from a summed-area table of the image in
+    O(H * W) instead of summing every window.
+    """
+    H, W, C = image.shape
+    H_out = (H - size) // stride + 1
+    W_out = (W - size) // stride + 1
+    table = np.zeros((H + 1, W + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(image.sum(axis=2, dtype=np.int64), axis=0), axis=1,
+              out=table[1:, 1:])
+    top = slice(0, (H_out - 1) * stride + 1, stride)
+    bottom = slice(size, size + (H_out - 1) * stride + 1, stride)
+    left = slice(0, (W_out - 1) * stride + 1, stride)
+    right = slice(size, size + (W_out - 1) * stride + 1, stride)
+    return (table[bottom, right] - table[top, right] - table[bottom, left] +
+            table[top, left])
+
+
+def candidate_mask(image, size=28, stride=2, min_mean=10, boundary=3):
+    """
+    Boolean array of shape (H_out, W_out) marking the windows of
+    window_view(image, size, stride) that may hold a whole digit: their mean
+    pixel value is above min_mean and their first and last boundary rows, and
+    first and last boundary columns, are equal.
+    """
+    C = image.shape[2]
+    mask = window_sums(image, size, stride) > min_mean * size * size * C
+    j, i = np.nonzero(mask)
+    if j.size:
+        w = window_view(image, size, stride)[j, i]
+        b = boundary
+        rows = np.all(w[:, :b] == w[:, -b:], axis=(1, 2, 3))
+        columns = np.all(w[:, :, :b] == w[:, :, -b:], axis=(1, 2, 3))
+        mask[j, i] = rows & columns
+    return mask
+
+
+def group_detections(coords, sums, scores, size=28):
+    """
+    Turn classified candidate windows into one detection per digit.
+
+    Windows containing the same digit surrounded by blank background have the
+    same pixel sum, so candidates are grouped by sum. Each group votes for its
+    most frequent class, and the window of that class with the highest score
+    gives the location.
+
+    Inputs:
+    - coords: Array of shape (K, 2) of the (x, y) top-left corners
+    - sums: Array of shape (K,) of the pixel sums of the windows
+    - scores: Array of shape (K, C) of classification scores
+
+    Returns:
+    - detections: int array of shape (G, 3) of (label, x, y) rows, where
+      (x, y) is the center of the window, sorted by label.
+    """
+    if len(sums) == 0:
+        return np.zeros((0, 3), dtype=int)
+    labels = np.argmax(scores, axis=1)
+    detections = []
+    for s in np.unique(sums):
+        members = np.flatnonzero(sums == s)
+        label = np.argmax(np.bincount(labels[members]))
+        voters = members[labels[members] == label]
+        best = voters[np.argmax(scores[voters, label])]
+        x, y = coords[best] + size // 2 - 1
+        detections.append((label, x, y))
+    detections = np.array(detections, dtype=int)
+    return detections[np.argsort(detections[:, 0], kind='stable')]
+
+
+def detect_digits(model, image, size=28, stride=2, min_mean=10, boundary=3,
+                  cache=None, model_version=None, batch_size=None):
+    """
+    Find the digits in an image with a sliding window.
+
+    Inputs:
+    - model: A classifier with the test-time model.loss(X) API, trained on
+      size x size images with the channels of image.
+    - image: Array of shape (H, W, C), e.g. loaded with cv2.imread.
+    - size, stride: Window size and stride in pixels.
+    - min_mean, boundary: Candidate filter, see candidate_mask.
+    - cache: Optional PredictionCache for the window scores.
+    - model_version: Model version for the cache, see PredictionCache.predict.
+    - batch_size: Batch size of the forward passes; see predict_in_batches.
+
+    Returns:
+    - detections: int array of shape (G, 3) of (label, x, y) rows, see
+      group_detections.
+    """
+    j, i = np.nonzero(candidate_mask(image, size, stride, min_mean, boundary))
+    if j.size == 0:
+        return np.zeros((0, 3), dtype=int)
+    X = window_view(image, size, stride)[j, i]
+    if batch_size is None and (cache is None or cache.batch_size is None):
+        batch_size = inference_batch_size(model)
+    if cache is not None:
+        scores = cache.predict(model, X, model_version, batch_size)
+    else:
+        scores = predict_in_batches(model, X, batch_size)
+    coords = np.stack([i * stride, j * stride], axis=1)
+    sums = X.reshape(X.shape[0], -1).sum(axis=1, dtype=np.int64)
+    return group_detections(coords, sums, scores, size)
+
+
+def changed_tiles(previous, frame, tile=16):
+    """
+    Boolean array of shape (ceil(H / tile), ceil(W / tile)) marking the
+    tile x tile blocks in which frame differs from previous.
+    """
+    H, W, C = frame.shape
+    # Maximum over the bytes of each block with reduceat, which is several
+    # times faster than any() over the axes of a reshaped array and handles
+    # partial tiles at the borders
+    changed = np.not_equal(previous, frame).view(np.uint8).reshape(H, W * C)
+    changed = np.maximum.reduceat(changed, np.arange(0, W * C, tile * C),
+                                  axis=1)
+    changed = np.maximum.reduceat(changed, np.arange(0, H, tile), axis=0)
+    return changed.astype(bool)
+
+
+class IncrementalDetector(object):
+    """
+    Sliding-window digit search over successive frames of a mostly static
+    view.
+
+    The candidate mask, pixel sums and scores of every window position are
+    kept between frames. For a new frame, only the windows that intersect a
+    tile that changed since the previous frame are filtered and classified
+    again, so the cost of a frame grows with the amount of change rather than
+    the image size. When more than full_scan_fraction of the windows are
+    affected, or the frame size changes, the whole frame is scanned as in
+    detect_digits.
+
+    After every call to detect, last_stats holds the number of changed tiles,
+    of windows checked again and of windows classified, and whether a full
+    scan was done.
+    """
+
+    def __init__(self, model, size=28, stride=2, tile=16, min_mean=10,
+                 boundary=3, cache=None, model_version=None, batch_size=None,
+                 full_scan_fraction=0.25):
+        """
+        Inputs: Same as detect_digits, plus:
+        - tile: Size in pixels of the square tiles compared between frames.
+        - full_scan_fraction: Fraction of affected windows above which the
+          whole frame is scanned.
+        """
+        self.model = model
+        self.size = size
+        self.stride = stride
+        self.tile = tile
+        self.min_mean = min_mean
+        self.boundary = boundary
+        self.cache = cache
+        self.model_version = model_version
+        if batch_size is None and (cache is None or cache.batch_size is None):
+            batch_size = inference_batch_size(model)
+        self.batch_size = batch_size
+        self.full_scan_fraction = full_scan_fraction
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the previous frame; the next frame is scanned in full.
+        """
+        self.frame = None
+        self.candidates = None
+        self.sums = None
+        self.scores = None
+        self.last_stats = {}
+
+    def _classify(self, X):
+        if self.cache is not None:
+            return self.cache.predict(self.model, X, self.model_version,
+                                      self.batch_size)
+        return predict_in_batches(self.model, X, self.batch_size)
+
+    def _affected_windows(self, tiles):
+        """
+        Boolean array of shape (H_out, W_out) marking the windows that
+        intersect a changed tile.
+        """
+        H_out, W_out = self.candidates.shape
+        if not tiles.any():
+            return np.zeros((H_out, W_out), dtype=bool)
+        TH, TW = tiles.shape
+        table = np.zeros((TH + 1, TW + 1), dtype=np.int64)
+        np.cumsum(np.cumsum(tiles, axis=0), axis=1, out=table[1:, 1:])
+        # Range of tiles covered by each window row and column, inclusive
+        starts = np.arange(H_out) * self.stride
+        r0 = (starts // self.tile)[:, np.newaxis]
+        r1 = ((starts + self.size - 1) // self.tile)[:, np.newaxis] + 1
+        starts = np.arange(W_out) * self.stride
+        c0 = (starts // self.tile)[np.newaxis, :]
+        c1 = ((starts + self.size - 1) // self.tile)[np.newaxis, :] + 1
+        count = table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+        return count > 0
+
+    def _full_scan(self, frame):
+        self.sums = window_sums(frame, self.size, self.stride)
+        self.candidates = candidate_mask(frame, self.size, self.stride,
+                                         self.min_mean, self.boundary)
+        j, i = np.nonzero(self.candidates)
+        self.scores = None
+        if j.size:
+            scores = self._classify(window_view(frame, self.size,
+                                                self.stride)[j, i])
+            self.scores = np.zeros(self.candidates.shape + scores.shape[1:],
+                                   dtype=scores.dtype)
+            self.scores[j, i] = scores
+        return self.candidates.size, j.size
+
+    def _partial_scan(self, frame, affected):
+        j, i = np.nonzero(affected)
+        if j.size == 0:
+            return 0, 0
+        # Window sums from a summed-area table of the bounding box of the
+        # affected windows only
+        j0, j1, i0, i1 = j.min(), j.max() + 1, i.min(), i.max() + 1
+        s = self.stride
+        box = frame[j0 * s:(j1 - 1) * s + self.size,
+                    i0 * s:(i1 - 1) * s + self.size]
+        sums = window_sums(box, self.size, s)[j - j0, i - i0]
+        self.sums[j, i] = sums
+
+        # Candidate filter of detect_digits on the affected windows only;
+        # only the bright windows are gathered
+        C = frame.shape[2]
+        min_sum = self.min_mean * self.size * self.size * C
+        bright = np.flatnonzero(sums > min_sum)
+        view = window_view(frame, self.size, s)
+        w = view[j[bright], i[bright]]
+        b = self.boundary
+        same = (np.all(w[:, :b] == w[:, -b:], axis=(1, 2, 3)) &
+                np.all(w[:, :, :b] == w[:, :, -b:], axis=(1, 2, 3)))
+        keep = np.zeros(j.size, dtype=bool)
+        keep[bright[same]] = True
+        self.candidates[j, i] = keep
+
+        if keep.any():
+            scores = self._classify(w[same])
+            if self.scores is None:
+                self.scores = np.zeros(self.candidates.shape +
+                                       scores.shape[1:], dtype=scores.dtype)
+            self.scores[j[keep], i[keep]] = scores
+        return j.size, int(keep.sum())
+
+    def detect(self, frame):
+        """
+        Find the digits in the next frame.
+
+        Inputs:
+        - frame: Array of shape (H, W, C)
+
+        Returns:
+        - detections: int array of shape (G, 3) of (label, x, y) rows, see
+          group_detections.
+        """
+        frame = np.ascontiguousarray(frame)
+        num_tiles = None
+        affected = None
+        if self.frame is not None and frame.shape == self.frame.shape:
+            tiles = changed_tiles(self.frame, frame, self.tile)
+            num_tiles = int(tiles.sum())
+            affected = self._affected_windows(tiles)
+        self.frame = frame.copy()
+
+        full = bool(affected is None or
+                    affected.mean() > self.full_scan_fraction)
+        if full:
+            checked, classified = self._full_scan(frame)
+        else:
+            checked, classified = self._partial_scan(frame, affected)
+        self.last_stats = {'changed_tiles': num_tiles, 'full_scan': full,
+                           'windows_checked': checked,
+                           'windows_classified': classified}
+
+        j, i = np.nonzero(self.candidates)
+        if j.size == 0:
+            return np.zeros((0, 3), dtype=int)
+        coords = np.stack([i * self.stride, j * self.stride], axis=1)
+        return group_detections(coords, self.sums[j, i], self.scores[j, i],
+                                self.size)
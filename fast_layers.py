@@ -0,0 +1,117 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from NN.layers import max_pool_forward_naive, max_pool_backward_naive
+
+
+def conv_forward_fast(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer based
+    on im2col: every receptive field of the padded input is copied into a
+    column of a matrix, turning the convolution into a single matrix multiply.
+
+    Inputs / outputs: Same as conv_forward_naive, except that the cache is
+    (x, w, b, conv_param, x_cols).
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+    assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+    H_out = (H + 2 * pad - HH) // stride + 1
+    W_out = (W + 2 * pad - WW) // stride + 1
+
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                      mode='constant')
+    sN, sC, sH, sW = x_padded.strides
+    windows = as_strided(x_padded,
+                         shape=(C, HH, WW, N, H_out, W_out),
+                         strides=(sC, sH, sW, sN, sH * stride, sW * stride))
+    x_cols = np.ascontiguousarray(windows).reshape(C * HH * WW, -1)
+
+    out = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+    out = out.reshape(F, N, H_out, W_out).transpose(1, 0, 2, 3)
+    out = np.ascontiguousarray(out)
+
+    cache = (x, w, b, conv_param, x_cols)
+    return out, cache
+
+
+def conv_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for a convolutional layer,
+    using the columns stored by conv_forward_fast.
+
+    Inputs / outputs: Same as conv_backward_naive.
+    """
+    x, w, b, conv_param, x_cols = cache
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    _, _, H_out, W_out = dout.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    db = np.sum(dout, axis=(0, 2, 3))
+    dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
+    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+
+    # col2im: add each column back onto the receptive field it came from
+    dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
+    dx_cols = dx_cols.reshape(C, HH, WW, N, H_out, W_out)
+    dx_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=dx_cols.dtype)
+    for k in range(HH):
+        for l in range(WW):
+            dx_padded[:, :, k:k + stride * H_out:stride,
+                      l:l + stride * W_out:stride] += \
+                dx_cols[:, k, l].transpose(1, 0, 2, 3)
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+    return dx, dw, db
+
+
+def max_pool_forward_fast(x, pool_param):
+    """
+    A fast implementation of the forward pass for a max pooling layer.
+
+    When the pooling regions are square, do not overlap and tile the input,
+    the input is reshaped so that every region becomes two axes and the max is
+    taken over those axes. Other configurations fall back to the naive
+    implementation.
+
+    Inputs / outputs: Same as max_pool_forward_naive, except that the cache is
+    (method, cache) where method is 'reshape' or 'naive'.
+    """
+    N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+
+    same_size = pool_height == pool_width == stride
+    tiles = H % pool_height == 0 and W % pool_width == 0
+    if not (same_size and tiles):
+        out, naive_cache = max_pool_forward_naive(x, pool_param)
+        return out, ('naive', naive_cache)
+
+    x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
+                           W // pool_width, pool_width)
+    out = x_reshaped.max(axis=3).max(axis=4)
+    cache = ('reshape', (x, x_reshaped, out))
+    return out, cache
+
+
+def max_pool_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for a max pooling layer. As in
+    max_pool_backward_naive, every input equal to the max of its region
+    receives the upstream gradient.
+
+    Inputs / outputs: Same as max_pool_backward_naive.
+    """
+    method, real_cache = cache
+    if method == 'naive':
+        return max_pool_backward_naive(dout, real_cache)
+
+    x, x_reshaped, out = real_cache
+    mask = x_reshaped == out[:, :, :, np.newaxis, :, np.newaxis]
+    dx_reshaped = mask * dout[:, :, :, np.newaxis, :, np.newaxis]
+    dx = dx_reshaped.reshape(x.shape)
+    return dx
@@ -1,9 +1,15 @@
-from builtins import range
-from builtins import object
 import numpy as np
 
-from NN.layers import *
-from NN.layer_utils import *
+from NN.layers import (affine_backward, affine_forward, batchnorm_backward,
+                       batchnorm_forward, distillation_loss, dropout_backward,
+                       dropout_forward, lowrank_affine_backward,
+                       lowrank_affine_forward, softmax_loss,
+                       sparse_affine_backward, sparse_affine_forward)
+from NN.layer_utils import (affine_relu_backward, affine_relu_forward,
+                            lowrank_affine_relu_backward,
+                            lowrank_affine_relu_forward,
+                            sparse_affine_relu_backward,
+                            sparse_affine_relu_forward)
 
 
 class TwoLayerNet(object):
@@ -101,7 +107,9 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3*28*28, num_classes=10,
                  dropout=1, normalization=None, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None,
+                 checkpoint_every=None, label_smoothing=0.0,
+                 class_weights=None, sparse_input=False, ranks=None):
         """
         Initialize a new FullyConnectedNet.
 
@@ -122,13 +130,65 @@ class FullyConnectedNet(object):
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
           model.
+        - checkpoint_every: If not None, an integer k; during training only the
+          inputs of every k-th layer are kept in the forward pass, and each
+          segment of k layers is recomputed during the backward pass. This
+          trades roughly one extra forward pass for memory that grows with
+          L / k instead of L.
+        - label_smoothing: Scalar label smoothing passed to softmax_loss.
+        - class_weights: Optional array of shape (num_classes,) of per-class loss
+          weights passed to softmax_loss.
+        - sparse_input: If True, the first layer uses sparse_affine_forward,
+          which exploits inputs that are mostly zero (see
+          data_utils.collapse_identical_channels for removing redundant
+          channels as well), and its backward pass skips the unused gradient
+          with respect to the input. Requires normalization=None, since
+          normalizing the inputs would make them dense.
+        - ranks: Optional dictionary mapping layer numbers (counting from 1) to
+          ranks. The weight matrix of each of these layers is factorized as
+          U.dot(V), stored as params 'U%d' and 'V%d' instead of 'W%d', which
+          cuts the parameters and FLOPs of a D x M layer with rank r from
+          D * M to r * (D + M). See lowrank.py for factorizing trained weights.
+
+        The attribute loss_scale (default 1.0) multiplies the gradients returned
+        by loss(); the Solver sets it for mixed-precision training so that small
+        gradients survive the low-precision backward pass. The returned loss is
+        not scaled.
+
+        The attribute distillation (default None) can hold a dictionary of
+        keyword arguments of distillation_loss (teacher_scores for the
+        minibatch, temperature, alpha); the Solver sets it when training with
+        a teacher, and the next training-time loss() uses distillation_loss
+        instead of softmax_loss.
         """
+        if sparse_input and normalization is not None:
+            raise ValueError('sparse_input requires normalization=None')
         self.normalization = normalization
+        self.sparse_input = sparse_input
+        self.ranks = dict(ranks or {})
+        if sparse_input and 1 in self.ranks:
+            raise ValueError('The first layer cannot be both sparse_input and '
+                             'factorized')
         self.use_dropout = dropout != 1
         self.reg = reg
         self.num_layers = 1 + len(hidden_dims)
         self.dtype = dtype
+        self.loss_scale = 1.0
+        self.distillation = None
+        self.checkpoint_every = checkpoint_every
+        self.label_smoothing = label_smoothing
+        self.class_weights = class_weights
+        self._dscores = None
         self.params = {}
+
+        # Parameter names of each layer, built once rather than on every pass
+        self.param_names = [None] + [
+            ('W%d' % i, 'b%d' % i, 'gamma%d' % i, 'beta%d' % i)
+            for i in range(1, self.num_layers + 1)]
+        # Names of the regularized weights of each layer: W, or U and V
+        self.weight_names = [None] + [
+            ('U%d' % i, 'V%d' % i) if i in self.ranks else ('W%d' % i,)
+            for i in range(1, self.num_layers + 1)]
         
         all_dims = [input_dim] + hidden_dims + [num_classes]
         for i in range (0, self.num_layers):
@@ -140,7 +200,13 @@ class FullyConnectedNet(object):
                 self.params[gamma_name] = np.ones(all_dims[i])
                 self.params[beta_name] = np.zeros(all_dims[i])
             self.params[b_name] = np.zeros(all_dims[i+1])
-            self.params[W_name] = np.random.normal(scale=weight_scale, size=(all_dims[i],all_dims[i+1]))
+            if i+1 in self.ranks:
+                # Scale V so that the entries of U.dot(V) have std weight_scale
+                r = self.ranks[i+1]
+                self.params['U'+str(i+1)] = np.random.normal(scale=weight_scale, size=(all_dims[i],r))
+                self.params['V'+str(i+1)] = np.random.normal(scale=1/np.sqrt(r), size=(r,all_dims[i+1]))
+            else:
+                self.params[W_name] = np.random.normal(scale=weight_scale, size=(all_dims[i],all_dims[i+1]))
             
         self.dropout_param = {}
         if self.use_dropout:
@@ -173,64 +239,213 @@ class FullyConnectedNet(object):
         if self.normalization=='batchnorm':
             for bn_param in self.bn_params:
                 bn_param['mode'] = mode
-        scores = None
-        pass
-        self.cache = {}
-        self.dropout_cache = {}
-        self.batchnorm_cache = {}
+        self.cache = [None] * (self.num_layers + 1)
         N = X.shape[0]
         D = np.prod(X.shape[1:])
-        x2 = X.reshape(N,D)
-        scores = x2
-        
-        for i in range(1,self.num_layers+1):
-            id_str = str(i)
-            W_name = 'W' + id_str
-            b_name = 'b' + id_str
-            gamma_name = 'gamma' + id_str
-            beta_name = 'beta' + id_str
-            batchnorm_name = 'batchnorm' + id_str
-            dropout_name = 'dropout' + id_str
-            cache_name = 'c' + id_str
-            
-            if i == self.num_layers:
-                scores, cache = affine_forward(scores, self.params[W_name],self.params[b_name])
-            else:
-                if self.normalization=='batchnorm':
-                    scores, self.batchnorm_cache[batchnorm_name] = batchnorm_forward(scores, self.params[gamma_name],self.params[beta_name],self.bn_params[i-1])
-                scores, cache = affine_relu_forward(scores, self.params[W_name], self.params[b_name])
-                if self.use_dropout:
-                    scores, self.dropout_cache[dropout_name] = dropout_forward(scores, self.dropout_param)
+        scores = X.reshape(N,D)
 
-            
-            self.cache[cache_name] = cache
+        if mode == 'train' and self.checkpoint_every is not None:
+            return self._checkpointed_loss(scores, y)
+
+        for i in range(1,self.num_layers+1):
+            scores, cache = self._layer_forward(i, scores, self.dropout_param)
+            if mode == 'train':
+                self.cache[i] = cache
 
         if mode == 'test':
             return scores
 
         loss, grads = 0.0, {}
 
-        loss, der = softmax_loss(scores,y)
+        loss, der = self._data_loss(scores, y)
         for i in range(self.num_layers,0,-1):
-            id_str = str(i)
-            W_name = 'W' + id_str
-            b_name = 'b' + id_str
-            gamma_name = 'gamma' + id_str
-            beta_name = 'beta' + id_str
-            batchnorm_name = 'batchnorm' + id_str
-            dropout_name = 'dropout' + id_str
-            cache_name = 'c' + id_str
-
-            loss += 0.5*self.reg*np.sum(self.params[W_name]**2)  # l2 regulation
-            if i == self.num_layers:
-                der, grads[W_name], grads[b_name] = affine_backward(der, self.cache[cache_name])
-            else:
-                if self.use_dropout:
-                    der = dropout_backward(der,self.dropout_cache[dropout_name])
-                der, grads[W_name], grads[b_name] = affine_relu_backward(der, self.cache[cache_name])
-                if self.normalization=='batchnorm':
-                    der, grads[gamma_name], grads[beta_name] = batchnorm_backward(der, self.batchnorm_cache[batchnorm_name])
-            grads[W_name] += self.reg*self.params[W_name]
+            der = self._layer_backward(i, der, self.cache[i], grads)
+            loss += self._reg_loss(i, grads)
+
+        return loss, grads
+
+
+    def _data_loss(self, scores, y):
+        """
+        Softmax loss of the scores and its gradient multiplied by loss_scale.
+        The gradient is written into a buffer that is reused while the shape
+        and dtype of the scores stay the same.
+        """
+        if (self._dscores is None or self._dscores.shape != scores.shape or
+                self._dscores.dtype != scores.dtype):
+            self._dscores = np.empty_like(scores)
+        if self.distillation is not None:
+            loss, dscores = distillation_loss(
+                scores, y, class_weights=self.class_weights,
+                label_smoothing=self.label_smoothing, out=self._dscores,
+                **self.distillation)
+        else:
+            loss, dscores = softmax_loss(scores, y, class_weights=self.class_weights,
+                                         label_smoothing=self.label_smoothing,
+                                         out=self._dscores)
+        if self.loss_scale != 1.0:
+            dscores *= self.loss_scale
+        return loss, dscores
+
+
+    def _layer_forward(self, i, x, dropout_param, bn_param=None):
+        """
+        Forward pass for layer i (counting from 1): the final affine layer, or
+        an {[batchnorm] - affine - relu - [dropout]} block. bn_param overrides
+        the layer's entry of self.bn_params.
+
+        Returns a tuple of the output and a cache of (bn_cache, fc_cache,
+        dropout_cache).
+        """
+        W_name, b_name, gamma_name, beta_name = self.param_names[i]
+        if i == self.num_layers:
+            out, fc_cache = self._affine_forward(i, x, relu=False)
+            return out, (None, fc_cache, None)
+
+        bn_cache, dropout_cache = None, None
+        if self.normalization=='batchnorm':
+            if bn_param is None:
+                bn_param = self.bn_params[i-1]
+            x, bn_cache = batchnorm_forward(x, self.params[gamma_name],
+                                            self.params[beta_name], bn_param)
+        out, fc_cache = self._affine_forward(i, x, relu=True)
+        if self.use_dropout:
+            out, dropout_cache = dropout_forward(out, dropout_param)
+        return out, (bn_cache, fc_cache, dropout_cache)
+
 
+    def _layer_backward(self, i, dout, cache, grads):
+        """
+        Backward pass for layer i using the cache from _layer_forward; the
+        parameter gradients are written into grads. Returns the gradient with
+        respect to the layer input, or None for the first layer with
+        sparse_input.
+        """
+        W_name, b_name, gamma_name, beta_name = self.param_names[i]
+        bn_cache, fc_cache, dropout_cache = cache
+        if i == self.num_layers:
+            dx = self._affine_backward(i, dout, fc_cache, grads, relu=False)
+        else:
+            if self.use_dropout:
+                dout = dropout_backward(dout, dropout_cache)
+            dx = self._affine_backward(i, dout, fc_cache, grads, relu=True)
+            if self.normalization=='batchnorm':
+                dx, grads[gamma_name], grads[beta_name] = batchnorm_backward(dx, bn_cache)
+        return dx
+
+
+    def _affine_forward(self, i, x, relu):
+        """
+        Affine part of layer i, followed by a ReLU if relu is True: dense,
+        factorized (see ranks) or sparse (see sparse_input).
+        """
+        b = self.params[self.param_names[i][1]]
+        if i in self.ranks:
+            U, V = [self.params[name] for name in self.weight_names[i]]
+            if relu:
+                return lowrank_affine_relu_forward(x, U, V, b)
+            return lowrank_affine_forward(x, U, V, b)
+        W = self.params[self.param_names[i][0]]
+        if self.sparse_input and i == 1:
+            if relu:
+                return sparse_affine_relu_forward(x, W, b)
+            return sparse_affine_forward(x, W, b)
+        if relu:
+            return affine_relu_forward(x, W, b)
+        return affine_forward(x, W, b)
+
+
+    def _affine_backward(self, i, dout, cache, grads, relu):
+        """
+        Backward pass of _affine_forward; the gradients of the weights and
+        bias are written into grads. Returns the gradient with respect to x.
+        """
+        W_name, b_name = self.param_names[i][:2]
+        if i in self.ranks:
+            U_name, V_name = self.weight_names[i]
+            backward = lowrank_affine_relu_backward if relu else lowrank_affine_backward
+            dx, grads[U_name], grads[V_name], grads[b_name] = backward(dout, cache)
+        elif self.sparse_input and i == 1:
+            backward = sparse_affine_relu_backward if relu else sparse_affine_backward
+            dx, grads[W_name], grads[b_name] = backward(dout, cache,
+                                                        compute_dx=False)
+        else:
+            backward = affine_relu_backward if relu else affine_backward
+            dx, grads[W_name], grads[b_name] = backward(dout, cache)
+        return dx
+
+
+    def _reg_loss(self, i, grads):
+        """
+        Add the L2 regularization gradient of layer i to grads and return its
+        contribution to the loss.
+        """
+        loss = 0.0
+        for W_name in self.weight_names[i]:
+            W = self.params[W_name]
+            grads[W_name] += self.reg*self.loss_scale*W
+            loss += 0.5*self.reg*np.sum(W**2)  # l2 regulation
+        return loss
+
+
+    def affine_weight(self, i):
+        """
+        Weight matrix of layer i (counting from 1), computed as U.dot(V) for
+        factorized layers.
+        """
+        if i in self.ranks:
+            U, V = [self.params[name] for name in self.weight_names[i]]
+            return U.dot(V)
+        return self.params[self.param_names[i][0]]
+
+
+    def _checkpointed_loss(self, x, y):
+        """
+        Training-time loss with activation recomputation. The forward pass only
+        keeps the input of every checkpoint_every-th layer; the backward pass
+        reruns each segment from its stored input to rebuild the caches.
+
+        Dropout masks are replayed by giving every layer its own seed for this
+        step, and batchnorm layers are recomputed on a copy of their bn_param so
+        that running statistics are updated only once.
+        """
+        k = self.checkpoint_every
+        L = self.num_layers
+        seeds = np.random.randint(2**31, size=L)
+        dropout_params = [None] * (L + 1)
+        if self.use_dropout:
+            for i in range(1, L):
+                p = dict(self.dropout_param)
+                p.pop('rng', None)
+                p.setdefault('seed', int(seeds[i-1]))
+                dropout_params[i] = p
+
+        # Forward pass keeping only the segment inputs
+        boundaries = {}
+        scores = x
+        for i in range(1, L+1):
+            if (i - 1) % k == 0:
+                boundaries[i] = scores
+            scores, _ = self._layer_forward(i, scores, dropout_params[i])
+
+        loss, der = self._data_loss(scores, y)
+        del scores
+
+        grads = {}
+        for start in sorted(boundaries, reverse=True):
+            end = min(start + k, L + 1)
+            # Recompute the segment with caches
+            caches = {}
+            out = boundaries.pop(start)
+            for i in range(start, end):
+                bn_param = None
+                if self.normalization=='batchnorm' and i < L:
+                    bn_param = dict(self.bn_params[i-1])
+                out, caches[i] = self._layer_forward(i, out, dropout_params[i],
+                                                     bn_param)
+            del out
+            for i in range(end - 1, start - 1, -1):
+                der = self._layer_backward(i, der, caches.pop(i), grads)
+                loss += self._reg_loss(i, grads)
 
         return loss, grads
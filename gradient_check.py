@@ -1,10 +1,18 @@
 from __future__ import print_function
-from builtins import range
-from past.builtins import xrange
 
+import time
 import numpy as np
 from random import randrange
 
+# Function, point and step shared with forked workers of the process pool used
+# by eval_numerical_gradient_parallel; see _init_pool_state.
+_pool_state = None
+
+
+def rel_error(x, y):
+    """ returns relative error """
+    return np.max(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
+
 def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
     """
     a naive implementation of numerical gradient of f at x
@@ -58,53 +66,6 @@ def eval_numerical_gradient_array(f, x, df, h=1e-5):
     return grad
 
 
-def eval_numerical_gradient_blobs(f, inputs, output, h=1e-5):
-    """
-    Compute numeric gradients for a function that operates on input
-    and output blobs.
-
-    We assume that f accepts several input blobs as arguments, followed by a
-    blob where outputs will be written. For example, f might be called like:
-
-    f(x, w, out)
-
-    where x and w are input Blobs, and the result of f will be written to out.
-
-    Inputs:
-    - f: function
-    - inputs: tuple of input blobs
-    - output: output blob
-    - h: step size
-    """
-    numeric_diffs = []
-    for input_blob in inputs:
-        diff = np.zeros_like(input_blob.diffs)
-        it = np.nditer(input_blob.vals, flags=['multi_index'],
-                       op_flags=['readwrite'])
-        while not it.finished:
-            idx = it.multi_index
-            orig = input_blob.vals[idx]
-
-            input_blob.vals[idx] = orig + h
-            f(*(inputs + (output,)))
-            pos = np.copy(output.vals)
-            input_blob.vals[idx] = orig - h
-            f(*(inputs + (output,)))
-            neg = np.copy(output.vals)
-            input_blob.vals[idx] = orig
-
-            diff[idx] = np.sum((pos - neg) * output.diffs) / (2.0 * h)
-
-            it.iternext()
-        numeric_diffs.append(diff)
-    return numeric_diffs
-
-
-def eval_numerical_gradient_net(net, inputs, output, h=1e-5):
-    return eval_numerical_gradient_blobs(lambda *args: net.forward(),
-                inputs, output, h=h)
-
-
 def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
     """
     sample a few random elements and only return numerical
@@ -127,3 +88,285 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
                     (abs(grad_numerical) + abs(grad_analytic)))
         print('numerical: %f analytic: %f, relative error: %e'
               %(grad_numerical, grad_analytic, rel_error))
+
+
+def _eval_coords(f, x, coords, h):
+    """
+    Evaluate the centered difference of the scalar function f at x along each
+    of the flat indices in coords. x is perturbed in place and restored.
+    """
+    flat = x.reshape(-1)
+    grad = np.zeros(len(coords))
+    for k, ix in enumerate(coords):
+        oldval = flat[ix]
+        flat[ix] = oldval + h
+        fxph = f(x)
+        flat[ix] = oldval - h
+        fxmh = f(x)
+        flat[ix] = oldval
+        grad[k] = (fxph - fxmh) / (2 * h)
+    return grad
+
+
+def _eval_coords_worker(coords):
+    f, x, h = _pool_state
+    return _eval_coords(f, x, coords, h)
+
+
+def eval_numerical_gradient_parallel(f, x, df=None, h=1e-5, indices=None,
+                                     num_workers=None, chunk_size=256):
+    """
+    Evaluate a numeric gradient by splitting the coordinates of x into chunks
+    and evaluating the chunks across a pool of forked worker processes.
+
+    Inputs:
+    - f: Function taking a single array argument. It returns a scalar, or an
+      array when df is given.
+    - x: Point (numpy array) to evaluate the gradient at. It is perturbed in
+      place and restored before returning.
+    - df: If not None, upstream derivative of the output of f; the gradient of
+      np.sum(f(x) * df) is computed, as in eval_numerical_gradient_array.
+    - h: Step size.
+    - indices: Optional array of flat indices into x; only these coordinates
+      are evaluated.
+    - num_workers: Number of worker processes; defaults to the CPU count. With
+      a single worker, or on platforms without fork, the chunks are evaluated
+      in this process.
+    - chunk_size: Number of coordinates handed to a worker at a time.
+
+    Returns:
+    - grad: If indices is None, an array of the same shape as x; otherwise a
+      1-D array with the gradient at each of the requested indices.
+    """
+    import multiprocessing
+
+    global _pool_state
+    if not x.flags.c_contiguous:
+        raise ValueError('x must be C-contiguous to be perturbed in place')
+
+    g = f
+    if df is not None:
+        g = lambda z: np.sum(f(z) * df)
+
+    coords = np.arange(x.size) if indices is None else np.asarray(indices)
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, max(len(coords) // chunk_size, 1))
+
+    if (num_workers <= 1 or
+            'fork' not in multiprocessing.get_all_start_methods()):
+        grad = _eval_coords(g, x, coords, h)
+    else:
+        chunks = [coords[i:i + chunk_size]
+                  for i in range(0, len(coords), chunk_size)]
+        _pool_state = (g, x, h)
+        try:
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(num_workers) as pool:
+                grad = np.concatenate(pool.map(_eval_coords_worker, chunks))
+        finally:
+            _pool_state = None
+
+    if indices is None:
+        return grad.reshape(x.shape)
+    return grad
+
+
+def directional_gradient_check(f, x, analytic_grad, num_directions=5,
+                               h=1e-5, seed=None):
+    """
+    Check an analytic gradient along a few random directions instead of every
+    coordinate. For a unit direction v the centered difference of f along v
+    is compared against the projection np.sum(analytic_grad * v), which costs
+    two evaluations of f per direction regardless of the size of x.
+
+    Inputs:
+    - f: Function taking a single array argument and returning a scalar
+    - x: Point (numpy array) to check at; perturbed in place and restored
+    - analytic_grad: Analytic gradient of f at x, same shape as x
+    - num_directions: Number of random directions to check
+    - h: Step size
+    - seed: Optional seed for the random directions
+
+    Returns a dictionary with:
+    - numerical: Array of shape (num_directions,) of numeric derivatives
+    - analytic: Array of shape (num_directions,) of projected gradients
+    - rel_error: Largest relative error over all directions
+    """
+    rng = np.random.RandomState(seed)
+    x0 = x.copy()
+    numerical = np.zeros(num_directions)
+    analytic = np.zeros(num_directions)
+    for i in range(num_directions):
+        v = rng.randn(*x.shape)
+        v /= np.linalg.norm(v)
+        x[...] = x0 + h * v
+        fxph = f(x)
+        x[...] = x0 - h * v
+        fxmh = f(x)
+        x[...] = x0
+        numerical[i] = (fxph - fxmh) / (2 * h)
+        analytic[i] = np.sum(analytic_grad * v)
+
+    return {
+        'numerical': numerical,
+        'analytic': analytic,
+        'rel_error': rel_error(numerical, analytic),
+    }
+
+
+def check_gradients(f, params, grads, num_directions=5, num_coords=0, h=1e-5,
+                    num_workers=1, seed=None):
+    """
+    Check the analytic gradients of a scalar function of several parameter
+    arrays and return a relative-error report per parameter.
+
+    Inputs:
+    - f: Function of no arguments returning a scalar; it must read the
+      arrays in params, which are perturbed in place.
+    - params: Dictionary mapping names to parameter arrays
+    - grads: Dictionary with the same keys mapping to analytic gradients
+    - num_directions: Random directions checked per parameter
+    - num_coords: Randomly chosen coordinates checked per parameter with
+      eval_numerical_gradient_parallel; None checks every coordinate.
+    - h: Step size
+    - num_workers: Worker processes used for coordinate checks
+    - seed: Optional seed for the random directions and coordinates
+
+    Returns:
+    - report: Dictionary mapping each parameter name to a dictionary with the
+      keys 'directional' and 'coords' holding the largest relative error of
+      each kind of check (None if that check was skipped).
+    """
+    rng = np.random.RandomState(seed)
+    g = lambda _: f()
+    report = {}
+    for name in sorted(params):
+        x = params[name]
+        entry = {'directional': None, 'coords': None}
+        if num_directions > 0:
+            result = directional_gradient_check(g, x, grads[name],
+                num_directions=num_directions, h=h, seed=rng.randint(2**31))
+            entry['directional'] = result['rel_error']
+        if num_coords is None or num_coords > 0:
+            indices = None
+            if num_coords is not None and num_coords < x.size:
+                indices = rng.choice(x.size, num_coords, replace=False)
+            num = eval_numerical_gradient_parallel(g, x, h=h, indices=indices,
+                num_workers=num_workers)
+            ana = grads[name].reshape(-1)
+            if indices is not None:
+                ana = ana[indices]
+            entry['coords'] = rel_error(num.reshape(-1), ana.reshape(-1))
+        report[name] = entry
+    return report
+
+
+def print_gradient_report(report):
+    """
+    Print the per-parameter report returned by check_gradients.
+    """
+    fmt = lambda e: '%e' % e if e is not None else '-'
+    print('%-10s %-14s %-14s' % ('param', 'directional', 'coords'))
+    for name, entry in report.items():
+        print('%-10s %-14s %-14s' % (
+              name, fmt(entry['directional']), fmt(entry['coords'])))
+
+
+def check_model_gradients(model, X, y, num_checks=200, num_directions=3,
+                          h=1e-5, num_workers=1, seed=0):
+    """
+    Gradient check every parameter of a model conforming to the Solver API.
+
+    While checking, the parameters are cast to float64 and, if the model uses
+    dropout, the 'seed' of its dropout_param (or of every entry of
+    dropout_params) is set so that every evaluation of the loss uses the same
+    mask. Batchnorm running statistics are restored afterwards,
+    and the parameters are cast back to their original dtype.
+
+    Inputs:
+    - model: Model with a params dictionary and a loss(X, y) method
+    - X, y: Minibatch of data and labels to check the loss on
+    - num_checks: Total number of coordinates to check. They are sampled
+      from each parameter in proportion to its size, with at least one
+      coordinate per parameter.
+    - num_directions: Random directions checked per parameter
+    - h: Step size
+    - num_workers: Worker processes used for coordinate checks
+    - seed: Seed for dropout and for sampling coordinates and directions
+
+    Returns a dictionary with:
+    - params: Dictionary mapping each parameter name to a dictionary with
+      keys 'rel_error' (coordinate checks), 'directional_error',
+      'num_checked', 'size' and 'time' (seconds spent on that parameter)
+    - max_rel_error: Largest relative error over all parameters and checks
+    - time: Total seconds spent
+    """
+    start = time.time()
+    rng = np.random.RandomState(seed)
+    X = np.asarray(X, dtype=np.float64)
+
+    orig_dtype = getattr(model, 'dtype', None)
+    orig_params = {k: v.dtype for k, v in model.params.items()}
+    dropout_params = getattr(model, 'dropout_params', None)
+    if dropout_params is None:
+        dropout_params = [getattr(model, 'dropout_param', None) or {}]
+    dropout_params = [p for p in dropout_params if p]
+    orig_seeds = [p.get('seed') for p in dropout_params]
+    bn_params = getattr(model, 'bn_params', [])
+    orig_bn = [dict(p) for p in bn_params]
+
+    for k, v in model.params.items():
+        model.params[k] = v.astype(np.float64)
+    if orig_dtype is not None:
+        model.dtype = np.float64
+    for p in dropout_params:
+        p['seed'] = seed
+
+    try:
+        _, grads = model.loss(X, y)
+        f = lambda _: model.loss(X, y)[0]
+
+        total = sum(v.size for v in model.params.values())
+        results = {}
+        max_err = 0.0
+        for name in sorted(model.params):
+            t0 = time.time()
+            x = model.params[name]
+            n = min(x.size, max(1, int(round(num_checks * x.size / total))))
+            indices = rng.choice(x.size, n, replace=False)
+            num = eval_numerical_gradient_parallel(f, x, h=h, indices=indices,
+                num_workers=num_workers)
+            err = rel_error(num, grads[name].reshape(-1)[indices])
+            dir_err = None
+            if num_directions > 0:
+                dir_err = directional_gradient_check(f, x, grads[name],
+                    num_directions=num_directions, h=h,
+                    seed=rng.randint(2**31))['rel_error']
+            max_err = max(max_err, err, dir_err or 0.0)
+            results[name] = {
+                'rel_error': err,
+                'directional_error': dir_err,
+                'num_checked': n,
+                'size': x.size,
+                'time': time.time() - t0,
+            }
+    finally:
+        for k, dtype in orig_params.items():
+            model.params[k] = model.params[k].astype(dtype)
+        if orig_dtype is not None:
+            model.dtype = orig_dtype
+        for p, orig_seed in zip(dropout_params, orig_seeds):
+            if orig_seed is None:
+                p.pop('seed', None)
+            else:
+                p['seed'] = orig_seed
+        for p, orig in zip(bn_params, orig_bn):
+            p.clear()
+            p.update(orig)
+
+    return {
+        'params': results,
+        'max_rel_error': max_err,
+        'time': time.time() - start,
+    }
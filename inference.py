@@ -0,0 +1,93 @@
+import pickle
+
+import numpy as np
+
+from NN.detect import PredictionCache, detect_digits, predict_in_batches
+from NN.fc_net import FullyConnectedNet
+from NN.layers import (affine_forward, batchnorm_forward,
+                       lowrank_affine_forward, relu_forward,
+                       sparse_affine_forward)
+from NN.quantize import QuantizedFCNet
+
+"""
+This file is the import surface for inference-only programs. It loads numpy,
+the forward kernels and the test-time models, and never imports the Solver,
+the optimizers, gradient checking or scipy, which keeps the start-up time of
+small workers low (see benchmark.benchmark_import_time).
+
+Example usage:
+
+from NN.inference import load_checkpoint, predict
+
+model = load_checkpoint('fc_net_epoch_10.pkl')
+y_pred = predict(model, X)
+"""
+
+__all__ = [
+    'FullyConnectedNet', 'PredictionCache', 'QuantizedFCNet', 'affine_forward',
+    'batchnorm_forward', 'detect_digits', 'load_checkpoint',
+    'lowrank_affine_forward', 'predict', 'predict_in_batches', 'relu_forward',
+    'sparse_affine_forward',
+]
+
+# Modules of the training state stored next to the model in a checkpoint
+_TRAINING_MODULES = ('NN.solver', 'NN.optim', 'NN.lr_schedule', 'NN.metrics',
+                     'NN.profiler', 'NN.pruning')
+
+
+class _Skipped(object):
+    """
+    Stand-in for the objects of _TRAINING_MODULES in an unpickled checkpoint.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+
+class _ModelUnpickler(pickle.Unpickler):
+    """
+    Unpickler that replaces the classes and functions of _TRAINING_MODULES by
+    _Skipped instead of importing them, so that loading a checkpoint only
+    imports the modules of the model itself.
+    """
+
+    def find_class(self, module, name):
+        if module in _TRAINING_MODULES:
+            return _Skipped
+        return super(_ModelUnpickler, self).find_class(module, name)
+
+
+def load_checkpoint(filename, use_ema=True):
+    """
+    Load the model of a checkpoint written by Solver.
+
+    Inputs:
+    - filename: Path of a checkpoint file.
+    - use_ema: If True and the checkpoint holds an exponential moving average
+      of the weights, load those weights into the model.
+
+    Returns:
+    - The model, ready for test-time calls of model.loss(X).
+
+    The optimizer, schedule and metric histories of the checkpoint are not
+    loaded, and the training modules are not imported.
+    """
+    with open(filename, 'rb') as f:
+        checkpoint = _ModelUnpickler(f).load()
+    model = checkpoint['model']
+    if use_ema and checkpoint.get('ema_params'):
+        model.params = dict(model.params)
+        for p, w in checkpoint['ema_params'].items():
+            model.params[p] = w.astype(model.params[p].dtype)
+    return model
+
+
+def predict(model, X, batch_size=None):
+    """
+    Predicted labels of model on X, computed in batches of batch_size; see
+    predict_in_batches.
+    """
+    return np.argmax(predict_in_batches(model, X, batch_size), axis=1)
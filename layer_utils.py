@@ -1,4 +1,6 @@
-from NN.layers import *
+from NN.layers import (affine_backward, affine_forward, lowrank_affine_backward,
+                       lowrank_affine_forward, relu_backward, relu_forward,
+                       sparse_affine_backward, sparse_affine_forward)
 
 
 def affine_relu_forward(x, w, b):
@@ -15,4 +17,29 @@ def affine_relu_backward(dout, cache):
     return dx, dw, db
 
 
+def sparse_affine_relu_forward(x, w, b):
+    a, fc_cache = sparse_affine_forward(x, w, b)
+    out, relu_cache = relu_forward(a)
+    cache = (fc_cache, relu_cache)
+    return out, cache
+
+
+def sparse_affine_relu_backward(dout, cache, compute_dx=True):
+    fc_cache, relu_cache = cache
+    da = relu_backward(dout, relu_cache)
+    dx, dw, db = sparse_affine_backward(da, fc_cache, compute_dx)
+    return dx, dw, db
 
+
+def lowrank_affine_relu_forward(x, u, v, b):
+    a, fc_cache = lowrank_affine_forward(x, u, v, b)
+    out, relu_cache = relu_forward(a)
+    cache = (fc_cache, relu_cache)
+    return out, cache
+
+
+def lowrank_affine_relu_backward(dout, cache):
+    fc_cache, relu_cache = cache
+    da = relu_backward(dout, relu_cache)
+    dx, du, dv, db = lowrank_affine_backward(da, fc_cache)
+    return dx, du, dv, db
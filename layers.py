@@ -1,4 +1,3 @@
-from builtins import range
 import numpy as np
 
 
@@ -58,6 +57,126 @@ def affine_backward(dout, cache):
     return dx, dw, db
 
 
+def lowrank_affine_forward(x, u, v, b):
+    """
+    Computes the forward pass for an affine layer whose weight matrix is
+    factorized as w = u.dot(v) with rank r, in 2 * N * r * (D + M) operations
+    instead of 2 * N * D * M.
+
+    Inputs:
+    - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
+    - u: A numpy array of shape (D, r)
+    - v: A numpy array of shape (r, M)
+    - b: A numpy array of biases, of shape (M,)
+
+    Returns a tuple of:
+    - out: output, of shape (N, M)
+    - cache: (x, u, v, xu)
+    """
+    N = x.shape[0]
+    xu = x.reshape(N, -1).dot(u)
+    out = xu.dot(v) + b
+    cache = (x, u, v, xu)
+    return out, cache
+
+
+def lowrank_affine_backward(dout, cache):
+    """
+    Computes the backward pass for a factorized affine layer.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M)
+    - cache: The cache of lowrank_affine_forward
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
+    - du: Gradient with respect to u, of shape (D, r)
+    - dv: Gradient with respect to v, of shape (r, M)
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    x, u, v, xu = cache
+    N = x.shape[0]
+    dv = xu.T.dot(dout)
+    dxu = dout.dot(v.T)
+    du = x.reshape(N, -1).T.dot(dxu)
+    dx = dxu.dot(u.T).reshape(x.shape)
+    db = np.sum(dout, axis=0)
+    return dx, du, dv, db
+
+
+def sparse_affine_forward(x, w, b, csr_threshold=0.05, column_threshold=0.75):
+    """
+    Forward pass for an affine layer whose inputs are mostly zero, such as the
+    first layer on digit images with a black background.
+
+    The sparsity of the batch is measured on every call and the cheapest of
+    three methods is used:
+    - 'csr': if the fraction of nonzero inputs is below csr_threshold, x is
+      converted to a scipy.sparse CSR matrix and multiplied by w.
+    - 'compact': otherwise, if the fraction of input features that are
+      nonzero in some example is below column_threshold, only those columns of
+      x and rows of w take part in a dense product.
+    - 'dense': otherwise, the same product as affine_forward.
+    BLAS beats the sparse product unless the batch is very sparse, so the
+    thresholds are low.
+
+    Inputs / outputs: Same as affine_forward, except that the cache is
+    (x_shape, w, b, method, data).
+    """
+    N = x.shape[0]
+    x2 = x.reshape(N, -1)
+    D = x2.shape[1]
+
+    density = np.count_nonzero(x2) / x2.size
+    if density < csr_threshold:
+        from scipy import sparse
+        x_csr = sparse.csr_matrix(x2)
+        out = x_csr.dot(w) + b
+        return out, (x.shape, w, b, 'csr', x_csr)
+
+    active = np.flatnonzero(x2.any(axis=0))
+    if active.size < column_threshold * D:
+        x_active = x2[:, active]
+        out = x_active.dot(w[active]) + b
+        return out, (x.shape, w, b, 'compact', (active, x_active))
+
+    out = x2.dot(w) + b
+    return out, (x.shape, w, b, 'dense', x2)
+
+
+def sparse_affine_backward(dout, cache, compute_dx=True):
+    """
+    Backward pass for sparse_affine_forward. dw is computed with the same
+    method as the forward pass; in particular the rows of dw for inputs that
+    are zero in the whole batch are zero without any computation.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M)
+    - cache: The cache of sparse_affine_forward
+    - compute_dx: If False, dx is not computed and None is returned instead,
+      e.g. for the first layer of a network.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k), or None
+    - dw: Gradient with respect to w, of shape (D, M)
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    x_shape, w, b, method, data = cache
+    if method == 'csr':
+        dw = np.asarray(data.T.dot(dout))
+    elif method == 'compact':
+        active, x_active = data
+        dw = np.zeros_like(w, dtype=dout.dtype)
+        dw[active] = x_active.T.dot(dout)
+    else:
+        dw = data.T.dot(dout)
+    db = np.sum(dout, axis=0)
+    dx = None
+    if compute_dx:
+        dx = dout.dot(w.T).reshape(x_shape)
+    return dx, dw, db
+
+
 def relu_forward(x):
     """
     Computes the forward pass for a layer of rectified linear units (ReLUs).
@@ -67,11 +186,11 @@ def relu_forward(x):
 
     Returns a tuple of:
     - out: Output, of the same shape as x
-    - cache: x
+    - cache: Boolean mask of the positive entries of x
     """
     out = np.maximum(0,x)
 
-    cache = x
+    cache = x > 0
     return out, cache
 
 
@@ -81,16 +200,14 @@ def relu_backward(dout, cache):
 
     Input:
     - dout: Upstream derivatives, of any shape
-    - cache: Input x, of same shape as dout
+    - cache: Boolean mask of the positive inputs, of same shape as dout
 
     Returns:
     - dx: Gradient with respect to x
     """
-    dx, x = None, cache
-    out = np.maximum(0,x)
-    out[out > 0] = 1
-    dx = out * dout
-    
+    dx, mask = None, cache
+    dx = dout * mask
+
     return dx
 
 
@@ -282,6 +399,21 @@ def layernorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
+def _dropout_rng(dropout_param):
+    """
+    Return the random generator for a dropout layer. A seeded dropout_param gets
+    a fresh counter-based Philox generator on every call, so repeated forward
+    passes draw identical masks without touching the global numpy RNG.
+    """
+    if 'seed' in dropout_param:
+        return np.random.Generator(np.random.Philox(dropout_param['seed']))
+    rng = dropout_param.get('rng')
+    if rng is None:
+        rng = np.random.Generator(np.random.Philox(np.random.randint(2**31)))
+        dropout_param['rng'] = rng
+    return rng
+
+
 def dropout_forward(x, dropout_param):
     """
     Performs the forward pass for (inverted) dropout.
@@ -295,11 +427,15 @@ def dropout_forward(x, dropout_param):
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not
         in real networks.
+      - rng: Optional np.random.Generator used when no seed is given. If
+        missing, a Philox generator seeded from the global numpy RNG is
+        created and stored here on the first call.
 
     Outputs:
     - out: Array of the same shape as x.
-    - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+    - cache: tuple (dropout_param, mask). In training mode, mask is the keep
+      mask that was used to multiply the input, packed to one bit per element
+      with np.packbits; in test mode, mask is None.
 
     NOTE: Please implement **inverted** dropout, not the vanilla version of dropout.
     See http://cs231n.github.io/neural-networks-2/#reg for more details.
@@ -309,16 +445,16 @@ def dropout_forward(x, dropout_param):
     as the probability of dropping a neuron output.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
-    if 'seed' in dropout_param:
-        np.random.seed(dropout_param['seed'])
 
     mask = None
     out = None
 
     if mode == 'train':
 
-        mask = (np.random.rand(*x.shape) < p) / p
-        out = x * mask
+        keep = _dropout_rng(dropout_param).random(x.shape, dtype=np.float32) < p
+        out = x * keep
+        out /= p
+        mask = np.packbits(keep)
 
     elif mode == 'test':
 
@@ -344,8 +480,10 @@ def dropout_backward(dout, cache):
 
     dx = None
     if mode == 'train':
-        
-        dx = dout * mask
+
+        keep = np.unpackbits(mask, count=dout.size).reshape(dout.shape)
+        dx = dout * keep
+        dx /= dropout_param['p']
 
     elif mode == 'test':
         dx = dout
@@ -389,13 +527,13 @@ def conv_forward_naive(x, w, b, conv_param):
     stride = conv_param['stride']
     pad = conv_param['pad']
     
-    assert (H + 2 * padding - field_height) % stride == 0
-    assert (W + 2 * padding - field_height) % stride == 0
+    assert (H + 2 * pad - HH) % stride == 0
+    assert (W + 2 * pad - WW) % stride == 0
     
-    H_out = (H + 2 * pad - HH) / stride + 1
-    W_out = (W + 2 * pad - WW) / stride + 1
+    H_out = (H + 2 * pad - HH) // stride + 1
+    W_out = (W + 2 * pad - WW) // stride + 1
     
-    out = np.zeros((N,F,H_out,W_out))
+    out = np.zeros((N,F,H_out,W_out), dtype=x.dtype)
     
     # padding
     x_with_pad = np.pad(x, ((0,0),(0,0),(pad,pad),(pad,pad)),'constant',constant_values=0) # x was 4 dimentional matrix
@@ -420,9 +558,6 @@ def conv_forward_naive(x, w, b, conv_param):
                     conv_value = np.sum(x_rf * w[l]) + b[l]
                     out[i,l,yy,xx] = conv_value
             xx = -1
-    cache = (x,w,b,conv_param)
-    return out,cache
-
     cache = (x, w, b, conv_param)
     return out, cache
 
@@ -451,9 +586,6 @@ def conv_backward_naive(dout, cache):
     
     N,F,Hdout,Wdout = dout.shape
     
-    H_out = (H + 2 * conv_param['pad'] - HH) / conv_param['stride'] + 1
-    W_out = (W + 2 * conv_param['pad'] - WW) / conv_param['stride'] + 1
-    
     db = np.zeros((b.shape))
     for i in range(0, F):
         db[i] = np.sum(dout[:,i,:,:])
@@ -465,24 +597,14 @@ def conv_backward_naive(dout, cache):
                 for l in range(0,WW):
                     dw[i,j,k,l] = np.sum(dout[:,i,:,:] * x_with_pad[:,j,k:k + Hdout * stride:stride, l:l + Wdout * stride:stride])
     
-    dx = np.zeros((N,C,H,W))
-    
-    for nprime in range(N):
-        for i in range(H):
-            for j in range(W):
-                for f in range(F):
-                    for k in range(Hdout):
-                        for l in range(Wdout):
-                            mask1 = np.zeros_like(w[f,:,:,:])
-                            mask2 = np.zeros_like(w[f,:,:,:])
-                            if(i + pad - k * stride) < HH and (i + pad - k * stride) >= 0:
-                                mask1[:,1+pad-k*stride,:] = 1.0
-                            if(j + pad - l * stride) < WW and (j + pad - l * stride) >= 0:
-                                mask2[:,:,j+pad-l*stride] = 1.0
-                            w_masked = np.sum(w[f,:,:,:] * mask1 * mask2, axis=(1,2))
-                            dx[nprime,:,i,j] += dout[nprime,f,k,l] * w_masked
-                 
-    
+    # Scatter each output gradient back onto its receptive field
+    dx_with_pad = np.zeros_like(x_with_pad)
+    for k in range(Hdout):
+        for l in range(Wdout):
+            dx_with_pad[:,:,k*stride:k*stride+HH,l*stride:l*stride+WW] += \
+                np.tensordot(dout[:,:,k,l], w, axes=(1,0))
+    dx = dx_with_pad[:,:,pad:pad+H,pad:pad+W]
+
     return dx, dw, db
 
 
@@ -513,9 +635,9 @@ def max_pool_forward_naive(x, pool_param):
     pool_width = pool_param['pool_width']
     stride = pool_param['stride']
 
-    H_out = 1 + (H - pool_height) / stride 
-    W_out = 1 + (W - pool_width) / stride 
-    out = np.zeros((N, C, H_out, W_out))
+    H_out = 1 + (H - pool_height) // stride
+    W_out = 1 + (W - pool_width) // stride
+    out = np.zeros((N, C, H_out, W_out), dtype=x.dtype)
 
     for i in range(0, N):
         x_data = x[i]
@@ -555,8 +677,6 @@ def max_pool_backward_naive(dout, cache):
     stride = pool_param['stride']
 
     dx = np.zeros((N, C, H, W))
-    H_out = 1 + (H - pool_height) / stride
-    W_out = 1 + (W - pool_width) / stride
 
     for i in range(0, N):
         x_data = x[i]
@@ -698,39 +818,150 @@ def svm_loss(x, y):
     - dx: Gradient of the loss with respect to x
     """
     N = x.shape[0]
-    correct_class_scores = x[np.arange(N), y]
-    margins = np.maximum(0, x - correct_class_scores[:, np.newaxis] + 1.0)
-    margins[np.arange(N), y] = 0
+    rows = np.arange(N)
+    margins = x - x[rows, y][:, np.newaxis]
+    margins += 1.0
+    np.maximum(margins, 0, out=margins)
+    margins[rows, y] = 0
     loss = np.sum(margins) / N
-    num_pos = np.sum(margins > 0, axis=1)
-    dx = np.zeros_like(x)
-    dx[margins > 0] = 1
-    dx[np.arange(N), y] -= num_pos
+    positive = margins > 0
+    dx = positive.astype(x.dtype)
+    dx[rows, y] -= np.sum(positive, axis=1)
     dx /= N
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, class_weights=None, label_smoothing=0.0, out=None):
     """
     Computes the loss and gradient for softmax classification.
 
+    The log-sum-exp is computed once and the gradient is written in place into
+    a single (N, C) buffer, which can be passed in as out to be reused across
+    calls.
+
     Inputs:
     - x: Input data, of shape (N, C) where x[i, j] is the score for the jth
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - class_weights: Optional array of shape (C,). The loss of x[i] is weighted
+      by class_weights[y[i]], and the loss is normalized by the total weight
+      of the minibatch instead of N.
+    - label_smoothing: Scalar eps; the target distribution puts 1 - eps + eps / C
+      on the correct class and eps / C on every other class.
+    - out: Optional array of shape (N, C) with the dtype of x that dx is
+      written into.
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dx: Gradient of the loss with respect to x
+    """
+    N, C = x.shape
+    rows = np.arange(N)
+    dx = np.empty_like(x) if out is None else out
+
+    np.subtract(x, np.max(x, axis=1, keepdims=True), out=dx)
+    correct_logits = dx[rows, y]
+    if label_smoothing:
+        mean_logits = np.mean(dx, axis=1)
+    np.exp(dx, out=dx)
+    Z = np.sum(dx, axis=1)
+    log_Z = np.log(Z)
+
+    sample_loss = log_Z - correct_logits
+    if label_smoothing:
+        sample_loss *= 1 - label_smoothing
+        sample_loss += label_smoothing * (log_Z - mean_logits)
+
+    # Scale of each row of the gradient: 1 / N, or the normalized class weight
+    if class_weights is None:
+        loss = np.sum(sample_loss) / N
+        row_scale = np.full(N, 1.0 / N)
+    else:
+        weights = np.asarray(class_weights)[y]
+        total = np.sum(weights)
+        loss = np.dot(weights, sample_loss) / total
+        row_scale = weights / total
+
+    # dx = row_scale * (probs - targets)
+    dx *= (row_scale / Z)[:, np.newaxis]
+    dx[rows, y] -= (1 - label_smoothing) * row_scale
+    if label_smoothing:
+        dx -= (label_smoothing / C) * row_scale[:, np.newaxis]
+    return loss, dx
+
+
+def distillation_loss(x, y, teacher_scores, temperature=4.0, alpha=0.5,
+                      out=None, **softmax_kwargs):
+    """
+    Computes the knowledge distillation loss of Hinton et al. (2015) and its
+    gradient: a mix of the softmax loss on the labels and the KL divergence
+    between the teacher's and the student's class distributions at a raised
+    temperature T,
+
+    loss = (1 - alpha) * softmax_loss(x, y)
+           + alpha * T**2 * mean_i KL(softmax(t_i / T) || softmax(x_i / T))
+
+    The factor T**2 keeps the gradient of the second term on the same scale as
+    the first for any temperature.
+
+    Inputs:
+    - x: Student scores, of shape (N, C)
+    - y: Vector of labels, of shape (N,)
+    - teacher_scores: Teacher scores, of shape (N, C)
+    - temperature: Scalar temperature T
+    - alpha: Weight of the distillation term, between 0 and 1
+    - out: Optional array of shape (N, C) with the dtype of x that dx is
+      written into.
+    - softmax_kwargs: class_weights and label_smoothing for softmax_loss.
 
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    shifted_logits = x - np.max(x, axis=1, keepdims=True)
-    Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-    log_probs = shifted_logits - np.log(Z)
-    probs = np.exp(log_probs)
     N = x.shape[0]
-    loss = -np.sum(log_probs[np.arange(N), y]) / N
-    dx = probs.copy()
-    dx[np.arange(N), y] -= 1
-    dx /= N
+    T = temperature
+    hard_loss, dx = softmax_loss(x, y, out=out, **softmax_kwargs)
+    dx *= 1 - alpha
+
+    def log_softmax(scores):
+        shifted = scores / T
+        shifted -= np.max(shifted, axis=1, keepdims=True)
+        shifted -= np.log(np.sum(np.exp(shifted), axis=1, keepdims=True))
+        return shifted
+
+    log_p_student = log_softmax(x)
+    log_p_teacher = log_softmax(teacher_scores.astype(x.dtype, copy=False))
+    p_teacher = np.exp(log_p_teacher)
+    soft_loss = np.sum(p_teacher * (log_p_teacher - log_p_student)) / N
+
+    # d/dx of T**2 * KL = T * (p_student - p_teacher)
+    dx += (alpha * T / N) * (np.exp(log_p_student) - p_teacher)
+    loss = (1 - alpha) * hard_loss + alpha * T * T * soft_loss
     return loss, dx
+
+
+def softmax_loss_topk(x, y, k=1):
+    """
+    Computes the softmax loss and top-k accuracy for evaluation, without any of
+    the gradient work of softmax_loss.
+
+    Inputs:
+    - x: Input data, of shape (N, C)
+    - y: Vector of labels, of shape (N,)
+    - k: Number of highest-scoring classes that count as a correct prediction
+
+    Returns a tuple of:
+    - loss: Scalar giving the mean softmax loss
+    - acc: Fraction of inputs whose label is among the k highest scores
+    """
+    N, C = x.shape
+    rows = np.arange(N)
+    x_max = np.max(x, axis=1)
+    log_Z = np.log(np.sum(np.exp(x - x_max[:, np.newaxis]), axis=1)) + x_max
+    loss = np.mean(log_Z - x[rows, y])
+
+    # The label is in the top k iff fewer than k classes score strictly higher
+    num_higher = np.sum(x > x[rows, y][:, np.newaxis], axis=1)
+    acc = np.mean(num_higher < k)
+    return loss, acc
@@ -0,0 +1,138 @@
+from __future__ import print_function, division
+import copy
+import time
+
+import numpy as np
+
+from NN.solver import Solver
+
+"""
+This file implements compression of the affine layers of a trained
+FullyConnectedNet by truncated SVD.
+
+The weight matrix W of shape (D, M) of a layer is replaced by the factors
+U = U_r * sqrt(s_r) of shape (D, r) and V = sqrt(s_r) * V_r of shape (r, M),
+where s_r are the r largest singular values, which turns the layer into a
+factorized layer (see the ranks option of FullyConnectedNet). The rank can be
+given directly or chosen as the smallest rank that keeps a fraction energy of
+the squared singular values. A compressed model can be fine-tuned with the
+Solver like any other model.
+
+Example usage:
+
+small = compress_affine(model, layer=1, energy=0.9, data=data,
+                        fine_tune_epochs=1, update_rule='adam')
+report = rank_tradeoff(model, data, ranks=(8, 16, 32, 64))
+"""
+
+
+def rank_for_energy(s, energy):
+    """
+    Smallest rank r such that the r largest singular values s (sorted in
+    decreasing order) hold at least the fraction energy of sum(s ** 2).
+    """
+    cumulative = np.cumsum(s ** 2) / np.sum(s ** 2)
+    return int(min(np.searchsorted(cumulative, energy) + 1, s.size))
+
+
+def compress_affine(model, layer=1, rank=None, energy=None, data=None,
+                    fine_tune_epochs=0, **solver_kwargs):
+    """
+    Return a copy of a FullyConnectedNet in which the weight matrix of one
+    affine layer is factorized by truncated SVD.
+
+    Inputs:
+    - model: A FullyConnectedNet; it is not modified.
+    - layer: Number of the layer to compress, counting from 1.
+    - rank: Rank of the factorization. Exactly one of rank and energy must be
+      given.
+    - energy: Fraction of the squared singular values to keep, e.g. 0.9.
+    - data: Dictionary of data in the format used by Solver; required for
+      fine-tuning.
+    - fine_tune_epochs: If positive, train the compressed model for this many
+      epochs with a Solver built with solver_kwargs.
+
+    Returns:
+    - The compressed model.
+    """
+    if (rank is None) == (energy is None):
+        raise ValueError('Pass exactly one of rank and energy')
+    if layer in model.ranks:
+        raise ValueError('Layer %d is already factorized' % layer)
+    if model.sparse_input and layer == 1:
+        raise ValueError('The first layer of a sparse_input model cannot be '
+                         'factorized')
+
+    W = model.affine_weight(layer)
+    u, s, vt = np.linalg.svd(W.astype(np.float64), full_matrices=False)
+    if rank is None:
+        rank = rank_for_energy(s, energy)
+    rank = min(rank, s.size)
+    root = np.sqrt(s[:rank])
+
+    compressed = copy.deepcopy(model)
+    W_name = model.weight_names[layer][0]
+    del compressed.params[W_name]
+    compressed.params['U%d' % layer] = (u[:, :rank] * root).astype(W.dtype)
+    compressed.params['V%d' % layer] = (root[:, np.newaxis] *
+                                        vt[:rank]).astype(W.dtype)
+    compressed.ranks[layer] = rank
+    compressed.weight_names[layer] = ('U%d' % layer, 'V%d' % layer)
+
+    if fine_tune_epochs > 0:
+        if data is None:
+            raise ValueError('Fine-tuning requires data')
+        solver_kwargs.setdefault('verbose', False)
+        solver = Solver(compressed, data, num_epochs=fine_tune_epochs,
+                        **solver_kwargs)
+        solver.train()
+    return compressed
+
+
+def rank_tradeoff(model, data, layer=1, ranks=(8, 16, 32, 64),
+                  fine_tune_epochs=0, verbose=True, **solver_kwargs):
+    """
+    Compress one layer of a trained FullyConnectedNet at several ranks and
+    report the trade-off between size, speed and accuracy on the validation
+    set.
+
+    Returns a dictionary mapping each rank (None for the original model) to a
+    dictionary with the number of parameters of the layer, the fraction of
+    the squared singular values kept, the validation accuracy and the best
+    time of a test-time forward pass over the validation set in seconds.
+    """
+    X_val, y_val = data['X_val'], data['y_val']
+    s = np.linalg.svd(model.affine_weight(layer).astype(np.float64),
+                      compute_uv=False)
+
+    def evaluate(m, repeats=3):
+        elapsed = float('inf')
+        for _ in range(repeats):
+            start = time.time()
+            scores = m.loss(X_val)
+            elapsed = min(elapsed, time.time() - start)
+        return np.mean(np.argmax(scores, axis=1) == y_val), elapsed
+
+    D, M = model.affine_weight(layer).shape
+    acc, elapsed = evaluate(model)
+    results = {None: {'num_params': D * M, 'energy': 1.0, 'val_acc': acc,
+                      'time': elapsed}}
+    for rank in ranks:
+        compressed = compress_affine(model, layer, rank=rank, data=data,
+                                     fine_tune_epochs=fine_tune_epochs,
+                                     **solver_kwargs)
+        acc, elapsed = evaluate(compressed)
+        results[rank] = {
+            'num_params': rank * (D + M),
+            'energy': np.sum(s[:rank] ** 2) / np.sum(s ** 2),
+            'val_acc': acc,
+            'time': elapsed,
+        }
+
+    if verbose:
+        for rank, r in results.items():
+            print('rank %-5s params: %8d  energy: %.3f  val_acc: %f  '
+                  'time: %.2f ms' % (rank if rank is not None else 'full',
+                                     r['num_params'], r['energy'],
+                                     r['val_acc'], 1000 * r['time']))
+    return results
@@ -0,0 +1,175 @@
+from __future__ import division
+import math
+
+"""
+This file implements learning rate schedules for the Solver. A schedule maps
+the iteration number to the learning rate that all update rules read for that
+iteration. Every schedule has the same interface:
+
+schedule.reset(base_lr, num_iterations, iterations_per_epoch)
+  Called by Solver.train() before the first iteration with the learning rate
+  from optim_config and the length of the run.
+
+schedule(t) -> learning rate for iteration t (counting from 0)
+
+schedule.observe(val_acc)
+  Called by the Solver after every validation; only ReduceOnPlateau uses it.
+
+Schedules can be combined with Warmup, which ramps the learning rate linearly
+from zero over the first iterations before handing over to another schedule:
+
+Solver(model, data, lr_schedule=Warmup(CosineDecay(), warmup_epochs=1), ...)
+"""
+
+
+class Schedule(object):
+    """
+    Base class of the learning rate schedules; a constant learning rate.
+    """
+
+    def reset(self, base_lr, num_iterations, iterations_per_epoch):
+        self.base_lr = base_lr
+        self.num_iterations = num_iterations
+        self.iterations_per_epoch = iterations_per_epoch
+
+    def __call__(self, t):
+        return self.base_lr
+
+    def observe(self, val_acc):
+        pass
+
+
+class ExponentialDecay(Schedule):
+    """
+    Multiply the learning rate by decay at the end of every epoch. This is the
+    behavior of the Solver's lr_decay option.
+    """
+
+    def __init__(self, decay):
+        self.decay = decay
+
+    def __call__(self, t):
+        return self.base_lr * self.decay ** (t // self.iterations_per_epoch)
+
+
+class StepDecay(Schedule):
+    """
+    Multiply the learning rate by gamma every step_epochs epochs.
+    """
+
+    def __init__(self, step_epochs, gamma=0.1):
+        self.step_epochs = step_epochs
+        self.gamma = gamma
+
+    def __call__(self, t):
+        epoch = t // self.iterations_per_epoch
+        return self.base_lr * self.gamma ** (epoch // self.step_epochs)
+
+
+class CosineDecay(Schedule):
+    """
+    Anneal the learning rate from its base value to min_lr along half a cosine
+    over the whole run.
+    """
+
+    def __init__(self, min_lr=0.0):
+        self.min_lr = min_lr
+
+    def __call__(self, t):
+        progress = t / max(self.num_iterations - 1, 1)
+        cosine = 0.5 * (1 + math.cos(math.pi * progress))
+        return self.min_lr + (self.base_lr - self.min_lr) * cosine
+
+
+class OneCycle(Schedule):
+    """
+    The one-cycle policy: ramp up from max_lr / div_factor to max_lr over the
+    first pct_start of the run, then anneal with a cosine to
+    max_lr / (div_factor * final_div_factor). If max_lr is None the learning
+    rate from optim_config is used as the peak.
+    """
+
+    def __init__(self, max_lr=None, pct_start=0.3, div_factor=25.0,
+                 final_div_factor=1e4):
+        self.max_lr = max_lr
+        self.pct_start = pct_start
+        self.div_factor = div_factor
+        self.final_div_factor = final_div_factor
+
+    def __call__(self, t):
+        max_lr = self.base_lr if self.max_lr is None else self.max_lr
+        start_lr = max_lr / self.div_factor
+        final_lr = start_lr / self.final_div_factor
+        peak = max(int(self.pct_start * self.num_iterations), 1)
+        if t < peak:
+            return start_lr + (max_lr - start_lr) * t / peak
+        progress = (t - peak) / max(self.num_iterations - 1 - peak, 1)
+        cosine = 0.5 * (1 + math.cos(math.pi * min(progress, 1.0)))
+        return final_lr + (max_lr - final_lr) * cosine
+
+
+class Warmup(Schedule):
+    """
+    Increase the learning rate linearly from zero over the first
+    warmup_iterations (or warmup_epochs) iterations, then follow schedule.
+    The wrapped schedule sees iteration numbers counted from the start of the
+    run.
+    """
+
+    def __init__(self, schedule=None, warmup_iterations=None, warmup_epochs=None):
+        if (warmup_iterations is None) == (warmup_epochs is None):
+            raise ValueError('Pass exactly one of warmup_iterations and '
+                             'warmup_epochs')
+        self.schedule = schedule if schedule is not None else Schedule()
+        self.warmup_iterations = warmup_iterations
+        self.warmup_epochs = warmup_epochs
+
+    def reset(self, base_lr, num_iterations, iterations_per_epoch):
+        super(Warmup, self).reset(base_lr, num_iterations, iterations_per_epoch)
+        self.schedule.reset(base_lr, num_iterations, iterations_per_epoch)
+        if self.warmup_epochs is not None:
+            self.warmup_iterations = int(self.warmup_epochs *
+                                         iterations_per_epoch)
+
+    def __call__(self, t):
+        lr = self.schedule(t)
+        if t < self.warmup_iterations:
+            lr *= (t + 1) / self.warmup_iterations
+        return lr
+
+    def observe(self, val_acc):
+        self.schedule.observe(val_acc)
+
+
+class ReduceOnPlateau(Schedule):
+    """
+    Multiply the learning rate by factor whenever the validation accuracy has
+    not improved by more than threshold for patience validations, without
+    going below min_lr.
+    """
+
+    def __init__(self, factor=0.5, patience=2, threshold=1e-4, min_lr=0.0):
+        self.factor = factor
+        self.patience = patience
+        self.threshold = threshold
+        self.min_lr = min_lr
+
+    def reset(self, base_lr, num_iterations, iterations_per_epoch):
+        super(ReduceOnPlateau, self).reset(base_lr, num_iterations,
+                                           iterations_per_epoch)
+        self.lr = base_lr
+        self.best = -float('inf')
+        self.num_bad = 0
+
+    def __call__(self, t):
+        return self.lr
+
+    def observe(self, val_acc):
+        if val_acc > self.best + self.threshold:
+            self.best = val_acc
+            self.num_bad = 0
+            return
+        self.num_bad += 1
+        if self.num_bad > self.patience:
+            self.lr = max(self.lr * self.factor, self.min_lr)
+            self.num_bad = 0
@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+
+"""
+This file implements memory-bounded metric histories for the Solver.
+
+A RingBuffer keeps the most recent values of a metric in a preallocated numpy
+array. A MetricLog combines a RingBuffer of recent values with downsampled
+aggregates (mean, min, max and an exponential moving average per window of
+values) and can stream every value to an append-only binary file of float64
+values, which load_metric_file() reads back. The memory used by a MetricLog is
+fixed no matter how long training runs, and pickles only hold the entries
+actually stored.
+"""
+
+
+class RingBuffer(object):
+    """
+    A fixed-capacity buffer of numbers (or rows of numbers) in a preallocated
+    numpy array. Once full, every append overwrites the oldest entry.
+
+    Indexing, len() and np.asarray() see the stored entries from oldest to
+    newest, so a RingBuffer can be used in place of a list for reading and
+    plotting. Pickling stores only the entries, not the preallocated array.
+    """
+
+    def __init__(self, capacity, shape=(), dtype=np.float64):
+        self.capacity = capacity
+        self.data = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.count % self.capacity] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def to_array(self):
+        """
+        Copy of the stored entries from oldest to newest.
+        """
+        if self.count <= self.capacity:
+            return self.data[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate([self.data[start:], self.data[:start]])
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_array()[index]
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('RingBuffer index out of range')
+        return self.data[(self.count - n + index) % self.capacity]
+
+    def __iter__(self):
+        return iter(self.to_array())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = self.to_array()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._restore(self.data)
+
+    def _restore(self, values):
+        """
+        Rebuild the preallocated array from the entries values, from oldest
+        to newest.
+        """
+        data = np.zeros((self.capacity,) + values.shape[1:], dtype=values.dtype)
+        positions = np.arange(self.count - len(values), self.count)
+        data[positions % self.capacity] = values
+        self.data = data
+
+
+class MetricLog(RingBuffer):
+    """
+    History of a scalar metric such as the training loss.
+
+    The most recent capacity values are kept as a RingBuffer. Every window
+    values, one row of aggregates (last step, mean, min, max, EMA) is appended
+    to self.aggregates, a RingBuffer of the same capacity, so the aggregates
+    cover window times more steps than the raw values. If filename is given,
+    every value is also appended to that file in batches of window values,
+    after any values already in it.
+
+    A pickled MetricLog with a filename stores only its aggregates and reads
+    its recent values back from the file when it is unpickled; values appended
+    after pickling are ignored. If the file is gone or shorter by then, the
+    aggregates and EMA are kept and the missing values read as NaN.
+    """
+
+    AGGREGATE_FIELDS = ('step', 'mean', 'min', 'max', 'ema')
+
+    def __init__(self, capacity=10000, window=100, ema_decay=0.99,
+                 filename=None):
+        super(MetricLog, self).__init__(capacity)
+        self.window = window
+        self.ema_decay = ema_decay
+        self.ema = None
+        self.aggregates = RingBuffer(capacity, shape=(len(self.AGGREGATE_FIELDS),))
+        # Absolute, so that unpickling from another directory finds the file
+        self.filename = filename and os.path.abspath(filename)
+        self._pending = []
+        self._reset_window()
+        # Number of values in the file before this log, which are not its own;
+        # the file is appended to, not truncated, so that the checkpoints of
+        # earlier runs still find their values
+        self._offset = 0
+        if filename is not None and os.path.exists(self.filename):
+            self._offset = os.path.getsize(self.filename) // 8
+
+    def _reset_window(self):
+        self._sum = 0.0
+        self._min = float('inf')
+        self._max = -float('inf')
+        self._n = 0
+
+    def append(self, value):
+        value = float(value)
+        super(MetricLog, self).append(value)
+        if self.ema is None:
+            self.ema = value
+        else:
+            self.ema = self.ema_decay * self.ema + (1 - self.ema_decay) * value
+
+        self._sum += value
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+        self._n += 1
+        if self.filename is not None:
+            self._pending.append(value)
+        if self._n == self.window:
+            self.aggregates.append((self.count - 1, self._sum / self._n,
+                                    self._min, self._max, self.ema))
+            self._reset_window()
+            self.flush()
+
+    def aggregate(self, field):
+        """
+        Array of one aggregate field ('step', 'mean', 'min', 'max' or 'ema')
+        over the stored windows.
+        """
+        return self.aggregates.to_array()[:, self.AGGREGATE_FIELDS.index(field)]
+
+    def flush(self):
+        """
+        Append the values not yet written to the file.
+        """
+        if self.filename is None or not self._pending:
+            return
+        with open(self.filename, 'ab') as f:
+            np.asarray(self._pending, dtype=np.float64).tofile(f)
+        self._pending = []
+
+    def __getstate__(self):
+        self.flush()
+        state = super(MetricLog, self).__getstate__()
+        if self.filename is not None:
+            # The values are in the file; keep only the aggregates and EMA
+            state['data'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.data is not None:
+            self._restore(self.data)
+            return
+        n = len(self)
+        recent = np.full(n, np.nan)
+        if os.path.exists(self.filename):
+            values = load_metric_file(self.filename)
+            end = self._offset + self.count
+            found = values[end - n:end]
+            recent[:len(found)] = found
+        self._restore(recent)
+
+
+def load_metric_file(filename):
+    """
+    Read all values streamed to filename by a MetricLog.
+    """
+    return np.fromfile(filename, dtype=np.float64)
@@ -0,0 +1,266 @@
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+"""
+This file implements an opt-in profiler for the layer functions and the Solver.
+
+While a Profiler is enabled, every public function defined in layers.py,
+fast_layers.py and layer_utils.py is replaced, in every loaded module of this
+package, by a wrapper that records its wall time, an estimate of its floating
+point operations, the bytes of the new arrays it returns and its call count.
+Disabling the profiler restores the original functions, so there is no
+overhead at all when profiling is off. The Solver records its own stages
+(loss, update, check_accuracy, ...) through Profiler.region().
+
+Example usage:
+
+profiler = Profiler(trace_file='trace.json')
+solver = Solver(model, data, profiler=profiler)
+solver.train()   # prints the table and writes the trace at the end
+
+or, around arbitrary code:
+
+with Profiler() as profiler:
+    model.loss(X, y)
+profiler.print_report()
+
+The trace can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+_PACKAGE = __name__.rpartition('.')[0]
+_PROFILED_MODULES = tuple('%s.%s' % (_PACKAGE, m)
+                          for m in ('layers', 'fast_layers', 'layer_utils'))
+
+
+def _affine_flops(x, w):
+    return 2 * x.shape[0] * w.shape[0] * w.shape[1]
+
+
+def _conv_flops(out, w):
+    return 2 * out.size * np.prod(w.shape[1:])
+
+
+def _estimate_flops(name, args, result):
+    """
+    Rough floating point operation count of a call to the layer function name.
+    Matrix products are counted exactly; elementwise layers are counted as a
+    few operations per element of their first array argument.
+    """
+    try:
+        if name in ('affine_forward', 'affine_relu_forward'):
+            return _affine_flops(args[0], args[1])
+        if name in ('affine_backward', 'affine_relu_backward'):
+            cache = args[1][0] if name == 'affine_relu_backward' else args[1]
+            return 2 * _affine_flops(cache[0], cache[1])
+        if name.startswith('conv_forward'):
+            return _conv_flops(result[0], args[1])
+        if name.startswith('conv_backward'):
+            return 2 * _conv_flops(args[0], args[1][1])
+        if 'batchnorm' in name or 'layernorm' in name or 'loss' in name:
+            return 10 * args[0].size
+        return args[0].size
+    except (AttributeError, IndexError, TypeError):
+        return 0
+
+
+def _nbytes(obj, exclude=(), seen=None, depth=0):
+    """
+    Total bytes of the distinct numpy arrays reachable through nested tuples,
+    lists and dicts, skipping arrays whose id is in exclude.
+    """
+    if seen is None:
+        seen = set(exclude)
+    if isinstance(obj, np.ndarray):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        return obj.nbytes
+    if depth > 4:
+        return 0
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(o, exclude, seen, depth + 1) for o in obj)
+    return 0
+
+
+def _peak_memory(fn, *args):
+    """
+    Call fn(*args) and return its result together with the peak number of
+    bytes allocated during the call, as tracked by tracemalloc. If tracing is
+    already on, it is left on.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        result = fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return result, peak - base
+
+
+class Profiler(object):
+    """
+    Records wall time, estimated FLOPs, bytes allocated and call counts of the
+    layer functions and of named regions.
+
+    The statistics of each function or region are kept in self.stats, a
+    dictionary mapping names to dictionaries with the keys 'calls', 'time'
+    (inclusive seconds), 'self_time' (seconds excluding profiled calls made
+    from inside), 'flops' and 'bytes'.
+    """
+
+    def __init__(self, trace_file=None, max_events=1000000):
+        """
+        Inputs:
+        - trace_file: If not None, Solver.train() writes a Chrome trace here at
+          the end of the run.
+        - max_events: Maximum number of trace events kept in memory.
+        """
+        self.trace_file = trace_file
+        self.max_events = max_events
+        self.enabled = False
+        self._originals = []
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        self.events = []
+        self._stack = []
+        self._start = time.perf_counter()
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def enable(self):
+        """
+        Replace the layer functions in every loaded module of the package by
+        profiled wrappers.
+        """
+        if self.enabled:
+            return
+        wrappers = {}
+        for module_name, module in list(sys.modules.items()):
+            if module is None or not module_name.startswith(_PACKAGE + '.'):
+                continue
+            for attr, fn in list(vars(module).items()):
+                if (not callable(fn) or attr.startswith('_') or
+                        getattr(fn, '__module__', None) not in _PROFILED_MODULES):
+                    continue
+                if fn not in wrappers:
+                    wrappers[fn] = self._wrap(fn)
+                self._originals.append((module, attr, fn))
+                setattr(module, attr, wrappers[fn])
+        self.enabled = True
+
+    def disable(self):
+        """
+        Restore the original layer functions.
+        """
+        for module, attr, fn in self._originals:
+            setattr(module, attr, fn)
+        self._originals = []
+        self.enabled = False
+
+    def _wrap(self, fn):
+        name = fn.__name__
+        profiler = self
+
+        def wrapper(*args, **kwargs):
+            profiler._push()
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                profiler._stack.pop()
+                raise
+            elapsed = time.perf_counter() - start
+            flops = _estimate_flops(name, args, result)
+            nbytes = _nbytes(result, exclude=[id(a) for a in args])
+            profiler._record(name, 'layer', start, elapsed, flops, nbytes)
+            return result
+
+        wrapper.__name__ = name
+        wrapper.__doc__ = fn.__doc__
+        wrapper.__wrapped__ = fn
+        return wrapper
+
+    @contextmanager
+    def region(self, name):
+        """
+        Context manager recording the code inside as the region name.
+        """
+        self._push()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, 'solver', start, time.perf_counter() - start,
+                         0, 0)
+
+    def _push(self):
+        self._stack.append(0.0)
+
+    def _record(self, name, category, start, elapsed, flops, nbytes):
+        child_time = self._stack.pop()
+        if self._stack:
+            self._stack[-1] += elapsed
+        s = self.stats.get(name)
+        if s is None:
+            s = self.stats[name] = {'calls': 0, 'time': 0.0, 'self_time': 0.0,
+                                    'flops': 0, 'bytes': 0}
+        s['calls'] += 1
+        s['time'] += elapsed
+        s['self_time'] += elapsed - child_time
+        s['flops'] += flops
+        s['bytes'] += nbytes
+        if len(self.events) < self.max_events:
+            self.events.append((name, category, start, elapsed, flops, nbytes))
+
+    def print_report(self, sort_by='self_time'):
+        """
+        Print one row per profiled function or region, sorted by sort_by.
+        """
+        total = sum(s['self_time'] for s in self.stats.values()) or 1.0
+        print('%-28s %8s %10s %10s %6s %10s %10s' % (
+              'name', 'calls', 'time (s)', 'self (s)', 'self%', 'GFLOP/s',
+              'MB'))
+        rows = sorted(self.stats.items(), key=lambda kv: -kv[1][sort_by])
+        for name, s in rows:
+            gflops = s['flops'] / s['time'] / 1e9 if s['time'] > 0 else 0.0
+            print('%-28s %8d %10.4f %10.4f %6.1f %10.2f %10.1f' % (
+                  name, s['calls'], s['time'], s['self_time'],
+                  100 * s['self_time'] / total, gflops, s['bytes'] / 2.0**20))
+
+    def export_chrome_trace(self, filename=None):
+        """
+        Write the recorded events in the Chrome trace event format.
+        """
+        filename = filename or self.trace_file
+        pid = os.getpid()
+        events = []
+        for name, category, start, elapsed, flops, nbytes in self.events:
+            events.append({
+                'name': name, 'cat': category, 'ph': 'X', 'pid': pid,
+                'tid': 0, 'ts': 1e6 * (start - self._start),
+                'dur': 1e6 * elapsed,
+                'args': {'flops': flops, 'bytes': nbytes},
+            })
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,217 @@
+from __future__ import print_function, division
+import numpy as np
+
+from NN.quantize import fold_batchnorm
+
+"""
+This file implements magnitude pruning of the weight matrices of a model and
+a sparse inference path for pruned FullyConnectedNets.
+
+A MagnitudePruner is passed to the Solver, which calls it after every update:
+
+pruner = MagnitudePruner(sparsity=0.9, end_epoch=8)
+solver = Solver(model, data, pruner=pruner, num_epochs=10)
+solver.train()
+
+Every frequency iterations between start_epoch and end_epoch, counted from
+the start of each Solver.train() (see MagnitudePruner.reset), the pruner
+raises the sparsity of each pruned matrix along the cubic schedule of Zhu and
+Gupta (2017) and recomputes its mask by zeroing the entries of smallest
+magnitude; after every update the masks are applied in place, so pruned
+weights stay at zero.
+
+After training, to_csr exports the pruned matrices as scipy.sparse CSR
+matrices and SparseFCNet runs inference with sparse-dense products for the
+layers whose density is below a threshold. scipy is only imported by these
+two.
+"""
+
+
+# Prefixes of the weight matrices: dense 'W' and the low-rank factors 'U', 'V'
+_WEIGHT_PREFIXES = ('W', 'U', 'V')
+
+
+def _weight_names(params):
+    """
+    Sorted names of the weight matrices in params.
+    """
+    return [p for p in sorted(params) if p.startswith(_WEIGHT_PREFIXES)]
+
+
+class MagnitudePruner(object):
+    """
+    Iterative magnitude pruning of model parameters.
+
+    After reset() has been called, masks maps the name of every pruned
+    parameter to a boolean array of the entries that are kept.
+    """
+
+    def __init__(self, sparsity, params=None, start_epoch=0, end_epoch=None,
+                 frequency=100):
+        """
+        Inputs:
+        - sparsity: Final fraction of zeros in each pruned parameter.
+        - params: Names of the parameters to prune; the default is every
+          weight matrix, i.e. every parameter whose name starts with 'W', or
+          with 'U' or 'V' for the factors of low-rank layers.
+        - start_epoch: Epoch at which pruning starts.
+        - end_epoch: Epoch at which the final sparsity is reached; the default
+          is three quarters of the run, which leaves time to recover.
+        - frequency: Number of iterations between mask updates.
+        """
+        if not 0 <= sparsity < 1:
+            raise ValueError('sparsity must be in [0, 1)')
+        self.sparsity = sparsity
+        self.params = params
+        self.start_epoch = start_epoch
+        self.end_epoch = end_epoch
+        self.frequency = frequency
+        self.masks = {}
+        self.num_steps = 0
+
+    def reset(self, params, num_iterations, iterations_per_epoch):
+        """
+        Called by Solver.train() before the first iteration. The schedule
+        starts again from iteration 0 with every entry kept.
+        """
+        names = self.params
+        if names is None:
+            names = _weight_names(params)
+        self.masks = {p: np.ones(params[p].shape, dtype=bool) for p in names}
+        self.num_steps = 0
+        self.start = int(self.start_epoch * iterations_per_epoch)
+        if self.end_epoch is None:
+            self.end = int(0.75 * num_iterations)
+        else:
+            self.end = int(self.end_epoch * iterations_per_epoch)
+        self.end = max(self.end, self.start + 1)
+
+    def target_sparsity(self, t):
+        """
+        Sparsity of the pruned parameters at iteration t.
+        """
+        if t < self.start:
+            return 0.0
+        progress = min((t - self.start) / (self.end - self.start), 1.0)
+        return self.sparsity * (1 - (1 - progress) ** 3)
+
+    def update_masks(self, params, sparsity):
+        """
+        Recompute the masks so that the fraction sparsity of the entries of
+        each pruned parameter, those of smallest magnitude, are removed.
+        """
+        for p, mask in self.masks.items():
+            w = np.abs(params[p]).ravel()
+            k = int(sparsity * w.size)
+            if k == 0:
+                continue
+            threshold = np.partition(w, k - 1)[k - 1]
+            np.greater(np.abs(params[p]), threshold, out=mask)
+
+    def apply(self, params):
+        """
+        Zero the pruned entries of params in place.
+        """
+        for p, mask in self.masks.items():
+            params[p] *= mask
+
+    def step(self, params):
+        """
+        Called by the Solver after every update: update the masks if this is a
+        pruning iteration, then apply them.
+        """
+        t = self.num_steps
+        self.num_steps += 1
+        if t == self.end or (self.start <= t < self.end and
+                             (t - self.start) % self.frequency == 0):
+            self.update_masks(params, self.target_sparsity(t))
+        self.apply(params)
+
+    def density(self):
+        """
+        Dictionary mapping each pruned parameter to its fraction of nonzeros.
+        """
+        return {p: mask.mean() for p, mask in self.masks.items()}
+
+
+def to_csr(params, names=None):
+    """
+    Export weight matrices as scipy.sparse CSR matrices.
+
+    Inputs:
+    - params: Dictionary of parameters, e.g. model.params.
+    - names: Names of the matrices to export; default is every weight matrix,
+      as for MagnitudePruner.
+
+    Returns:
+    - A dictionary mapping names to csr_matrix.
+    """
+    from scipy import sparse
+
+    if names is None:
+        names = _weight_names(params)
+    return {p: sparse.csr_matrix(params[p]) for p in names}
+
+
+class SparseFCNet(object):
+    """
+    Inference version of a pruned FullyConnectedNet. Batch normalization is
+    folded into the weights, and every layer whose weight density is below
+    density_threshold is stored as a CSR matrix of W.T and applied with a
+    sparse-dense product; the other layers stay dense. On a single core the
+    sparse product only beats BLAS below a density of about 0.1 (see
+    benchmark.benchmark_pruning).
+    """
+
+    def __init__(self, model, density_threshold=0.1, dtype=np.float32):
+        from scipy import sparse
+
+        self.dtype = dtype
+        self.layers = []
+        for W, b in fold_batchnorm(model):
+            density = np.count_nonzero(W) / W.size
+            if density < density_threshold:
+                # CSR of W.T: one row per output unit
+                W = sparse.csr_matrix(W.T.astype(dtype))
+                self.layers.append((True, W, b.astype(dtype)))
+            else:
+                self.layers.append((False, W.astype(dtype), b.astype(dtype)))
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of the stored weights and biases.
+        """
+        total = 0
+        for is_sparse, W, b in self.layers:
+            if is_sparse:
+                total += W.data.nbytes + W.indices.nbytes + W.indptr.nbytes
+            else:
+                total += W.nbytes
+            total += b.nbytes
+        return total
+
+    def loss(self, X, y=None):
+        """
+        Compute classification scores for a minibatch of data.
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+        - y: Must be None; the sparse model only supports inference.
+
+        Returns:
+        - scores: Array of shape (N, C) of classification scores.
+        """
+        if y is not None:
+            raise ValueError('SparseFCNet only supports inference')
+        x = X.reshape(X.shape[0], -1).astype(self.dtype, copy=False)
+        for i, (is_sparse, W, b) in enumerate(self.layers):
+            if is_sparse:
+                out = W.dot(x.T).T
+            else:
+                out = x.dot(W)
+            out += b
+            if i + 1 < len(self.layers):
+                np.maximum(out, 0, out=out)
+            x = out
+        return x
@@ -0,0 +1,304 @@
+from __future__ import print_function, division
+import numpy as np
+
+"""
+This file implements post-training int8 quantization of a trained
+FullyConnectedNet for inference.
+
+Each affine layer is stored as int8 weights with one scale per output unit
+(column of W) and an int32 bias. Batch normalization, which the network applies
+before each hidden affine layer, is folded into W and b first. The input of
+every layer is quantized to int8 with a single scale calibrated on a sample of
+data. A layer multiplies int8 inputs by int8 weights with int32 accumulation,
+and hidden layers requantize the int32 result straight to the int8 input of the
+next layer, clipping at zero so that the ReLU is applied in the same pass.
+
+Example usage:
+
+qmodel = quantize_model(model, data['X_val'][:1000])
+report = evaluate_quantization(model, qmodel, data['X_val'], data['y_val'])
+
+numpy has no integer matrix product, so the int8 products are computed exactly
+by float32 BLAS (see int8_matmul), and the int8 activations are kept in float32
+arrays of integer values. By default only the int8 weights are resident, a
+quarter of the bytes of the float32 model, and each call converts them to
+float32 block by block, which makes inference somewhat slower than with the
+float32 model. quantize_model(..., cache_float_weights=True) converts them
+once instead, which runs at about the speed of the float32 model but holds
+the float32 copies as well (see nbytes): on numpy the format saves memory or
+keeps speed, not both.
+
+A QuantizedFCNet has the test-time half of the model API, so
+solver.check_accuracy and other inference code can use it in place of the
+float model.
+"""
+
+# Products of two int8 values are at most 127 * 127 in magnitude, so sums of
+# up to 1024 of them are below 2**24 and exactly representable in float32.
+_K_BLOCK = 1024
+
+
+def weight_blocks(wq):
+    """
+    float32 copies of the blocks of _K_BLOCK rows of an int8 weight matrix,
+    as used by int8_matmul.
+    """
+    return [wq[k:k + _K_BLOCK].astype(np.float32)
+            for k in range(0, wq.shape[0], _K_BLOCK)]
+
+
+def int8_matmul(xq, wq, blocks=None):
+    """
+    Exact int32 matrix product of int8 arrays.
+
+    numpy has no integer GEMM, so the product is computed with float32 BLAS
+    over blocks of _K_BLOCK rows of wq, each of which is exact, and the blocks
+    are accumulated in int32.
+
+    Inputs:
+    - xq: int8 array of shape (N, D), or float32 array of int8 values
+    - wq: int8 array of shape (D, M)
+    - blocks: Optional result of weight_blocks(wq), to avoid converting wq
+      on every call.
+
+    Returns:
+    - out: int32 array of shape (N, M)
+    """
+    if blocks is None:
+        blocks = weight_blocks(wq)
+    x = xq.astype(np.float32, copy=False)
+    out = None
+    for i, w in enumerate(blocks):
+        block = x[:, i * _K_BLOCK:(i + 1) * _K_BLOCK].dot(w)
+        if out is None:
+            out = block.astype(np.int32)
+        else:
+            out += block.astype(np.int32)
+    return out
+
+
+def _quantize_float(x, scale, out=None):
+    """
+    clip(round(x / scale), -127, 127) as a float32 array.
+    """
+    q = np.multiply(x, 1.0 / scale, out=out, dtype=np.float32,
+                    casting='unsafe')
+    np.rint(q, out=q)
+    np.clip(q, -127, 127, out=q)
+    return q
+
+
+def quantize_symmetric(x, scale, out=None):
+    """
+    Quantize x to int8 as clip(round(x / scale), -127, 127).
+    """
+    return _quantize_float(x, scale, out).astype(np.int8)
+
+
+def _calibrated_scale(x, percentile):
+    """
+    Scale mapping the given percentile of |x| to 127.
+    """
+    bound = np.percentile(np.abs(x), percentile)
+    return max(float(bound), 1e-8) / 127
+
+
+class QuantizedFCNet(object):
+    """
+    Int8 inference version of a FullyConnectedNet, built by quantize_model.
+
+    For layer i (counting from 0) the following are stored:
+    - weights[i]: int8 array of shape (D, M)
+    - biases[i]: int32 array of shape (M,) at scale input_scales[i] * w_scales[i]
+    - input_scales[i]: Scalar scale of the int8 input of the layer
+    - w_scales[i]: float32 array of shape (M,) of per-output-unit scales
+
+    If cache_float_weights is True, float32 copies of the weights are also
+    kept, so that they are not converted on every call.
+    """
+
+    def __init__(self, weights, biases, input_scales, w_scales,
+                 cache_float_weights=False):
+        self.weights = weights
+        self.biases = biases
+        self.input_scales = input_scales
+        self.w_scales = w_scales
+        self.num_layers = len(weights)
+
+        # Multipliers taking the int32 accumulators of a hidden layer to the
+        # scale of the next layer's input, and of the last layer to scores
+        self.multipliers = []
+        for i in range(self.num_layers):
+            acc_scale = input_scales[i] * w_scales[i]
+            if i + 1 < self.num_layers:
+                acc_scale = acc_scale / input_scales[i + 1]
+            self.multipliers.append(acc_scale.astype(np.float32))
+
+        # Every partial sum of a column of x.dot(W) is at most
+        # 127 * sum(|W[:, j]|) in magnitude; when that plus the bias is below
+        # 2**24 the whole layer is exact in float32, and is computed with one
+        # product and no int32 accumulator.
+        self._exact_float = []
+        for w, b in zip(weights, biases):
+            bound = (127 * np.abs(w.astype(np.int64)).sum(axis=0).max() +
+                     np.abs(b.astype(np.int64)).max())
+            self._exact_float.append(bool(bound < 2**24))
+        self._float_biases = [b.astype(np.float32) for b in biases]
+        self._blocks = None
+        if cache_float_weights:
+            self._blocks = [self._float_weights(i)
+                            for i in range(self.num_layers)]
+
+    def _float_weights(self, i):
+        """
+        float32 blocks of the weights of layer i: the whole matrix if the
+        layer is exact in float32, else weight_blocks.
+        """
+        if self._exact_float[i]:
+            return [self.weights[i].astype(np.float32)]
+        return weight_blocks(self.weights[i])
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of the weights, biases and scales resident in memory, including
+        the float32 copies of the weights if they are cached.
+        """
+        arrays = self.weights + self.biases + self.w_scales
+        arrays += self._float_biases
+        if self._blocks is not None:
+            arrays += [w for blocks in self._blocks for w in blocks]
+        return sum(a.nbytes for a in arrays)
+
+    def loss(self, X, y=None):
+        """
+        Compute classification scores for a minibatch of data.
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+        - y: Must be None; a quantized model cannot be trained.
+
+        Returns:
+        - scores: float32 array of shape (N, C) of classification scores.
+        """
+        if y is not None:
+            raise ValueError('QuantizedFCNet only supports inference')
+        N = X.shape[0]
+        # int8 values held in float32
+        xq = _quantize_float(X.reshape(N, -1), self.input_scales[0])
+        for i in range(self.num_layers):
+            if self._blocks is not None:
+                blocks = self._blocks[i]
+            else:
+                blocks = self._float_weights(i)
+            if self._exact_float[i]:
+                out = xq.dot(blocks[0])
+                out += self._float_biases[i]
+            else:
+                acc = int8_matmul(xq, self.weights[i], blocks)
+                acc += self.biases[i]
+                out = acc.astype(np.float32)
+            out *= self.multipliers[i]
+            if i + 1 == self.num_layers:
+                return out
+            # Fused requantize and ReLU
+            np.rint(out, out=out)
+            np.clip(out, 0, 127, out=out)
+            xq = out
+
+
+def fold_batchnorm(model):
+    """
+    List of float64 (W, b) pairs of the affine layers of a trained
+    FullyConnectedNet with batch normalization folded in, for inference.
+    Entries of W that are zero stay zero.
+    """
+    if model.normalization == 'layernorm':
+        raise ValueError('Layer normalization cannot be folded into the '
+                         'weights')
+    layers = []
+    for i in range(1, model.num_layers + 1):
+        _, b_name, gamma_name, beta_name = model.param_names[i]
+        W = model.affine_weight(i).astype(np.float64)
+        b = model.params[b_name].astype(np.float64)
+        if model.normalization == 'batchnorm' and i < model.num_layers:
+            # batchnorm(x) = a * x + c elementwise, so
+            # batchnorm(x).dot(W) + b = x.dot(a[:, None] * W) + c.dot(W) + b
+            bn_param = model.bn_params[i - 1]
+            eps = bn_param.get('eps', 1e-5)
+            a = model.params[gamma_name] / np.sqrt(bn_param['running_var'] + eps)
+            c = model.params[beta_name] - bn_param['running_mean'] * a
+            b = b + c.dot(W)
+            W = a[:, np.newaxis] * W
+        layers.append((W, b))
+    return layers
+
+
+def quantize_model(model, X_calib, percentile=99.99,
+                   cache_float_weights=False):
+    """
+    Quantize a trained FullyConnectedNet to int8.
+
+    Inputs:
+    - model: A trained FullyConnectedNet. Batch normalization must have
+      running statistics, i.e. the model must have been trained.
+    - X_calib: Array of shape (N, d_1, ..., d_k) of calibration data, e.g. a
+      few hundred samples of X_val.
+    - percentile: Percentile of the absolute values of each layer input that
+      is mapped to the largest int8 value; 100 uses the maximum.
+    - cache_float_weights: If True, keep float32 copies of the int8 weights
+      for faster inference at the cost of memory; see QuantizedFCNet.
+
+    Returns:
+    - A QuantizedFCNet.
+    """
+    layers = fold_batchnorm(model)
+    x = X_calib.reshape(X_calib.shape[0], -1).astype(np.float64)
+
+    weights, biases, input_scales, w_scales = [], [], [], []
+    for i, (W, b) in enumerate(layers):
+        s_x = _calibrated_scale(x, percentile)
+        s_w = np.maximum(np.abs(W).max(axis=0), 1e-8) / 127
+        weights.append(np.clip(np.rint(W / s_w), -127, 127).astype(np.int8))
+        biases.append(np.rint(b / (s_x * s_w)).astype(np.int32))
+        input_scales.append(s_x)
+        w_scales.append(s_w.astype(np.float32))
+        # The calibration data of the next layer is the float activation
+        x = np.maximum(x.dot(W) + b, 0)
+
+    return QuantizedFCNet(weights, biases, input_scales, w_scales,
+                          cache_float_weights)
+
+
+def evaluate_quantization(model, qmodel, X, y, batch_size=100, verbose=True):
+    """
+    Compare a float model with its quantized version on held-out data.
+
+    Returns a dictionary with the accuracies of both models, the accuracy
+    drop and the bytes of their weights. The bytes of the float model are
+    counted in its declared dtype, since update rules such as adam may have
+    upcast its params during training.
+    """
+    itemsize = np.dtype(model.dtype).itemsize
+    float_bytes = sum(v.size * itemsize for v in model.params.values())
+
+    def accuracy(m):
+        y_pred = [np.argmax(m.loss(X[i:i + batch_size]), axis=1)
+                  for i in range(0, X.shape[0], batch_size)]
+        return np.mean(np.hstack(y_pred) == y)
+
+    results = {
+        'float_acc': accuracy(model),
+        'int8_acc': accuracy(qmodel),
+        'float_bytes': float_bytes,
+        'int8_bytes': qmodel.nbytes,
+    }
+    results['acc_drop'] = results['float_acc'] - results['int8_acc']
+    results['compression'] = float_bytes / qmodel.nbytes
+    if verbose:
+        print('float acc: %f  int8 acc: %f  drop: %f' % (
+              results['float_acc'], results['int8_acc'], results['acc_drop']))
+        print('weights: %.2f MB -> %.2f MB (%.1fx)' % (
+              float_bytes / 2.0**20, qmodel.nbytes / 2.0**20,
+              results['compression']))
+    return results
@@ -0,0 +1,307 @@
+from __future__ import print_function, division
+import ctypes
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+"""
+This file controls the BLAS threads and the cores used by a process.
+
+numpy runs the matrix products of affine_forward and affine_backward in the
+thread pool of its BLAS library, which by default has one thread per core.
+Several Solvers or inference workers on one machine then oversubscribe the
+cores, while small batches are often faster on fewer threads than the
+default. The functions below query and set the size of the BLAS thread pool
+of the running process, pin processes to cores, and calibrate the best number
+of threads for a workload.
+
+The thread pool is controlled through threadpoolctl when it is installed.
+Otherwise the OpenBLAS or MKL library loaded by numpy is found in the memory
+map of the process (Linux only) and called through ctypes. The usual
+environment variables are always set too, so that processes started later
+with the spawn method, which load BLAS again, use the same number of threads.
+
+Example usage:
+
+with blas_threads(1):
+    scores = model.loss(X)
+
+# Four workers with two cores each on an eight core machine
+def worker(index):
+    configure_worker(index, num_workers=4)
+    ...
+
+threads, times = calibrate_threads(lambda: model.loss(X_batch))
+"""
+
+_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+             'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+# (getter, setter) symbol names of the libraries controlled through ctypes;
+# the OpenBLAS builds shipped in numpy and scipy wheels prefix and suffix them
+_SYMBOLS = (
+    ('openblas_get_num_threads', 'openblas_set_num_threads'),
+    ('openblas_get_num_threads64_', 'openblas_set_num_threads64_'),
+    ('scipy_openblas_get_num_threads64_', 'scipy_openblas_set_num_threads64_'),
+    ('scipy_openblas_get_num_threads', 'scipy_openblas_set_num_threads'),
+    ('MKL_Get_Max_Threads', 'MKL_Set_Num_Threads'),
+)
+
+_libraries = None
+
+
+def _find_libraries():
+    """
+    List of (path, getter, setter) of the BLAS libraries loaded in the process
+    that can be controlled through ctypes.
+    """
+    global _libraries
+    if _libraries is not None:
+        return _libraries
+    _libraries = []
+    try:
+        with open('/proc/self/maps') as f:
+            paths = sorted(set(line.split()[-1] for line in f
+                               if '.so' in line and
+                               ('blas' in line.lower() or 'mkl' in line)))
+    except (IOError, OSError):
+        return _libraries
+    for path in paths:
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for get_name, set_name in _SYMBOLS:
+            if hasattr(lib, get_name) and hasattr(lib, set_name):
+                getter, setter = getattr(lib, get_name), getattr(lib, set_name)
+                getter.restype = ctypes.c_int
+                setter.argtypes = [ctypes.c_int]
+                _libraries.append((path, getter, setter))
+                break
+    return _libraries
+
+
+def _threadpoolctl():
+    try:
+        import threadpoolctl
+    except ImportError:
+        return None
+    return threadpoolctl
+
+
+def available_cores():
+    """
+    Number of cores the process may run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def blas_info():
+    """
+    List of dictionaries describing the BLAS libraries of the process, with
+    the keys 'library', 'path' and 'num_threads'.
+    """
+    threadpoolctl = _threadpoolctl()
+    if threadpoolctl is not None:
+        return [{'library': i.get('internal_api'), 'path': i.get('filepath'),
+                 'num_threads': i.get('num_threads')}
+                for i in threadpoolctl.threadpool_info()
+                if i.get('user_api') == 'blas']
+    return [{'library': os.path.basename(path), 'path': path,
+             'num_threads': getter()}
+            for path, getter, _ in _find_libraries()]
+
+
+def get_blas_threads():
+    """
+    Number of threads of the BLAS thread pool, or None if it cannot be
+    determined.
+    """
+    counts = [i['num_threads'] for i in blas_info()]
+    return max(counts) if counts else None
+
+
+def set_blas_threads(num_threads):
+    """
+    Set the number of BLAS threads of this process and of processes it starts
+    later.
+
+    Returns:
+    - The previous number of threads, or None if no BLAS library could be
+      controlled; in that case only the environment variables are set, which
+      take effect in processes started afterwards.
+    """
+    if num_threads < 1:
+        raise ValueError('num_threads must be positive')
+    previous = get_blas_threads()
+    for var in _ENV_VARS:
+        os.environ[var] = str(num_threads)
+    threadpoolctl = _threadpoolctl()
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(num_threads, user_api='blas')
+    else:
+        for _, _, setter in _find_libraries():
+            setter(num_threads)
+    return previous
+
+
+@contextmanager
+def blas_threads(num_threads):
+    """
+    Context manager running its body with num_threads BLAS threads and
+    restoring the previous number afterwards. None leaves the thread pool
+    unchanged.
+    """
+    if num_threads is None:
+        yield
+        return
+    env = {var: os.environ.get(var) for var in _ENV_VARS}
+    previous = set_blas_threads(num_threads)
+    try:
+        yield
+    finally:
+        if previous is not None:
+            set_blas_threads(previous)
+        for var, value in env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def pin_to_cores(cores, pid=0):
+    """
+    Restrict a process to a set of cores.
+
+    Inputs:
+    - cores: Iterable of core numbers.
+    - pid: Process id; 0 is the calling process.
+
+    Returns:
+    - The previous set of cores, or None if the platform does not support
+      affinity (e.g. macOS), in which case nothing is done.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    previous = os.sched_getaffinity(pid)
+    os.sched_setaffinity(pid, set(cores))
+    return previous
+
+
+def worker_cores(worker_index, num_workers, cores=None):
+    """
+    Split cores (by default the cores available to this process) into
+    num_workers contiguous groups of nearly equal size and return the group
+    of worker worker_index. With more workers than cores, workers share
+    cores round-robin.
+    """
+    if cores is None:
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+    cores = list(cores)
+    if not 0 <= worker_index < num_workers:
+        raise ValueError('worker_index must be in [0, num_workers)')
+    if num_workers >= len(cores):
+        return [cores[worker_index % len(cores)]]
+    bounds = np.linspace(0, len(cores), num_workers + 1).round().astype(int)
+    return cores[bounds[worker_index]:bounds[worker_index + 1]]
+
+
+def configure_worker(worker_index, num_workers, cores=None):
+    """
+    Pin the calling worker process to its share of the cores, see
+    worker_cores, and use one BLAS thread per core of the share, so that
+    num_workers processes together use every core once.
+
+    Returns:
+    - The list of cores of the worker.
+    """
+    share = worker_cores(worker_index, num_workers, cores)
+    pin_to_cores(share)
+    set_blas_threads(len(share))
+    return share
+
+
+def calibrate_threads(fn, thread_counts=None, repeats=3, verbose=False):
+    """
+    Find the number of BLAS threads with which fn() runs fastest.
+
+    Inputs:
+    - fn: Function without arguments running a representative workload, e.g.
+      a forward and backward pass of a model on one batch.
+    - thread_counts: Numbers of threads to try; the default is the powers of
+      two up to the number of available cores, and that number itself.
+    - repeats: Number of timed calls per thread count; the best is kept.
+
+    Returns a tuple of:
+    - best: The fastest number of threads. The BLAS thread pool is left
+      unchanged.
+    - times: Dictionary mapping each number of threads to the best time of
+      fn() in seconds.
+    """
+    if thread_counts is None:
+        cores = available_cores()
+        thread_counts = sorted(set([2 ** k for k in range(cores.bit_length())
+                                    if 2 ** k <= cores] + [cores]))
+    times = {}
+    for n in thread_counts:
+        with blas_threads(n):
+            fn()  # warm up the thread pool
+            best = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                fn()
+                best = min(best, time.perf_counter() - start)
+        times[n] = best
+        if verbose:
+            print('%3d threads: %.3f ms' % (n, 1000 * best))
+    return min(times, key=times.get), times
+
+
+def calibrate_batch_threads(model, X, y=None, batch_sizes=(1, 16, 64, 256),
+                            thread_counts=None, repeats=3, verbose=False):
+    """
+    Calibrate the number of BLAS threads for several batch sizes of a model.
+
+    Inputs:
+    - model: A model following the Solver API. It is not modified; training
+      steps run on a copy so that batch normalization statistics are kept.
+    - X: Array of data with at least max(batch_sizes) samples.
+    - y: If not None, labels of X; the calibration then times training steps
+      (forward and backward passes) instead of test-time forward passes.
+    - batch_sizes, thread_counts, repeats: See calibrate_threads.
+
+    Returns:
+    - A dictionary mapping each batch size to its fastest number of threads,
+      to be used with threads_for_batch.
+    """
+    import copy
+
+    model = copy.deepcopy(model)
+    table = {}
+    for batch_size in batch_sizes:
+        X_batch = X[:batch_size]
+        y_batch = None if y is None else y[:batch_size]
+        best, _ = calibrate_threads(lambda: model.loss(X_batch, y_batch),
+                                    thread_counts, repeats)
+        table[batch_size] = best
+        if verbose:
+            print('batch size %5d: %d threads' % (batch_size, best))
+    return table
+
+
+def threads_for_batch(table, batch_size):
+    """
+    Number of threads for batch_size from a table of calibrate_batch_threads:
+    the entry of the largest calibrated batch size not above batch_size, or
+    of the smallest one if batch_size is below all of them.
+    """
+    sizes = sorted(table)
+    below = [b for b in sizes if b <= batch_size]
+    return table[below[-1] if below else sizes[0]]
@@ -0,0 +1,369 @@
+import numpy as np
+
+from NN.layers import (affine_backward, affine_forward, batchnorm_backward,
+                       batchnorm_forward, distillation_loss, dropout_backward,
+                       dropout_forward, relu_backward, relu_forward,
+                       softmax_loss, spatial_batchnorm_backward,
+                       spatial_batchnorm_forward)
+from NN.fast_layers import (conv_backward_fast, conv_forward_fast,
+                            max_pool_backward_fast, max_pool_forward_fast)
+from NN.layer_utils import affine_relu_backward, affine_relu_forward
+
+"""
+This file implements a Sequential model that composes layer objects in a fixed
+order. Each layer object holds direct references to its parameter arrays, the
+gradients computed by its last backward pass and the cache of its last forward
+pass, so a training step does no string building or dictionary lookups by
+name. Every layer has the same interface:
+
+class Layer:
+  params: dict mapping short names ('W', 'b', 'gamma', ...) to arrays
+  grads: dict with the same keys, filled by backward()
+  forward(x, mode) -> out
+  backward(dout) -> dx
+
+where mode is 'train' or 'test'. Caches are only kept in train mode.
+
+The Sequential model conforms to the API expected by Solver: model.params maps
+names such as 'W1' or 'gamma3' (parameter name followed by the 1-based position
+of the layer) to arrays, and model.loss(X, y) returns scores or (loss, grads).
+"""
+
+
+class Layer(object):
+    """
+    Base class for the layers composed by Sequential. Subclasses define
+    forward and backward as described in the module docstring.
+
+    The class attribute regularized lists the names of the parameters that
+    receive L2 regularization.
+    """
+    regularized = ()
+
+    def __init__(self):
+        self.params = {}
+        self.grads = {}
+        self.cache = None
+
+
+class Affine(Layer):
+    """
+    Fully-connected layer; inputs of shape (N, d_1, ..., d_k) are flattened.
+    """
+    regularized = ('W',)
+
+    def __init__(self, input_dim, output_dim, weight_scale=1e-2):
+        super(Affine, self).__init__()
+        self.params['W'] = np.random.normal(scale=weight_scale,
+                                            size=(input_dim, output_dim))
+        self.params['b'] = np.zeros(output_dim)
+
+    def forward(self, x, mode):
+        out, cache = affine_forward(x, self.params['W'], self.params['b'])
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx, self.grads['W'], self.grads['b'] = affine_backward(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class AffineReLU(Affine):
+    """
+    Fully-connected layer followed by a ReLU, using the affine_relu sandwich.
+    """
+
+    def forward(self, x, mode):
+        out, cache = affine_relu_forward(x, self.params['W'], self.params['b'])
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx, self.grads['W'], self.grads['b'] = affine_relu_backward(dout,
+                                                                    self.cache)
+        self.cache = None
+        return dx
+
+
+class ReLU(Layer):
+
+    def forward(self, x, mode):
+        out, cache = relu_forward(x)
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx = relu_backward(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class BatchNorm(Layer):
+    """
+    Batch normalization over the features of (N, D) inputs. The running
+    statistics live in bn_param.
+    """
+
+    def __init__(self, dim, momentum=0.9, eps=1e-5):
+        super(BatchNorm, self).__init__()
+        self.params['gamma'] = np.ones(dim)
+        self.params['beta'] = np.zeros(dim)
+        self.bn_param = {'mode': 'train', 'momentum': momentum, 'eps': eps}
+
+    def forward(self, x, mode):
+        self.bn_param['mode'] = mode
+        out, cache = batchnorm_forward(x, self.params['gamma'],
+                                       self.params['beta'], self.bn_param)
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx, self.grads['gamma'], self.grads['beta'] = batchnorm_backward(
+            dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class SpatialBatchNorm(BatchNorm):
+    """
+    Batch normalization over the channels of (N, C, H, W) inputs.
+    """
+
+    def forward(self, x, mode):
+        self.bn_param['mode'] = mode
+        out, cache = spatial_batchnorm_forward(x, self.params['gamma'],
+                                               self.params['beta'],
+                                               self.bn_param)
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx, self.grads['gamma'], self.grads['beta'] = \
+            spatial_batchnorm_backward(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class Dropout(Layer):
+    """
+    Inverted dropout keeping each activation with probability p. Passing seed
+    makes the masks deterministic, e.g. for gradient checking.
+    """
+
+    def __init__(self, p, seed=None):
+        super(Dropout, self).__init__()
+        self.dropout_param = {'mode': 'train', 'p': p}
+        if seed is not None:
+            self.dropout_param['seed'] = seed
+
+    def forward(self, x, mode):
+        self.dropout_param['mode'] = mode
+        out, cache = dropout_forward(x, self.dropout_param)
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx = dropout_backward(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class Conv(Layer):
+    """
+    Convolutional layer with num_filters filters of size
+    filter_size x filter_size over inputs of shape (N, channels, H, W). The
+    default padding preserves the spatial size for odd filter sizes.
+    """
+    regularized = ('W',)
+
+    def __init__(self, channels, num_filters, filter_size, stride=1, pad=None,
+                 weight_scale=1e-2):
+        super(Conv, self).__init__()
+        if pad is None:
+            pad = (filter_size - 1) // 2
+        self.conv_param = {'stride': stride, 'pad': pad}
+        self.params['W'] = np.random.normal(
+            scale=weight_scale,
+            size=(num_filters, channels, filter_size, filter_size))
+        self.params['b'] = np.zeros(num_filters)
+
+    def forward(self, x, mode):
+        out, cache = conv_forward_fast(x, self.params['W'], self.params['b'],
+                                       self.conv_param)
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx, self.grads['W'], self.grads['b'] = conv_backward_fast(dout,
+                                                                  self.cache)
+        self.cache = None
+        return dx
+
+
+class MaxPool(Layer):
+    """
+    Max pooling over pool_size x pool_size windows of (N, C, H, W) inputs.
+    """
+
+    def __init__(self, pool_size=2, stride=None):
+        super(MaxPool, self).__init__()
+        self.pool_param = {'pool_height': pool_size, 'pool_width': pool_size,
+                           'stride': pool_size if stride is None else stride}
+
+    def forward(self, x, mode):
+        out, cache = max_pool_forward_fast(x, self.pool_param)
+        if mode == 'train':
+            self.cache = cache
+        return out
+
+    def backward(self, dout):
+        dx = max_pool_backward_fast(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class ChannelsFirst(Layer):
+    """
+    Transposes images of shape (N, H, W, C), as loaded by cv2.imread, to the
+    (N, C, H, W) layout expected by the convolutional layers.
+    """
+
+    def forward(self, x, mode):
+        return x.transpose(0, 3, 1, 2)
+
+    def backward(self, dout):
+        return dout.transpose(0, 2, 3, 1)
+
+
+class _ParamDict(dict):
+    """
+    Dictionary of model parameters that keeps the references held by the
+    layers in sync when an entry is replaced, e.g. by Solver after an update.
+    """
+
+    def __init__(self, bindings):
+        super(_ParamDict, self).__init__()
+        self._bindings = bindings
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        # Unpickling sets the items before _bindings is restored
+        bindings = getattr(self, '_bindings', None)
+        if bindings is not None:
+            layer, name = bindings[key]
+            layer.params[name] = value
+
+
+class Sequential(object):
+    """
+    A model that applies a list of layers in order followed by a softmax loss.
+
+    For example, a small convolutional network for 28x28 RGB digits:
+
+    model = Sequential([
+        Conv(3, 16, 3), SpatialBatchNorm(16), ReLU(), MaxPool(2),
+        AffineReLU(16 * 14 * 14, 100), Affine(100, 10),
+    ], reg=1e-3)
+
+    The execution plan, i.e. the forward and backward order of the layers and
+    the mapping from model parameter names to layers, is built once in the
+    constructor.
+    """
+
+    def __init__(self, layers, reg=0.0, dtype=np.float32):
+        """
+        Initialize a new Sequential model.
+
+        Inputs:
+        - layers: A list of Layer objects; the last one produces the scores.
+        - reg: Scalar giving L2 regularization strength, applied to the
+          parameters listed in each layer's regularized attribute.
+        - dtype: A numpy datatype object; all computations will be performed
+          using this datatype.
+        """
+        self.layers = list(layers)
+        self.reg = reg
+        self.dtype = dtype
+        self.loss_scale = 1.0
+        self.distillation = None
+        self._dscores = None
+
+        self._forward_plan = self.layers
+        self._backward_plan = self.layers[::-1]
+        self._bindings = {}
+        self._param_plan = []
+        for i, layer in enumerate(self.layers):
+            for name in sorted(layer.params):
+                key = '%s%d' % (name, i + 1)
+                self._bindings[key] = (layer, name)
+                self._param_plan.append((key, layer, name,
+                                         name in layer.regularized))
+
+        self.params = {k: layer.params[name].astype(dtype)
+                       for k, (layer, name) in self._bindings.items()}
+
+    @property
+    def params(self):
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        self._params = _ParamDict(self._bindings)
+        for k, v in params.items():
+            self._params[k] = v
+
+    @property
+    def bn_params(self):
+        return [layer.bn_param for layer in self.layers
+                if isinstance(layer, BatchNorm)]
+
+    @property
+    def dropout_params(self):
+        return [layer.dropout_param for layer in self.layers
+                if isinstance(layer, Dropout)]
+
+    def loss(self, X, y=None):
+        """
+        Compute loss and gradient for a minibatch of data.
+
+        Input / output: Same as TwoLayerNet in fc_net.py. The gradients are
+        multiplied by the loss_scale attribute, and the distillation attribute
+        selects distillation_loss (see FullyConnectedNet).
+        """
+        mode = 'test' if y is None else 'train'
+        out = X.astype(self.dtype, copy=False)
+        for layer in self._forward_plan:
+            out = layer.forward(out, mode)
+        if mode == 'test':
+            return out
+
+        if (self._dscores is None or self._dscores.shape != out.shape or
+                self._dscores.dtype != out.dtype):
+            self._dscores = np.empty_like(out)
+        if self.distillation is not None:
+            loss, dout = distillation_loss(out, y, out=self._dscores,
+                                           **self.distillation)
+        else:
+            loss, dout = softmax_loss(out, y, out=self._dscores)
+        if self.loss_scale != 1.0:
+            dout *= self.loss_scale
+        for layer in self._backward_plan:
+            dout = layer.backward(dout)
+
+        grads = {}
+        for key, layer, name, regularized in self._param_plan:
+            grad = layer.grads[name]
+            if regularized and self.reg:
+                w = layer.params[name]
+                loss += 0.5 * self.reg * np.sum(w * w)
+                grad += self.reg * self.loss_scale * w
+            grads[key] = grad
+        return loss, grads
@@ -1,14 +1,23 @@
 from __future__ import print_function, division
-from future import standard_library
-standard_library.install_aliases()
-from builtins import range
-from builtins import object
 import os
 import pickle as pickle
+import tempfile
+import time
+from collections import ChainMap
+from contextlib import contextmanager
 
 import numpy as np
 
 from NN import optim
+from NN.autotune import tuned_batch_size
+from NN.layers import softmax_loss_topk
+from NN.lr_schedule import ExponentialDecay, Schedule
+from NN.metrics import MetricLog
+
+
+@contextmanager
+def _null_region(name):
+    yield
 
 
 class Solver(object):
@@ -28,10 +37,12 @@ class Solver(object):
 
     After the train() method returns, model.params will contain the parameters
     that performed best on the validation set over the course of training.
-    In addition, the instance variable solver.loss_history will contain a list
-    of all losses encountered during training and the instance variables
-    solver.train_acc_history and solver.val_acc_history will be lists of the
-    accuracies of the model on the training and validation set at each epoch.
+    In addition, the instance variable solver.loss_history will contain a
+    metrics.MetricLog of the losses encountered during training (the most
+    recent history_size of them, plus downsampled aggregates) and the instance
+    variables solver.train_acc_history and solver.val_acc_history will be lists
+    of the accuracies of the model on the training and validation set at each
+    epoch.
 
     Example usage might look something like this:
 
@@ -99,9 +110,21 @@ class Solver(object):
           hyperparameters (see optim.py) but all update rules require a
           'learning_rate' parameter so that should always be present.
         - lr_decay: A scalar for learning rate decay; after each epoch the
-          learning rate is multiplied by this value.
+          learning rate is multiplied by this value. Ignored if lr_schedule is
+          given.
+        - lr_schedule: A schedule from lr_schedule.py (e.g. CosineDecay(),
+          Warmup(OneCycle(), warmup_epochs=1), ReduceOnPlateau()) giving the
+          learning rate of every iteration, starting from the learning_rate
+          in optim_config.
         - batch_size: Size of minibatches used to compute loss and gradient
-          during training.
+          during training. If not given, the training batch size tuned for
+          the model on this machine is used (see autotune), or 100.
+        - micro_batch_size: If not None, accumulate the gradient of each
+          minibatch over micro-batches of at most this many samples before the
+          update, so that activation memory is bounded by micro_batch_size
+          while the effective batch size is batch_size. Batch normalization
+          then normalizes each micro-batch with its own statistics, and the
+          running statistics decay by momentum once per minibatch.
         - num_epochs: The number of epochs to run for during training.
         - print_every: Integer; training losses will be printed every
           print_every iterations.
@@ -112,7 +135,73 @@ class Solver(object):
         - num_val_samples: Number of validation samples to use to check val
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
-          epoch.
+          epoch, or at every check when val_every is set, in which case the
+          file name also holds the iteration.
+        - history_size: Number of recent training losses kept in memory, and
+          of window aggregates kept in loss_history.aggregates; default 10000.
+        - history_window: Number of losses per aggregate window; default 100.
+        - metrics_file: If not None, every training loss is appended to this
+          file (see metrics.load_metric_file), after the values of earlier
+          runs already in it; checkpoints then reference the file instead of
+          storing the losses.
+        - ema_decay: If not None (e.g. 0.999), keep an exponential moving
+          average of the parameters in solver.ema_params, updated in place
+          after every ema_every steps. Accuracy checks then evaluate the
+          averaged parameters, so best_params and the model.params left by
+          train() are averaged parameters.
+        - ema_every: Number of steps between updates of the moving average;
+          each update decays by ema_decay ** ema_every. Default is 1.
+        - teacher: If not None, a trained model to distill into the model. The
+          teacher's test-time scores on X_train are computed once, at the
+          start of the first train(), and stored in a memory-mapped file; the
+          model is then trained on distillation_loss (see layers.py) with the
+          cached scores of each minibatch. The model must have a distillation
+          attribute (see FullyConnectedNet).
+        - distill_temperature: Temperature of the distillation; default 4.0.
+        - distill_alpha: Weight of the distillation term; default 0.5.
+        - teacher_cache: File for the cached teacher scores. A key file next
+          to it, with the suffix '.key', records the teacher and X_train the
+          scores were computed for; they are reused when both match and
+          computed again otherwise. By default an anonymous temporary file is
+          used.
+        - pruner: If not None, a pruning.MagnitudePruner that prunes the
+          parameters during training; its masks are applied after every
+          update and once more to the parameters left by train().
+        - master_dtype: If not None (e.g. np.float64), train in mixed precision:
+          the model computes in the dtype of its params (e.g. float32) while the
+          Solver keeps a master copy of every parameter in master_dtype, runs
+          the update rule on the master copy and casts the result back into
+          model.params.
+        - loss_scale: Initial scale applied to the gradients through the model's
+          loss_scale attribute and divided out before the update. Only used
+          with master_dtype.
+        - dynamic_loss_scale: Boolean; if True, skip updates with non-finite
+          gradients and halve the loss scale, and double it again after
+          scale_window consecutive finite steps.
+        - scale_window: See dynamic_loss_scale; default is 1000.
+        - val_every: Check train and val accuracy every val_every iterations
+          instead of at the end of every epoch.
+        - patience: If not None, stop training after this many consecutive
+          accuracy checks without an improvement of the monitored quantity by
+          more than min_delta.
+        - monitor: The quantity watched by patience: 'val_acc' (default) or
+          'val_loss'.
+        - min_delta: Smallest change of the monitored quantity that counts as
+          an improvement; default is 0.
+        - target_acc: If not None, stop as soon as the val accuracy reaches it.
+        - time_budget: If not None, stop after this many seconds of training.
+        - max_samples: If not None, stop after training on this many samples.
+        - profiler: If not None, a profiler.Profiler that is enabled while
+          train() runs and records the layer functions and the Solver stages.
+          At the end of train() its report is printed (if verbose) and its
+          Chrome trace is written if it has a trace_file.
+        - blas_threads: If not None, number of BLAS threads used while train()
+          runs, or 'auto' to pick the fastest number for a training step on
+          one (micro-)batch with a short calibration (see
+          runtime.calibrate_threads) at the start of the first train().
+        - tuning_profile: Path of the tuning profile to read the default batch
+          sizes from; None for autotune.default_profile_path(), False to
+          ignore tuning profiles.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -124,15 +213,67 @@ class Solver(object):
         self.update_rule = kwargs.pop('update_rule', 'sgd')
         self.optim_config = kwargs.pop('optim_config', {})
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
-        self.batch_size = kwargs.pop('batch_size', 100)
+        self.lr_schedule = kwargs.pop('lr_schedule', None)
+        self.tuning_profile = kwargs.pop('tuning_profile', None)
+        self.batch_size = kwargs.pop('batch_size', None)
+        self.micro_batch_size = kwargs.pop('micro_batch_size', None)
         self.num_epochs = kwargs.pop('num_epochs', 10)
         self.num_train_samples = kwargs.pop('num_train_samples', 1000)
         self.num_val_samples = kwargs.pop('num_val_samples', None)
 
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
+        self.history_size = kwargs.pop('history_size', 10000)
+        self.history_window = kwargs.pop('history_window', 100)
+        self.metrics_file = kwargs.pop('metrics_file', None)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
 
+        self.ema_decay = kwargs.pop('ema_decay', None)
+        self.ema_every = kwargs.pop('ema_every', 1)
+        self.teacher = kwargs.pop('teacher', None)
+        self.distill_temperature = kwargs.pop('distill_temperature', 4.0)
+        self.distill_alpha = kwargs.pop('distill_alpha', 0.5)
+        self.teacher_cache = kwargs.pop('teacher_cache', None)
+        self.pruner = kwargs.pop('pruner', None)
+        self.master_dtype = kwargs.pop('master_dtype', None)
+        self.loss_scale = kwargs.pop('loss_scale', 1.0)
+        self.dynamic_loss_scale = kwargs.pop('dynamic_loss_scale', False)
+        self.scale_window = kwargs.pop('scale_window', 1000)
+        self.profiler = kwargs.pop('profiler', None)
+        self.blas_threads = kwargs.pop('blas_threads', None)
+
+        self.val_every = kwargs.pop('val_every', None)
+        self.patience = kwargs.pop('patience', None)
+        self.monitor = kwargs.pop('monitor', 'val_acc')
+        self.min_delta = kwargs.pop('min_delta', 0.0)
+        self.target_acc = kwargs.pop('target_acc', None)
+        self.time_budget = kwargs.pop('time_budget', None)
+        self.max_samples = kwargs.pop('max_samples', None)
+        if self.micro_batch_size is not None and self.micro_batch_size < 1:
+            raise ValueError('micro_batch_size must be positive')
+        if self.ema_decay is not None and not 0 <= self.ema_decay < 1:
+            raise ValueError('ema_decay must be in [0, 1)')
+        if not (self.blas_threads is None or self.blas_threads == 'auto' or
+                self.blas_threads >= 1):
+            raise ValueError('blas_threads must be positive, None or "auto"')
+        if self.monitor not in ('val_acc', 'val_loss'):
+            raise ValueError('Invalid monitor "%s"' % self.monitor)
+        self._region = (self.profiler.region if self.profiler is not None
+                        else _null_region)
+        if self.teacher is not None and not hasattr(model, 'distillation'):
+            raise ValueError('teacher requires a model with a distillation '
+                             'attribute')
+        if self.master_dtype is not None and not hasattr(model, 'loss_scale'):
+            raise ValueError('master_dtype requires a model with a loss_scale '
+                             'attribute')
+
+        # Batch sizes from the tuning profile are resolved once, here
+        if self.batch_size is None:
+            self.batch_size = tuned_batch_size(model, 'train', 100,
+                                               self.tuning_profile)
+        self.eval_batch_size = tuned_batch_size(model, 'inference', 100,
+                                                self.tuning_profile)
+
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
             extra = ', '.join('"%s"' % k for k in list(kwargs.keys()))
@@ -144,6 +285,12 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        if self.lr_schedule is None:
+            if self.lr_decay != 1.0:
+                self.lr_schedule = ExponentialDecay(self.lr_decay)
+            else:
+                self.lr_schedule = Schedule()
+
         self._reset()
 
 
@@ -156,15 +303,52 @@ class Solver(object):
         self.epoch = 0
         self.best_val_acc = 0
         self.best_params = {}
-        self.loss_history = []
+        self.loss_history = MetricLog(self.history_size, self.history_window,
+                                      filename=self.metrics_file)
         self.train_acc_history = []
         self.val_acc_history = []
-
-        # Make a deep copy of the optim_config for each parameter
+        self.val_loss_history = []
+
+        # Book-keeping for the stopping criteria
+        self.num_samples_seen = 0
+        self.best_monitored = None
+        self.num_bad_checks = 0
+        self.stop_reason = None
+
+        # The hyperparameters in optim_config, including the learning rate set
+        # by the schedule, are stored once and shared by all parameters; each
+        # parameter's config only holds its own state (momentum, Adam moments)
+        # in the first map of a ChainMap.
+        self.hyperparams = dict(self.optim_config)
+        if 'learning_rate' not in self.hyperparams:
+            _, defaults = self.update_rule(np.zeros(1), np.zeros(1), {})
+            self.hyperparams['learning_rate'] = defaults['learning_rate']
+        self.base_learning_rate = self.hyperparams['learning_rate']
         self.optim_configs = {}
         for p in self.model.params:
-            d = {k: v for k, v in self.optim_config.items()}
-            self.optim_configs[p] = d
+            self.optim_configs[p] = ChainMap({}, self.hyperparams)
+
+        # Persistent gradient buffers for micro-batch accumulation
+        self.grad_buffers = {}
+
+        # Teacher scores of the training samples, see _cache_teacher_scores
+        self.teacher_scores = None
+
+        # Master copies of the parameters for mixed-precision training
+        self.master_params = None
+        self.num_finite_steps = 0
+        if self.master_dtype is not None:
+            self.master_params = {p: w.astype(self.master_dtype)
+                                  for p, w in self.model.params.items()}
+            self.model.loss_scale = self.loss_scale
+
+        # Moving average of the parameters, in the precision of the updates
+        self.num_steps = 0
+        self.ema_params = None
+        self._ema_scratch = {}
+        if self.ema_decay is not None:
+            params = self.master_params or self.model.params
+            self.ema_params = {p: w.copy() for p, w in params.items()}
 
 
     def _step(self):
@@ -172,48 +356,287 @@ class Solver(object):
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
-        # Make a minibatch of training data
         num_train = self.X_train.shape[0]
         batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+        if (self.micro_batch_size is not None and
+                self.micro_batch_size < self.batch_size):
+            loss, grads = self._accumulate_gradients(batch_mask)
+        else:
+            loss, grads = self._batch_loss(batch_mask)
+        self.loss_history.append(loss)
+
+        with self._region('update'):
+            if self.master_params is not None:
+                self._mixed_precision_update(grads)
+            else:
+                # Perform a parameter update
+                for p, w in self.model.params.items():
+                    dw = grads[p]
+                    config = self.optim_configs[p]
+                    next_w, next_config = self.update_rule(w, dw, config)
+                    self.model.params[p] = next_w
+                    self.optim_configs[p] = next_config
+
+        if self.pruner is not None:
+            with self._region('prune'):
+                self._prune()
+
+        self.num_steps += 1
+        if self.ema_params is not None and self.num_steps % self.ema_every == 0:
+            with self._region('ema'):
+                self._update_ema()
+
+
+    def _batch_loss(self, mask):
+        """
+        Loss and gradients of the model on the training samples in mask, with
+        the cached teacher scores of those samples when distilling.
+        """
+        # Make a minibatch of training data
+        with self._region('minibatch'):
+            X_batch = self.X_train[mask]
+            y_batch = self.y_train[mask]
+            if self.teacher_scores is not None:
+                self.model.distillation = {
+                    'teacher_scores': self.teacher_scores[mask],
+                    'temperature': self.distill_temperature,
+                    'alpha': self.distill_alpha,
+                }
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
-        self.loss_history.append(loss)
+        with self._region('loss'):
+            try:
+                return self.model.loss(X_batch, y_batch)
+            finally:
+                if self.teacher_scores is not None:
+                    self.model.distillation = None
+
+
+    def _cache_teacher_scores(self, batch_size=None):
+        """
+        Compute the teacher's test-time scores on X_train in batches into a
+        memory-mapped float32 array, or reuse those in teacher_cache if its
+        key file matches the teacher and X_train. The default batch size is
+        the teacher's tuned inference batch size.
+        """
+        if batch_size is None:
+            batch_size = tuned_batch_size(self.teacher, 'inference', 100,
+                                          self.tuning_profile)
+        N = self.X_train.shape[0]
+        C = self.teacher.loss(self.X_train[:1]).shape[1]
+        shape = (N, C)
+        filename = self.teacher_cache
+        if filename is not None:
+            key = self._teacher_cache_key()
+            key_file = filename + '.key'
+            if os.path.exists(filename) and os.path.exists(key_file) and \
+                    os.path.getsize(filename) == N * C * 4:
+                with open(key_file) as f:
+                    if f.read() == key:
+                        self.teacher_scores = np.memmap(
+                            filename, dtype=np.float32, mode='r', shape=shape)
+                        return
+            # Invalidate the key until the new scores are written
+            if os.path.exists(key_file):
+                os.remove(key_file)
+        else:
+            filename = tempfile.TemporaryFile()
+        scores = np.memmap(filename, dtype=np.float32, mode='w+', shape=shape)
+        for start in range(0, N, batch_size):
+            end = start + batch_size
+            scores[start:end] = self.teacher.loss(self.X_train[start:end])
+        scores.flush()
+        if self.teacher_cache is not None:
+            with open(key_file, 'w') as f:
+                f.write(key)
+        self.teacher_scores = scores
+
+
+    def _teacher_cache_key(self):
+        """
+        Key identifying the teacher scores on X_train: the fingerprint of the
+        teacher and a hash of X_train.
+        """
+        import hashlib
+        from NN.detect import model_fingerprint
+
+        h = hashlib.blake2b(digest_size=16)
+        X = np.ascontiguousarray(self.X_train)
+        h.update(('%s%s' % (X.dtype.str, X.shape)).encode())
+        h.update(X)
+        return '%s %s' % (model_fingerprint(self.teacher), h.hexdigest())
 
-        # Perform a parameter update
-        for p, w in self.model.params.items():
-            dw = grads[p]
+
+    def _accumulate_gradients(self, batch_mask):
+        """
+        Compute the loss and gradient of the minibatch batch_mask as the
+        size-weighted mean over micro-batches, accumulating the gradients in
+        place into self.grad_buffers. Called by _step().
+        """
+        N = batch_mask.shape[0]
+        num_micro = -(-N // self.micro_batch_size)
+
+        # The running statistics of batch normalization are updated once per
+        # micro-batch; decay them by momentum ** (1 / num_micro) each time so
+        # they decay by momentum per minibatch as without accumulation.
+        bn_params = getattr(self.model, 'bn_params', [])
+        saved_momentum = [bn_param.get('momentum') for bn_param in bn_params]
+        for bn_param in bn_params:
+            momentum = bn_param.get('momentum', 0.9)
+            bn_param['momentum'] = momentum ** (1.0 / num_micro)
+
+        loss = 0.0
+        try:
+            for i in range(num_micro):
+                mask = batch_mask[i * self.micro_batch_size:
+                                  (i + 1) * self.micro_batch_size]
+                micro_loss, grads = self._batch_loss(mask)
+                weight = mask.shape[0] / N
+                loss += weight * micro_loss
+                for p, dw in grads.items():
+                    buf = self.grad_buffers.get(p)
+                    if buf is None or buf.shape != dw.shape:
+                        buf = self.grad_buffers[p] = np.empty_like(dw)
+                    if i == 0:
+                        np.multiply(dw, weight, out=buf)
+                    else:
+                        dw *= weight
+                        buf += dw
+        finally:
+            for bn_param, momentum in zip(bn_params, saved_momentum):
+                if momentum is None:
+                    del bn_param['momentum']
+                else:
+                    bn_param['momentum'] = momentum
+
+        return loss, self.grad_buffers
+
+
+    def _mixed_precision_update(self, grads):
+        """
+        Unscale the gradients into master_dtype, update the master copy of each
+        parameter and cast it back into model.params. Called by _step().
+        """
+        scale = self.model.loss_scale
+        master_grads = {}
+        for p, dw in grads.items():
+            master_grads[p] = dw.astype(self.master_dtype)
+            master_grads[p] /= scale
+
+        if self.dynamic_loss_scale:
+            finite = all(np.all(np.isfinite(dw))
+                         for dw in master_grads.values())
+            if not finite:
+                self.model.loss_scale = scale / 2
+                self.num_finite_steps = 0
+                return
+            self.num_finite_steps += 1
+            if self.num_finite_steps % self.scale_window == 0:
+                self.model.loss_scale = scale * 2
+
+        for p, w in self.master_params.items():
             config = self.optim_configs[p]
-            next_w, next_config = self.update_rule(w, dw, config)
-            self.model.params[p] = next_w
+            next_w, next_config = self.update_rule(w, master_grads[p], config)
+            self.master_params[p] = next_w
             self.optim_configs[p] = next_config
+            self.model.params[p] = next_w.astype(self.model.params[p].dtype)
 
 
-    def _save_checkpoint(self):
+    def _prune(self):
+        """
+        Let the pruner update and apply its masks after an update. With mixed
+        precision the master copy is pruned and cast back into model.params.
+        Called by _step().
+        """
+        if self.master_params is None:
+            self.pruner.step(self.model.params)
+            return
+        self.pruner.step(self.master_params)
+        for p in self.pruner.masks:
+            self.model.params[p] = self.master_params[p].astype(
+                self.model.params[p].dtype)
+
+
+    def _update_ema(self):
+        """
+        Move ema_params towards the current parameters in place:
+        ema += (1 - decay) * (w - ema), using a preallocated scratch array per
+        parameter. The decay is smaller during the first updates so that the
+        average forgets the initialization quickly. Called by _step().
+        """
+        num_updates = self.num_steps // self.ema_every
+        decay = min(self.ema_decay ** self.ema_every,
+                    (1.0 + num_updates) / (10.0 + num_updates))
+        params = self.master_params or self.model.params
+        for p, ema in self.ema_params.items():
+            scratch = self._ema_scratch.get(p)
+            if scratch is None:
+                scratch = self._ema_scratch[p] = np.empty_like(ema)
+            np.subtract(params[p], ema, out=scratch)
+            scratch *= 1 - decay
+            ema += scratch
+
+
+    @contextmanager
+    def ema_weights(self):
+        """
+        Context manager that puts the moving average of the parameters into
+        the model, cast to the dtype of its params, and restores the trained
+        parameters on exit.
+
+        Example usage:
+
+        with solver.ema_weights():
+            scores = solver.model.loss(X_test)
+        """
+        if self.ema_params is None:
+            raise ValueError('ema_weights requires ema_decay')
+        params = self.model.params
+        self.model.params = {p: self.ema_params[p].astype(w.dtype, copy=False)
+                             for p, w in params.items()}
+        try:
+            yield
+        finally:
+            self.model.params = params
+
+
+    def _save_checkpoint(self, iteration):
         if self.checkpoint_name is None: return
         checkpoint = {
           'model': self.model,
           'update_rule': self.update_rule,
           'lr_decay': self.lr_decay,
+          'lr_schedule': self.lr_schedule,
           'optim_config': self.optim_config,
           'batch_size': self.batch_size,
+          'micro_batch_size': self.micro_batch_size,
           'num_train_samples': self.num_train_samples,
           'num_val_samples': self.num_val_samples,
+          'master_dtype': self.master_dtype,
+          'loss_scale': getattr(self.model, 'loss_scale', 1.0),
           'epoch': self.epoch,
+          'iteration': iteration,
           'loss_history': self.loss_history,
           'train_acc_history': self.train_acc_history,
           'val_acc_history': self.val_acc_history,
+          'val_loss_history': self.val_loss_history,
+          'num_samples_seen': self.num_samples_seen,
+          'ema_params': self.ema_params,
         }
-        filename = '%s_epoch_%d.pkl' % (self.checkpoint_name, self.epoch)
+        if self.val_every is None:
+            filename = '%s_epoch_%d.pkl' % (self.checkpoint_name, self.epoch)
+        else:
+            # Several checks per epoch; keep one file per check
+            filename = '%s_epoch_%d_iter_%d.pkl' % (self.checkpoint_name,
+                                                   self.epoch, iteration)
         if self.verbose:
             print('Saving checkpoint to "%s"' % filename)
         with open(filename, 'wb') as f:
             pickle.dump(checkpoint, f)
 
 
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+    def check_accuracy(self, X, y, num_samples=None, batch_size=None,
+                       return_loss=False, use_ema=False):
         """
         Check accuracy of the model on the provided data.
 
@@ -223,13 +646,26 @@ class Solver(object):
         - num_samples: If not None, subsample the data and only test the model
           on num_samples datapoints.
         - batch_size: Split X and y into batches of this size to avoid using
-          too much memory.
+          too much memory. If None, the inference batch size tuned for the
+          model on this machine is used (see autotune), or 100.
+        - return_loss: If True, also compute the mean softmax loss.
+        - use_ema: If True, evaluate the moving average of the parameters
+          (see ema_decay) instead of the current parameters.
 
         Returns:
         - acc: Scalar giving the fraction of instances that were correctly
           classified by the model.
+        - loss: Mean softmax loss, only returned if return_loss is True.
         """
 
+        if use_ema:
+            with self.ema_weights():
+                return self.check_accuracy(X, y, num_samples, batch_size,
+                                           return_loss)
+
+        if batch_size is None:
+            batch_size = self.eval_batch_size
+
         # Maybe subsample the data
         N = X.shape[0]
         if num_samples is not None and N > num_samples:
@@ -243,53 +679,160 @@ class Solver(object):
         if N % batch_size != 0:
             num_batches += 1
         y_pred = []
+        loss = 0.0
         for i in range(num_batches):
             start = i * batch_size
             end = (i + 1) * batch_size
             scores = self.model.loss(X[start:end])
             y_pred.append(np.argmax(scores, axis=1))
+            if return_loss:
+                batch_loss, _ = softmax_loss_topk(scores, y[start:end])
+                loss += batch_loss * scores.shape[0] / N
         y_pred = np.hstack(y_pred)
         acc = np.mean(y_pred == y)
 
+        if return_loss:
+            return acc, loss
         return acc
 
 
+    def _check_stopping(self, val_acc, val_loss):
+        """
+        Update the early stopping state after an accuracy check and return the
+        reason to stop, or None to continue.
+        """
+        if self.target_acc is not None and val_acc >= self.target_acc:
+            return 'target_acc'
+        if self.patience is None:
+            return None
+
+        # Compare so that larger is better for both monitored quantities
+        value = val_acc if self.monitor == 'val_acc' else -val_loss
+        if (self.best_monitored is None or
+                value > self.best_monitored + self.min_delta):
+            self.best_monitored = value
+            self.num_bad_checks = 0
+            return None
+        self.num_bad_checks += 1
+        if self.num_bad_checks >= self.patience:
+            return 'patience'
+        return None
+
+
     def train(self):
         """
-        Run optimization to train the model.
+        Run optimization to train the model. After it returns, stop_reason
+        records why training ended: 'completed', 'patience', 'target_acc',
+        'time_budget' or 'max_samples'.
+        """
+        from NN.runtime import blas_threads
+
+        if self.blas_threads == 'auto':
+            self._calibrate_blas_threads()
+        with blas_threads(self.blas_threads):
+            if self.profiler is not None:
+                self.profiler.enable()
+                try:
+                    self._train()
+                finally:
+                    self.profiler.disable()
+                if self.verbose:
+                    self.profiler.print_report()
+                if self.profiler.trace_file is not None:
+                    self.profiler.export_chrome_trace()
+            else:
+                self._train()
+
+
+    def _calibrate_blas_threads(self):
+        """
+        Replace blas_threads='auto' by the number of threads with which a
+        training step (forward and backward pass) on one batch, or
+        micro-batch, is fastest. The steps run on a copy of the model so that
+        its batch normalization statistics are unchanged.
+        """
+        import copy
+        from NN.runtime import calibrate_threads
+
+        model = copy.deepcopy(self.model)
+        size = min(self.micro_batch_size or self.batch_size, self.batch_size)
+        X_batch, y_batch = self.X_train[:size], self.y_train[:size]
+        self.blas_threads, times = calibrate_threads(
+            lambda: model.loss(X_batch, y_batch))
+        if self.verbose:
+            timings = ', '.join('%d: %.2f ms' % (n, 1000 * t)
+                                for n, t in sorted(times.items()))
+            print('Using %d BLAS threads (%s)' % (self.blas_threads, timings))
+
+
+    def _train(self):
+        """
+        The optimization loop of train().
         """
         num_train = self.X_train.shape[0]
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
+        self.lr_schedule.reset(self.base_learning_rate, num_iterations,
+                               iterations_per_epoch)
+        if self.pruner is not None:
+            self.pruner.reset(self.model.params, num_iterations,
+                              iterations_per_epoch)
+        if self.teacher is not None and self.teacher_scores is None:
+            with self._region('teacher'):
+                self._cache_teacher_scores()
+        start_time = time.time()
+        self.stop_reason = None
 
         for t in range(num_iterations):
+            self.hyperparams['learning_rate'] = self.lr_schedule(t)
             self._step()
+            self.num_samples_seen += self.batch_size
 
             # Maybe print training loss
             if self.verbose and t % self.print_every == 0:
                 print('(Iteration %d / %d) loss: %f' % (
                        t + 1, num_iterations, self.loss_history[-1]))
 
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
+            # At the end of every epoch, increment the epoch counter.
             epoch_end = (t + 1) % iterations_per_epoch == 0
             if epoch_end:
                 self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+            # Budgets are checked every iteration; a run that runs out of
+            # budget still gets a final accuracy check.
+            stop_reason = None
+            if (self.time_budget is not None and
+                    time.time() - start_time >= self.time_budget):
+                stop_reason = 'time_budget'
+            elif (self.max_samples is not None and
+                    self.num_samples_seen >= self.max_samples):
+                stop_reason = 'max_samples'
 
             # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
+            # iteration, and at the end of each epoch (or every val_every
+            # iterations).
             first_it = (t == 0)
             last_it = (t == num_iterations - 1)
-            if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(self.X_train, self.y_train,
-                    num_samples=self.num_train_samples)
-                val_acc = self.check_accuracy(self.X_val, self.y_val,
-                    num_samples=self.num_val_samples)
+            if self.val_every is None:
+                check_it = epoch_end
+            else:
+                check_it = (t + 1) % self.val_every == 0
+            if first_it or last_it or check_it or stop_reason is not None:
+                use_ema = self.ema_params is not None
+                with self._region('check_accuracy'):
+                    train_acc = self.check_accuracy(self.X_train, self.y_train,
+                        num_samples=self.num_train_samples, use_ema=use_ema)
+                    val_acc, val_loss = self.check_accuracy(self.X_val,
+                        self.y_val, num_samples=self.num_val_samples,
+                        return_loss=True, use_ema=use_ema)
                 self.train_acc_history.append(train_acc)
                 self.val_acc_history.append(val_acc)
-                self._save_checkpoint()
+                self.val_loss_history.append(val_loss)
+                self.lr_schedule.observe(val_acc)
+                if stop_reason is None:
+                    stop_reason = self._check_stopping(val_acc, val_loss)
+                with self._region('checkpoint'):
+                    self._save_checkpoint(t + 1)
 
                 if self.verbose:
                     print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
@@ -300,7 +843,27 @@ class Solver(object):
                     self.best_val_acc = val_acc
                     self.best_params = {}
                     for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
+                        if use_ema:
+                            self.best_params[k] = self.ema_params[k].astype(
+                                v.dtype)
+                        else:
+                            self.best_params[k] = v.copy()
+
+            if stop_reason is not None:
+                self.stop_reason = stop_reason
+                if self.verbose:
+                    print('(Iteration %d / %d) stopping: %s' % (
+                           t + 1, num_iterations, stop_reason))
+                break
+        else:
+            self.stop_reason = 'completed'
+
+        self.loss_history.flush()
 
         # At the end of training swap the best params into the model
         self.model.params = self.best_params
+        if self.pruner is not None:
+            self.pruner.apply(self.model.params)
+        if self.master_params is not None:
+            self.master_params = {p: w.astype(self.master_dtype)
+                                  for p, w in self.model.params.items()}